@@ -1,9 +1,7 @@
-
 # -*- coding: utf-8 -*-
 from .client import Client
 from .header import URL_MAPPINGS
+from .bulk_download import BulkDownloader, read_manifest
+from .routing import RoutingClient
 
-__all__ = ["Client"]
-
-if __name__ == '__main__':
-    # pass
+__all__ = ["Client", "BulkDownloader", "read_manifest", "RoutingClient"]
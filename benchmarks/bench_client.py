@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Offline benchmarks of the main client code paths against the local stub
+server.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+Usage::
+
+    python benchmarks/bench_client.py                    # print results
+    python benchmarks/bench_client.py --save base.json   # store baseline
+    python benchmarks/bench_client.py --compare base.json --tolerance 0.2
+
+With ``--compare`` the exit code is 1 if any benchmark became slower (or
+needs more memory) than the baseline by more than the tolerance.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from obspy import UTCDateTime  # NOQA
+
+from client import Client  # NOQA
+from header import FDSNException  # NOQA
+from stub_server import StubConfig, StubServer, trusted_certificate  # NOQA
+
+T0 = UTCDateTime(2008, 4, 16)
+
+
+class _Discard(object):
+    """
+    File-like object dropping everything written to it.
+    """
+    def write(self, data):
+        pass
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    index = min(int(round(q / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+class Benchmark(object):
+    """
+    A named client operation that is run repeatedly.
+    """
+    def __init__(self, name, func, repeat, workers=1):
+        self.name = name
+        self.func = func
+        self.repeat = repeat
+        self.workers = workers
+
+    def _timed_call(self, client):
+        t0 = time.perf_counter()
+        try:
+            self.func(client)
+            ok = True
+        except FDSNException:
+            ok = False
+        return time.perf_counter() - t0, ok
+
+    def run(self, client):
+        client.instrumentation.reset()
+        t0 = time.perf_counter()
+        if self.workers == 1:
+            results = [self._timed_call(client) for _ in range(self.repeat)]
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = list(executor.map(
+                    lambda _: self._timed_call(client), range(self.repeat)))
+        elapsed = time.perf_counter() - t0
+        latencies = [latency for latency, _ in results]
+        stats = client.instrumentation.get_stats().get("request", {})
+
+        # Peak Python memory of a single call, measured separately so that
+        # tracemalloc does not distort the timings above.
+        tracemalloc.start()
+        self._timed_call(client)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        return {
+            "name": self.name,
+            "requests": self.repeat,
+            "failed": sum(1 for _, ok in results if not ok),
+            "requests_per_s": self.repeat / elapsed,
+            "mb_per_s": stats.get("bytes_decoded_sum", 0) / elapsed / 1e6,
+            "p50_ms": percentile(latencies, 50) * 1e3,
+            "p99_ms": percentile(latencies, 99) * 1e3,
+            "peak_mb": peak / 1e6,
+        }
+
+
+def default_benchmarks(repeat):
+    return [
+        Benchmark("get_waveforms", lambda c: c.get_waveforms(
+            "TW", "NSE01", "--", "EHZ", T0, T0 + 3600), repeat),
+        Benchmark("get_waveforms x8", lambda c: c.get_waveforms(
+            "TW", "NSE01", "--", "EHZ", T0, T0 + 3600), repeat, workers=8),
+        Benchmark("get_waveforms raw", lambda c: c.get_waveforms(
+            "TW", "NSE01", "--", "EHZ", T0, T0 + 3600,
+            filename=_Discard()), repeat),
+        Benchmark("get_stations response", lambda c: c.get_stations(
+            network="TW", station="*", level="response"), repeat),
+        Benchmark("get_webservice_version", lambda c: c._download(
+            c._build_url("station", "version"), return_string=True), repeat),
+        Benchmark("token refresh", lambda c: c._refresh_access_token(),
+                  repeat),
+    ]
+
+
+def run(config, repeat):
+    with StubServer(config) as server:
+        with trusted_certificate(server.certfile):
+            client = Client(server.base_url, user="bench", password="bench")
+            return [benchmark.run(client)
+                    for benchmark in default_benchmarks(repeat)]
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return a list of messages for every metric that regressed by more than
+    ``tolerance`` (relative) compared to the baseline.
+    """
+    baseline = dict((r["name"], r) for r in baseline)
+    regressions = []
+    # metric -> True if larger is better
+    metrics = {"requests_per_s": True, "mb_per_s": True, "p50_ms": False,
+               "p99_ms": False, "peak_mb": False}
+    for result in results:
+        base = baseline.get(result["name"])
+        if base is None:
+            continue
+        for metric, larger_is_better in metrics.items():
+            old, new = base[metric], result[metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            if larger_is_better:
+                change = -change
+            if change > tolerance:
+                regressions.append("%s: %s %.3g -> %.3g (%+.0f%%)" % (
+                    result["name"], metric, old, new, change * 100))
+    return regressions
+
+
+def print_table(results):
+    header = "%-24s %8s %7s %9s %8s %9s %9s %8s" % (
+        "benchmark", "requests", "failed", "req/s", "MB/s", "p50 ms",
+        "p99 ms", "peak MB")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print("%-24s %8d %7d %9.1f %8.2f %9.2f %9.2f %8.2f" % (
+            r["name"], r["requests"], r["failed"], r["requests_per_s"],
+            r["mb_per_s"], r["p50_ms"], r["p99_ms"], r["peak_mb"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-n", "--repeat", type=int, default=20,
+                        help="Calls per benchmark (default: %(default)s).")
+    parser.add_argument("--npts", type=int, default=360000,
+                        help="Samples per synthetic trace.")
+    parser.add_argument("--nstations", type=int, default=10,
+                        help="Stations per synthetic StationXML.")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Injected server latency in seconds.")
+    parser.add_argument("--error", action="append", default=[],
+                        metavar="CODE:PROBABILITY",
+                        help="Inject HTTP errors, e.g. --error 503:0.05.")
+    parser.add_argument("--body-rate", type=float,
+                        help="Limit response bodies to this many bytes/s.")
+    parser.add_argument("--save", help="Write results as JSON to this file.")
+    parser.add_argument("--compare", help="Baseline JSON file to compare to.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed relative regression (default: "
+                             "%(default)s).")
+    args = parser.parse_args(argv)
+
+    errors = {}
+    for item in args.error:
+        code, probability = item.split(":")
+        errors[int(code)] = float(probability)
+    config = StubConfig(npts=args.npts, nstations=args.nstations,
+                        latency=args.latency, errors=errors,
+                        body_rate=args.body_rate)
+    results = run(config, args.repeat)
+    print_table(results)
+
+    if args.save:
+        with open(args.save, "w") as fh:
+            json.dump(results, fh, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as fh:
+            baseline = json.load(fh)
+        regressions = compare(results, baseline, args.tolerance)
+        for msg in regressions:
+            print("REGRESSION " + msg)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark: time to ``import client`` and construct a ``Client`` in
+a fresh interpreter.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+Usage::
+
+    python benchmarks/bench_startup.py -n 20 --max-ms 100
+
+Every run uses a new Python process, the reported times exclude the
+interpreter start itself. The exit code is 1 if the median construction
+time exceeds ``--max-ms`` or a heavy dependency got imported eagerly.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must not be imported by ``Client("TAPS")``.
+HEAVY_MODULES = ("obspy", "numpy", "scipy", "lxml", "gzip")
+
+SNIPPET = """
+import json, sys, time
+t0 = time.perf_counter()
+import client
+t1 = time.perf_counter()
+client.Client("TAPS")
+t2 = time.perf_counter()
+print(json.dumps({"import": t1 - t0, "construct": t2 - t0,
+                  "loaded": [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+def measure(repeat):
+    results = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", SNIPPET],
+                                         cwd=ROOT)
+        results.append(json.loads(output.decode().strip().splitlines()[-1]))
+    return results
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-n", "--repeat", type=int, default=10,
+                        help="Number of fresh processes (default: "
+                             "%(default)s).")
+    parser.add_argument("--max-ms", type=float,
+                        help="Fail if the median time to a ready client "
+                             "exceeds this many milliseconds.")
+    args = parser.parse_args(argv)
+
+    results = measure(args.repeat)
+    import_ms = median([r["import"] for r in results]) * 1e3
+    construct_ms = median([r["construct"] for r in results]) * 1e3
+    loaded = sorted(set(m for r in results for m in r["loaded"]))
+    print("import client:          %8.2f ms (median of %d)" % (
+        import_ms, args.repeat))
+    print("import + Client('TAPS'): %7.2f ms" % construct_ms)
+    print("heavy modules loaded:   %s" % (", ".join(loaded) or "none"))
+
+    failed = bool(loaded)
+    if args.max_ms is not None and construct_ms > args.max_ms:
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+Local stub of the TAPS FDSN web services for offline benchmarks.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+The server speaks HTTPS with a throw-away self-signed certificate (the
+client only ever sends tokens over https) and implements
+
+* ``/fdsnws/dataselect/0/query`` and ``queryauth``: synthetic MiniSEED
+* ``/fdsnws/station/0/query``: synthetic StationXML
+* ``/fdsnws/{dataselect,station}/0/version``
+* ``/api/token``, ``/api/token/verify`` and ``/api/token/refresh``
+
+Latency, HTTP errors and slow bodies can be injected through
+:class:`StubConfig`::
+
+    >>> with StubServer(StubConfig(latency=0.01)) as server:  # doctest: +SKIP
+    ...     with trusted_certificate(server.certfile):
+    ...         client = Client(server.base_url, user="u", password="p")
+    ...         st = client.get_waveforms("TW", "NSE01", "--", "EHZ",
+    ...                                   t, t + 60)
+"""
+import io
+import json
+import os
+import random
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+VERSION = b"1.1.0"
+
+
+class StubConfig(object):
+    """
+    Behaviour of the stub server.
+    :type npts: int
+    :param npts: Samples per synthetic trace, determines the MiniSEED size.
+    :type ntraces: int
+    :param ntraces: Number of traces per dataselect response.
+    :type nstations: int
+    :param nstations: Number of stations per StationXML response.
+    :type latency: float
+    :param latency: Seconds to wait before answering any request.
+    :type errors: dict
+    :param errors: Mapping of HTTP status codes (e.g. 413, 429, 503) to the
+        probability of answering a data request with that code.
+    :type body_rate: float
+    :param body_rate: If given, response bodies are sent with at most this
+        many bytes per second.
+    :type seed: int
+    :param seed: Seed of the random error injection.
+    """
+    def __init__(self, npts=360000, ntraces=1, nstations=10, latency=0.0,
+                 errors=None, body_rate=None, seed=42):
+        self.npts = npts
+        self.ntraces = ntraces
+        self.nstations = nstations
+        self.latency = latency
+        self.errors = errors or {}
+        self.body_rate = body_rate
+        self.random = random.Random(seed)
+
+
+def synthetic_mseed(npts, ntraces=1, network="TW", station="NSE01"):
+    """
+    Return STEIM2 compressed MiniSEED bytes holding a random walk.
+    """
+    from obspy import Stream, Trace, UTCDateTime
+    rng = np.random.RandomState(0)
+    st = Stream()
+    for i, channel in zip(range(ntraces), ("EHZ", "EHN", "EHE") * ntraces):
+        data = np.cumsum(rng.randint(-50, 50, npts)).astype(np.int32)
+        header = {"network": network, "station": station, "location": "",
+                  "channel": channel, "sampling_rate": 100.0,
+                  "starttime": UTCDateTime(2008, 4, 16)}
+        if i >= 3:
+            header["location"] = "%02d" % (i // 3)
+        st.append(Trace(data=data, header=header))
+    buf = io.BytesIO()
+    st.write(buf, format="MSEED", encoding="STEIM2", reclen=4096)
+    return buf.getvalue()
+
+
+def synthetic_stationxml(nstations, network="TW"):
+    """
+    Return StationXML bytes with ``nstations`` three component stations
+    including simple poles and zeros responses.
+    """
+    from obspy import UTCDateTime
+    from obspy.core.inventory import (Channel, Inventory, Network, Response,
+                                      Station)
+    start = UTCDateTime(2008, 1, 1)
+    response = Response.from_paz(
+        zeros=[0j, 0j], poles=[-4.44 + 4.44j, -4.44 - 4.44j],
+        stage_gain=400.0, input_units="M/S", output_units="V")
+    stations = []
+    for i in range(nstations):
+        channels = [
+            Channel(code, "", 24.0 + i * 0.01, 121.6, 30.0, 0.0,
+                    azimuth=azimuth, dip=dip, sample_rate=100.0,
+                    start_date=start, response=response)
+            for code, azimuth, dip in (("EHZ", 0.0, -90.0),
+                                       ("EHN", 0.0, 0.0),
+                                       ("EHE", 90.0, 0.0))]
+        stations.append(Station("NSE%02d" % (i + 1), 24.0 + i * 0.01, 121.6,
+                                30.0, channels=channels, start_date=start))
+    inv = Inventory(networks=[Network(network, stations=stations,
+                                      start_date=start)],
+                    source="TAPS stub server")
+    buf = io.BytesIO()
+    inv.write(buf, format="STATIONXML")
+    return buf.getvalue()
+
+
+def create_certificate(directory):
+    """
+    Create a self-signed certificate for localhost with the ``openssl``
+    command line tool. Returns the paths of certificate and key.
+    """
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.check_call(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+         "-keyout", keyfile, "-out", certfile, "-days", "1",
+         "-subj", "/CN=localhost",
+         "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+@contextmanager
+def trusted_certificate(certfile):
+    """
+    Make the stub server certificate trusted by all HTTPS connections of
+    this process that do not bring their own SSL context.
+    """
+    original = ssl._create_default_https_context
+
+    def create_context(*args, **kwargs):
+        kwargs["cafile"] = certfile
+        return ssl.create_default_context(*args, **kwargs)
+
+    ssl._create_default_https_context = create_context
+    try:
+        yield
+    finally:
+        ssl._create_default_https_context = original
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def _send(self, code, body=b"", content_type="application/octet-stream"):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        rate = self.config.body_rate
+        if not rate or not body:
+            self.wfile.write(body)
+            return
+        chunk = max(int(rate / 10), 1)
+        for i in range(0, len(body), chunk):
+            self.wfile.write(body[i:i + chunk])
+            self.wfile.flush()
+            time.sleep(0.1)
+
+    def _inject_fault(self):
+        """
+        Sleep for the configured latency and maybe answer with an error.
+        Returns True if an error was sent.
+        """
+        if self.config.latency:
+            time.sleep(self.config.latency)
+        with self.server.lock:
+            roll = self.config.random.random()
+        threshold = 0.0
+        for code, probability in sorted(self.config.errors.items()):
+            threshold += probability
+            if roll < threshold:
+                self._send(code, b"Error injected by stub server",
+                           "text/plain")
+                return True
+        return False
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        self.server.count(url.path)
+        if len(parts) != 4 or parts[0] != "fdsnws" or \
+                parts[1] not in ("dataselect", "station"):
+            self._send(404, b"Not found", "text/plain")
+            return
+        service, resource = parts[1], parts[3]
+        if resource == "version":
+            self._send(200, VERSION, "text/plain")
+            return
+        if self._inject_fault():
+            return
+        if service == "dataselect" and resource in ("query", "queryauth"):
+            query = parse_qs(url.query)
+            if resource == "queryauth" and not self.headers.get(
+                    "Authorization", "").startswith("JWT "):
+                self._send(401, b"Authentication required", "text/plain")
+                return
+            if query.get("station") == ["NODATA"]:
+                self._send(204)
+                return
+            self._send(200, self.server.mseed)
+        elif service == "station" and resource == "query":
+            self._send(200, self.server.stationxml, "application/xml")
+        else:
+            self._send(404, b"Not found", "text/plain")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        self.server.count(url.path)
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if self.config.latency:
+            time.sleep(self.config.latency)
+        if url.path == "/api/token":
+            if not payload.get("username") or not payload.get("password"):
+                self._send(401, b"{}", "application/json")
+                return
+            body = {"access": "stub-access", "refresh": "stub-refresh"}
+        elif url.path == "/api/token/verify":
+            body = {}
+        elif url.path == "/api/token/refresh":
+            body = {"access": "stub-access"}
+        else:
+            self._send(404, b"Not found", "text/plain")
+            return
+        self._send(200, json.dumps(body).encode("utf-8"), "application/json")
+
+
+class _StubHTTPServer(ThreadingHTTPServer):
+    # The default backlog of 5 makes concurrent benchmarks measure SYN
+    # retransmits instead of the client.
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class StubServer(object):
+    """
+    Threaded HTTPS stub server running in a background thread. Use as a
+    context manager or call :meth:`start` and :meth:`stop`.
+    """
+    def __init__(self, config=None, host="localhost", port=0):
+        self.config = config or StubConfig()
+        self.host = host
+        self.port = port
+        self._tmpdir = None
+        self._httpd = None
+        self._thread = None
+        self.certfile = None
+
+    @property
+    def base_url(self):
+        return "https://%s:%d" % (self.host, self._httpd.server_address[1])
+
+    @property
+    def counts(self):
+        """
+        Number of requests received per path.
+        """
+        return dict(self._httpd.counts)
+
+    def start(self):
+        self._tmpdir = tempfile.mkdtemp(prefix="taps_stub_")
+        self.certfile, keyfile = create_certificate(self._tmpdir)
+        httpd = _StubHTTPServer((self.host, self.port), StubRequestHandler)
+        httpd.config = self.config
+        httpd.lock = threading.Lock()
+        httpd.counts = {}
+        httpd.mseed = synthetic_mseed(self.config.npts, self.config.ntraces)
+        httpd.stationxml = synthetic_stationxml(self.config.nstations)
+
+        def count(path):
+            with httpd.lock:
+                httpd.counts[path] = httpd.counts.get(path, 0) + 1
+        httpd.count = count
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.certfile, keyfile)
+        httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
+        self._httpd = httpd
+        self._thread = threading.Thread(target=httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._thread.join()
+            self._httpd = None
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Run the TAPS stub server.")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--npts", type=int, default=360000)
+    args = parser.parse_args()
+    server = StubServer(StubConfig(npts=args.npts, latency=args.latency),
+                        port=args.port).start()
+    print("Serving on %s, certificate: %s" % (server.base_url,
+                                              server.certfile))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Client-wide memory budget for concurrent and bulk downloads.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+A :class:`MemoryBudget` counts the bytes of response bodies buffered by
+in-flight requests and of decoded data not yet consumed by the caller.
+When the budget is used up, new requests wait until capacity is released
+and response bodies that do not fit any more are spilled to temporary
+files::
+
+    >>> budget = MemoryBudget(512 * 1024 ** 2)
+    >>> client = Client("TAPS", memory_budget=budget)  # doctest: +SKIP
+    >>> for i, st in client.iter_waveforms_batch(reqs, workers=32):
+    ...     process(st)  # doctest: +SKIP
+"""
+import io
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# Size of the chunks response bodies are read in.
+CHUNK_SIZE = 256 * 1024
+
+
+class MemoryBudget(object):
+    """
+    Thread safe byte counter with an upper limit.
+    :type max_bytes: int
+    :param max_bytes: Number of bytes that may be held in memory at once.
+    :type spill_dir: str
+    :param spill_dir: Directory of temporary files for spilled responses,
+        defaults to the system temporary directory.
+    """
+    def __init__(self, max_bytes, spill_dir=None):
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be positive.")
+        self.max_bytes = int(max_bytes)
+        self.spill_dir = spill_dir
+        self._init_state()
+
+    def _init_state(self):
+        self._cond = threading.Condition()
+        self.used = 0
+        self.peak = 0
+        self.spilled = 0
+        self._exempt = {}
+
+    def __getstate__(self):
+        # Budgets are per process, only the configuration is pickled.
+        return {"max_bytes": self.max_bytes, "spill_dir": self.spill_dir}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def __repr__(self):
+        return "MemoryBudget(used=%d, max_bytes=%d)" % (self.used,
+                                                         self.max_bytes)
+
+    @property
+    def available(self):
+        return max(self.max_bytes - self.used, 0)
+
+    def try_reserve(self, nbytes):
+        """
+        Reserve ``nbytes`` if they fit into the budget, returns whether
+        they were reserved.
+        """
+        with self._cond:
+            if self.used + nbytes > self.max_bytes:
+                return False
+            self._add(nbytes)
+            return True
+
+    def reserve(self, nbytes):
+        """
+        Reserve ``nbytes`` unconditionally, e.g. for data that already is
+        in memory. May push the budget above its limit.
+        """
+        with self._cond:
+            self._add(nbytes)
+
+    def _add(self, nbytes):
+        self.used += nbytes
+        self.peak = max(self.peak, self.used)
+
+    def release(self, nbytes):
+        with self._cond:
+            self.used = max(self.used - nbytes, 0)
+            self._cond.notify_all()
+
+    def wait_for_capacity(self, timeout=None):
+        """
+        Block until the budget is not exhausted any more. Returns False if
+        the timeout passed first. Threads inside :meth:`exempt` never wait.
+        """
+        with self._cond:
+            if threading.get_ident() in self._exempt:
+                return True
+            return self._cond.wait_for(lambda: self.used < self.max_bytes,
+                                       timeout=timeout)
+
+    @contextmanager
+    def exempt(self):
+        """
+        Let the calling thread pass :meth:`wait_for_capacity` within the
+        block, e.g. while it consumes results whose reservations only it
+        can release. Waiting would never end then.
+        """
+        ident = threading.get_ident()
+        with self._cond:
+            self._exempt[ident] = self._exempt.get(ident, 0) + 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._exempt[ident] -= 1
+                if not self._exempt[ident]:
+                    del self._exempt[ident]
+
+    def get_stats(self):
+        return {"used": self.used, "peak": self.peak,
+                "max_bytes": self.max_bytes, "spilled": self.spilled}
+
+
+class BudgetedBuffer(object):
+    """
+    Binary buffer whose size is accounted in a :class:`MemoryBudget`. Once
+    a write does not fit into the budget any more, the content moves to a
+    temporary file. Closing the buffer releases its reservation.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.spilled = False
+        self._file = io.BytesIO()
+        self._reserved = 0
+
+    def write(self, data):
+        if not self.spilled:
+            if self.budget.try_reserve(len(data)):
+                self._reserved += len(data)
+                return self._file.write(data)
+            self._spill()
+        return self._file.write(data)
+
+    def _spill(self):
+        tmp = tempfile.TemporaryFile(dir=self.budget.spill_dir)
+        self._file.seek(0, 0)
+        shutil.copyfileobj(self._file, tmp)
+        self._file.close()
+        self._file = tmp
+        self.spilled = True
+        with self.budget._cond:
+            self.budget.spilled += 1
+        self._release()
+
+    def _release(self):
+        if self._reserved:
+            self.budget.release(self._reserved)
+            self._reserved = 0
+
+    def getvalue(self):
+        pos = self._file.tell()
+        self._file.seek(0, 0)
+        value = self._file.read()
+        self._file.seek(pos, 0)
+        return value
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+    def readinto(self, buffer):
+        return self._file.readinto(buffer)
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def fileno(self):
+        return self._file.fileno()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def close(self):
+        self._file.close()
+        self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
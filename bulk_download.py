@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Manifest driven bulk downloader for TAPS.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+Usage::
+
+    python bulk_download.py manifest.csv -o data -u user -p password -j 8
+
+The manifest is either a CSV file with the columns
+``network,station,location,channel,starttime,endtime`` or a JSON file
+holding a list of such objects. A JSON object with a ``stations`` key is
+expanded to all matching channels via the station service, e.g.::
+
+    [{"stations": {"network": "TW", "station": "NSE*", "channel": "EH?"},
+      "starttime": "2008-04-16", "endtime": "2008-04-18"}]
+
+Every channel is downloaded in day chunks to
+``<outdir>/<net>/<sta>/<net>.<sta>.<loc>.<cha>.<year>.<julday>.mseed``.
+Chunks not covering a whole day get the time of day of their start and end
+appended (e.g. ``....2008.107.120000-180000.mseed``), so several windows of
+one day never replace each other. Finished chunks are recorded in a state
+file, re-running the same command skips them.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from client import Client
+from header import FDSNNoDataException
+from mseed_index import MSeedIndex
+
+MANIFEST_FIELDS = ("network", "station", "location", "channel", "starttime",
+                   "endtime")
+
+DEFAULT_STATE_FILENAME = ".taps_download_state"
+
+
+class DownloadItem(object):
+    """
+    A single channel/day chunk of a bulk download.
+    """
+    __slots__ = ("network", "station", "location", "channel", "starttime",
+                 "endtime")
+
+    def __init__(self, network, station, location, channel, starttime,
+                 endtime):
+        self.network = network
+        self.station = station
+        self.location = location or ""
+        self.channel = channel
+        self.starttime = starttime
+        self.endtime = endtime
+
+    @property
+    def seed_id(self):
+        return ".".join((self.network, self.station, self.location,
+                         self.channel))
+
+    @property
+    def key(self):
+        """
+        Key identifying the item in the state file.
+        """
+        return "%s|%s|%s" % (self.seed_id, self.starttime, self.endtime)
+
+    def filename(self, outdir):
+        """
+        File of the item below ``outdir``, the day file if the item covers
+        the whole day.
+        """
+        from obspy import UTCDateTime
+        day = UTCDateTime(self.starttime.year, self.starttime.month,
+                          self.starttime.day)
+        name = "%s.%04d.%03d" % (self.seed_id, self.starttime.year,
+                                 self.starttime.julday)
+        if self.starttime != day or self.endtime != day + 86400:
+            name += ".%s-%s" % (_time_of_day(self.starttime - day),
+                                _time_of_day(self.endtime - day))
+        return os.path.join(outdir, self.network, self.station,
+                            name + ".mseed")
+
+    def __repr__(self):
+        return "DownloadItem(%s)" % self.key
+
+
+def _time_of_day(seconds):
+    # HHMMSS (the end of the day is 240000), with microseconds if needed.
+    microseconds = int(round(seconds * 1e6))
+    seconds, microseconds = divmod(microseconds, 1000000)
+    text = "%02d%02d%02d" % (seconds // 3600, seconds // 60 % 60,
+                             seconds % 60)
+    if microseconds:
+        text += ".%06d" % microseconds
+    return text
+
+
+def split_by_day(network, station, location, channel, starttime, endtime):
+    """
+    Split a time window of a channel into items that do not cross midnight.
+    >>> from obspy import UTCDateTime
+    >>> items = split_by_day("TW", "NSE01", "", "EHZ",
+    ...                      UTCDateTime(2008, 4, 16, 12),
+    ...                      UTCDateTime(2008, 4, 17, 6))
+    >>> for item in items:
+    ...     print(item.key)
+    TW.NSE01..EHZ|2008-04-16T12:00:00.000000Z|2008-04-17T00:00:00.000000Z
+    TW.NSE01..EHZ|2008-04-17T00:00:00.000000Z|2008-04-17T06:00:00.000000Z
+    """
+    from obspy import UTCDateTime
+    starttime = UTCDateTime(starttime)
+    endtime = UTCDateTime(endtime)
+    items = []
+    t = starttime
+    while t < endtime:
+        midnight = UTCDateTime(t.year, t.month, t.day) + 86400
+        t_end = min(midnight, endtime)
+        items.append(DownloadItem(network, station, location, channel, t,
+                                  t_end))
+        t = t_end
+    return items
+
+
+def read_manifest(filename, client=None):
+    """
+    Read a CSV or JSON manifest and return the list of
+    :class:`DownloadItem` objects it describes.
+    :type filename: str
+    :param filename: Manifest file, ``.json`` files are parsed as JSON,
+        everything else as CSV.
+    :type client: :class:`~client.Client`
+    :param client: Client used to expand station queries. Only needed if
+        the manifest contains entries with a ``stations`` key.
+    """
+    if filename.lower().endswith(".json"):
+        with open(filename, "r") as fh:
+            entries = json.load(fh)
+        if isinstance(entries, dict):
+            entries = [entries]
+    else:
+        with open(filename, "r", newline="") as fh:
+            entries = [row for row in csv.DictReader(
+                (line for line in fh if not line.startswith("#")))]
+
+    items = []
+    for entry in entries:
+        if "stations" in entry:
+            if client is None:
+                msg = "A client is required to expand station queries."
+                raise ValueError(msg)
+            channels = expand_station_query(
+                client, entry["stations"], entry["starttime"],
+                entry["endtime"])
+        else:
+            missing = [key for key in MANIFEST_FIELDS if key not in entry]
+            if missing:
+                msg = "Manifest entry %s lacks the field(s): %s" % (
+                    entry, ", ".join(missing))
+                raise ValueError(msg)
+            channels = [tuple(entry[key] or "" for key in MANIFEST_FIELDS)]
+        for net, sta, loc, cha, start, end in channels:
+            items.extend(split_by_day(net.strip(), sta.strip(), loc.strip(),
+                                      cha.strip(), start, end))
+    return items
+
+
+def expand_station_query(client, query, starttime, endtime):
+    """
+    Resolve a station service query to the individual channels that are
+    active in the given time range.
+    """
+    from obspy import UTCDateTime
+    starttime = UTCDateTime(starttime)
+    endtime = UTCDateTime(endtime)
+    kwargs = dict(query)
+    kwargs["level"] = "channel"
+    inv = client.get_stations(starttime=starttime, endtime=endtime, **kwargs)
+    channels = []
+    for net in inv:
+        for sta in net:
+            for cha in sta:
+                start = max(starttime, cha.start_date or starttime)
+                end = min(endtime, cha.end_date or endtime)
+                if start >= end:
+                    continue
+                channels.append((net.code, sta.code, cha.location_code,
+                                 cha.code, start, end))
+    return channels
+
+
+class DownloadState(object):
+    """
+    Append-only record of finished items, one JSON object per line.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.done = {}
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename, "r") as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Truncated last line of an interrupted run.
+                        continue
+                    self.done[record["key"]] = record
+
+    def __contains__(self, item):
+        return item.key in self.done
+
+    def mark(self, item, status, nbytes=0):
+        record = {"key": item.key, "status": status, "bytes": nbytes}
+        with self._lock:
+            self.done[item.key] = record
+            with open(self.filename, "a") as fh:
+                fh.write(json.dumps(record) + "\n")
+
+
+class Progress(object):
+    """
+    Throughput and ETA reporting for the bulk downloader.
+    """
+    def __init__(self, total, stream=sys.stderr, interval=1.0):
+        self.total = total
+        self.stream = stream
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.nbytes = 0
+        self._start = time.time()
+        self._last_print = 0.0
+        self._lock = threading.Lock()
+
+    def update(self, nbytes=0, failed=False):
+        with self._lock:
+            self.done += 1
+            self.nbytes += nbytes
+            if failed:
+                self.failed += 1
+            now = time.time()
+            if now - self._last_print >= self.interval or \
+                    self.done == self.total:
+                self._last_print = now
+                self.stream.write("\r" + self.format(now))
+                if self.done == self.total:
+                    self.stream.write("\n")
+                self.stream.flush()
+
+    def format(self, now=None):
+        elapsed = max((now or time.time()) - self._start, 1e-6)
+        rate = self.nbytes / elapsed
+        if self.done:
+            eta = elapsed / self.done * (self.total - self.done)
+        else:
+            eta = 0
+        percent = 100.0 * self.done / self.total if self.total else 100.0
+        return "[%d/%d] %5.1f%% %8.2f MB/s, %d failed, ETA %s" % (
+            self.done, self.total, percent, rate / 1e6, self.failed,
+            time.strftime("%H:%M:%S", time.gmtime(eta)))
+
+
+class BulkDownloader(object):
+    """
+    Downloads a list of :class:`DownloadItem` objects with a pool of worker
+    threads sharing one :class:`~client.Client`.
+    :type client: :class:`~client.Client`
+    :param client: The client used for all requests.
+    :type outdir: str
+    :param outdir: Root directory of the downloaded files.
+    :type state_file: str
+    :param state_file: File recording finished items. Defaults to a hidden
+        file in ``outdir``.
+    :type workers: int or str
+    :param workers: Number of concurrent requests, ``"auto"`` lets the
+        adaptive concurrency limit of the client decide.
+    """
+    def __init__(self, client, outdir, state_file=None, workers=4,
+                 progress=True):
+        self.client = client
+        self.outdir = outdir
+        if state_file is None:
+            state_file = os.path.join(outdir, DEFAULT_STATE_FILENAME)
+        self.workers = workers
+        self.progress = progress
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        self.state = DownloadState(state_file)
+
+    def download(self, items):
+        """
+        Download all items not yet recorded in the state file.
+        Returns a dictionary mapping the keys of failed items to the
+        exception raised for them.
+        """
+        todo = [item for item in items if item not in self.state]
+        progress = Progress(len(todo)) if self.progress else None
+        failed = {}
+        if not todo:
+            return failed
+        workers = self.client._resolve_workers(self.workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict((executor.submit(self._download_item, item), item)
+                           for item in todo)
+            for future in as_completed(futures):
+                item = futures[future]
+                nbytes = 0
+                try:
+                    nbytes = future.result()
+                except Exception as e:
+                    failed[item.key] = e
+                if progress is not None:
+                    progress.update(nbytes, failed=item.key in failed)
+        return failed
+
+    def open_index(self):
+        """
+        :class:`~mseed_index.MSeedIndex` of the downloaded files, windows
+        are read from the memory mapped files without reading them whole.
+        >>> st = downloader.open_index().read(
+        ...     "TW.NSE01..EHZ", t + 3600, t + 3660)  # doctest: +SKIP
+        """
+        return MSeedIndex([self.outdir])
+
+    def _download_item(self, item):
+        filename = item.filename(self.outdir)
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        # The response is streamed to a temporary file (not buffered in
+        # memory) that is renamed when complete, so that an interrupted run
+        # never leaves a truncated file behind that looks finished.
+        tmp_filename = "%s.%d.part" % (filename, threading.get_ident())
+        try:
+            with open(tmp_filename, "wb") as fh:
+                self.client.get_waveforms(
+                    item.network, item.station, item.location, item.channel,
+                    item.starttime, item.endtime, filename=fh,
+                    priority="batch")
+                nbytes = fh.tell()
+        except FDSNNoDataException:
+            os.remove(tmp_filename)
+            self.state.mark(item, "nodata")
+            return 0
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+        os.replace(tmp_filename, filename)
+        self.state.mark(item, "ok", nbytes)
+        return nbytes
+
+def _workers(value):
+    if value == "auto":
+        return value
+    return int(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Download waveforms listed in a manifest from TAPS.")
+    parser.add_argument("manifest", help="CSV or JSON manifest file.")
+    parser.add_argument("-o", "--outdir", default=".",
+                        help="Output directory (default: %(default)s).")
+    parser.add_argument("-b", "--base-url", default="TAPS",
+                        help="FDSN base URL or key (default: %(default)s).")
+    parser.add_argument("-u", "--user", help="TAPS user name.")
+    parser.add_argument("-p", "--password", help="TAPS password.")
+    parser.add_argument("-j", "--workers", type=_workers, default=4,
+                        help="Concurrent downloads or 'auto' to adapt them "
+                             "to throughput and throttling "
+                             "(default: %(default)s).")
+    parser.add_argument("-s", "--state-file",
+                        help="State file recording finished items (default: "
+                             "%s in the output directory)." %
+                             DEFAULT_STATE_FILENAME)
+    parser.add_argument("-t", "--timeout", type=float, default=120,
+                        help="Request timeout in seconds "
+                             "(default: %(default)s).")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="Do not show progress.")
+    args = parser.parse_args(argv)
+
+    client = Client(args.base_url, user=args.user, password=args.password,
+                    timeout=args.timeout,
+                    concurrency=args.workers == "auto")
+    items = read_manifest(args.manifest, client=client)
+    downloader = BulkDownloader(client, args.outdir,
+                                state_file=args.state_file,
+                                workers=args.workers,
+                                progress=not args.quiet)
+    failed = downloader.download(items)
+    for key, e in sorted(failed.items()):
+        msg = str(e).splitlines()[0] if str(e) else e.__class__.__name__
+        sys.stderr.write("Failed: %s (%s)\n" % (key, msg))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
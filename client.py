@@ -5,30 +5,28 @@ FDSN Web service client for TAPS.
 :copyright:
     The TAPS Development Team (dmc@earth.sinica.edu.tw)
 """
+import contextlib
 import copy
-import gzip
 import io
 import os
 import re
+import shutil
 from socket import timeout as socket_timeout
 import textwrap
 import threading
+import time
 import warnings
 from collections import OrderedDict
 from urllib.parse import urlparse
 
-from lxml import etree
+# ObsPy (and with it NumPy, SciPy, lxml) is only imported when data is
+# actually decoded, constructing a client must stay cheap.
 
-import obspy
-from obspy import UTCDateTime, read_inventory
-from obspy.core.compatibility import collections_abc
-
-from header import (DEFAULT_PARAMETERS, DEFAULT_USER_AGENT, FDSNWS,
-                     OPTIONAL_PARAMETERS, PARAMETER_ALIASES,
-                     URL_DEFAULT_SUBPATH, URL_MAPPINGS,
-                     WADL_PARAMETERS_NOT_TO_BE_PARSED, DEFAULT_SERVICES,
+from header import (DEFAULT_PARAMETERS, get_default_user_agent, FDSNWS,
+                     OPTIONAL_PARAMETERS, PARAMETER_ALIASES, DEFAULT_SERVICES,
+                     URL_DEFAULT_SUBPATH, URL_MAJOR_VERSIONS, URL_MAPPINGS,
                      FDSNException, FDSNRedirectException, FDSNNoDataException,
-                     FDSNTimeoutException,
+                     FDSNTimeoutException, FDSNDeadlineExceededException,
                      FDSNNoAuthenticationServiceException,
                      FDSNBadRequestException, FDSNNoServiceException,
                      FDSNInternalServerException, FDSNTooManyRequestsException,
@@ -38,6 +36,22 @@ from header import (DEFAULT_PARAMETERS, DEFAULT_USER_AGENT, FDSNWS,
                      FDSNForbiddenException,
                      FDSNDoubleAuthenticationException,
                      FDSNInvalidRequestException)
+from instrumentation import (Instrumentation, RequestTiming,
+                             TimingHTTPHandler, TimingHTTPSHandler)
+from token_cache import FileTokenCache, is_expired
+from query import Query
+from budget import CHUNK_SIZE, BudgetedBuffer, MemoryBudget
+from planner import (DEFAULT_MAX_ITEMS, WaveformRequest, demultiplex,
+                     plan_waveform_requests)
+from endpoints import FAILOVER_CODES, EndpointPool
+from ratelimit import RateLimiter
+from version_cache import VersionCache, get_version_cache
+from response_cache import ResponseCache, attach_responses
+from coverage import Coverage, read_table
+from concurrency import (THROTTLE_CODES, THROTTLE_RETRIES,
+                         AdaptiveConcurrency)
+from scheduler import DEFAULT_PRIORITY, PriorityScheduler, deadline_after
+from merge import merge_traces
 
 # from .wadl_parser import WADLParser
 
@@ -49,6 +63,13 @@ import json
 
 DEFAULT_SERVICE_VERSIONS = {'dataselect': 0, 'station': 0}
 
+# Worker threads for workers="auto" without an adaptive concurrency limit.
+DEFAULT_AUTO_WORKERS = 4
+
+# Requests in flight served by the hedging threads without an adaptive
+# concurrency limit (two threads per request, primary and duplicate).
+DEFAULT_HEDGE_REQUESTS = 32
+
 class Client(object):
     """
     FDSN Web service request client.
@@ -85,9 +106,12 @@ class Client(object):
             return False
 
     def __init__(self, base_url="TAPS", major_versions=None, user=None,
-                 password=None, user_agent=DEFAULT_USER_AGENT, debug=False,
+                 password=None, user_agent=None, debug=False,
                  timeout=120, service_mappings=None, jwt_access_token=None,
-                 jwt_refresh_token=None):
+                 jwt_refresh_token=None, instrumentation=None,
+                 token_cache=None, memory_budget=None, mirrors=None,
+                 hedge_after=None, rate_limit=None, version_cache=None,
+                 response_cache=None, concurrency=None, scheduler=None):
         """
         Initializes an FDSN Web Service client.
         >>> client = Client("TAPS")
@@ -106,7 +130,9 @@ class Client(object):
         :param major_versions: Allows to specify custom major version numbers
             for individual services (e.g.
             `major_versions={'station': 2, 'dataselect': 3}`), otherwise the
-            latest version at time of implementation will be used.
+            version served by a known data center (see
+            :data:`~header.URL_MAJOR_VERSIONS`) or the TAPS version (0) for
+            other URLs will be used.
         :type user: str
         :param user: User name of JSON Web Tokens Authentication for access to
             restricted data.
@@ -114,25 +140,118 @@ class Client(object):
         :param password: Password of JSON Web Tokens Authentication for access to
             restricted data.
         :type user_agent: str
-        :param user_agent: The user agent for all requests.
+        :param user_agent: The user agent for all requests. Defaults to
+            :func:`~header.get_default_user_agent`.
         :type debug: bool
         :param debug: Debug flag.
         :type timeout: float
         :param timeout: Maximum time (in seconds) to wait for a single request
             to receive the first byte of the response (after which an exception
             is raised).
+        :type instrumentation: :class:`~instrumentation.Instrumentation`
+        :param instrumentation: Receives timing events of all requests,
+            token operations and decode steps. A new one is created if not
+            given, it is available as ``client.instrumentation``.
+        :type token_cache: :class:`~token_cache.FileTokenCache` or str
+        :param token_cache: Token cache (or path of its file) shared with
+            other processes. Clients using the same cache share one token
+            pair per server and user, only one of them logs in or refreshes
+            at a time.
+        :type memory_budget: :class:`~budget.MemoryBudget` or int
+        :param memory_budget: Limit (or number of bytes) of response data
+            held in memory across concurrent requests. New requests wait
+            while the budget is exhausted, responses that do not fit are
+            spilled to temporary files.
+        :type mirrors: list of str
+        :param mirrors: Base URLs of servers equivalent to ``base_url``.
+            Requests go to the healthiest of them (by recent latency and
+            error rate) and fail over to the others on connection errors,
+            HTTP 429 and 5xx. Values of ``service_mappings`` may also be
+            lists of equivalent URLs.
+        :type hedge_after: float
+        :param hedge_after: Latency percentile (e.g. ``95``) of the chosen
+            endpoint after which a duplicate request is sent to the next
+            endpoint, the first response wins. Needs at least two endpoints,
+            disabled by default.
+        :type rate_limit: float or :class:`~ratelimit.RateLimiter`
+        :param rate_limit: Maximum number of requests per second sent by
+            this client (across all threads).
+        :type version_cache: :class:`~version_cache.VersionCache` or str
+        :param version_cache: Cache of the service versions (or path of its
+            file to share versions across processes). Defaults to the in
+            memory cache shared by all clients of the process.
+        :type response_cache: :class:`~response_cache.ResponseCache`, int
+            or str
+        :param response_cache: Cache of the deconvolution filters used by
+            :meth:`remove_response` (or its size, or the directory it is
+            persisted in).
+        :type concurrency: :class:`~concurrency.AdaptiveConcurrency` or
+            bool
+        :param concurrency: Adaptive limit of the requests in flight
+            (``True`` for the defaults). Batch and bulk downloads with
+            ``workers="auto"`` then start ``maximum`` threads and let the
+            limiter decide how many of them send requests.
+        :type scheduler: :class:`~scheduler.PriorityScheduler` or bool
+        :param scheduler: Hands out the request slots by priority class
+            (``True`` for the defaults), see the ``priority`` and
+            ``deadline`` arguments of the query methods. Follows the
+            adaptive concurrency limit if there is one.
         """
         self.debug = debug
+        self.hedge_after = hedge_after
         self.user = user
         self.timeout = timeout
-
-        # Cache for the webservice versions. This makes interactive use of
-        # the client more convenient.
-        self.__version_cache = {}
-
+        if instrumentation is None:
+            instrumentation = Instrumentation()
+        self.instrumentation = instrumentation
+        if isinstance(token_cache, str):
+            token_cache = FileTokenCache(token_cache)
+        self.token_cache = token_cache
+        if isinstance(memory_budget, int):
+            memory_budget = MemoryBudget(memory_budget)
+        self.memory_budget = memory_budget
+        self.rate_limiter = None
+        if rate_limit is not None:
+            self.set_rate_limit(rate_limit)
+
+        # Cache for the webservice versions, shared with the other clients
+        # of the process. This makes interactive use of the client more
+        # convenient.
+        if not isinstance(version_cache, VersionCache):
+            version_cache = get_version_cache(version_cache)
+        self.version_cache = version_cache
+        if isinstance(response_cache, int):
+            response_cache = ResponseCache(maxsize=response_cache)
+        elif isinstance(response_cache, str):
+            response_cache = ResponseCache(path=response_cache)
+        elif response_cache is None:
+            response_cache = ResponseCache()
+        self.response_cache = response_cache
+        if concurrency is True:
+            concurrency = AdaptiveConcurrency()
+        self.concurrency = concurrency or None
+        if scheduler is True:
+            scheduler = PriorityScheduler()
+        if scheduler and scheduler.capacity is None and \
+                self.concurrency is not None:
+            scheduler.capacity = self.concurrency
+        self.scheduler = scheduler or None
+
+        if mirrors is None:
+            mirrors = []
+        # Service versions of a known data center, other URLs are assumed
+        # to be TAPS compatible.
+        service_versions = DEFAULT_SERVICE_VERSIONS
         if base_url.upper() in URL_MAPPINGS:
             url_mapping = base_url.upper()
+            service_versions = dict.fromkeys(
+                DEFAULT_SERVICE_VERSIONS,
+                URL_MAJOR_VERSIONS.get(url_mapping, 1))
             base_url = URL_MAPPINGS[url_mapping]
+            if not isinstance(base_url, str):
+                # The first URL of a mapping is the primary server.
+                base_url, mirrors = base_url[0], list(base_url[1:]) + \
+                    list(mirrors)
             url_subpath = URL_DEFAULT_SUBPATH
         else:
             if base_url.isalpha():
@@ -143,32 +262,57 @@ class Client(object):
 
         # Make sure the base_url does not end with a slash.
         base_url = base_url.strip("/")
+        mirrors = [url.strip("/") for url in mirrors]
         # Catch invalid URLs to avoid confusing error messages
-        if not self._validate_base_url(base_url):
-            msg = "The FDSN service base URL `{}` is not a valid URL."\
-                  .format(base_url)
-            raise ValueError(msg)
+        for url in [base_url] + mirrors:
+            if not self._validate_base_url(url):
+                msg = "The FDSN service base URL `{}` is not a valid URL."\
+                      .format(url)
+                raise ValueError(msg)
 
         self.base_url = base_url
         self.url_subpath = url_subpath
 
-        self._set_opener(user, password)
+        # Set before the opener, logging in with user and password replaces
+        # the given tokens.
+        self.jwt_access_token = jwt_access_token
+        self.jwt_refresh_token = jwt_refresh_token
 
+        if user_agent is None:
+            user_agent = get_default_user_agent()
         self.request_headers = {"User-Agent": user_agent}
         # Avoid mutable kwarg.
         if major_versions is None:
             major_versions = {}
         # Make a copy to avoid overwriting the default service versions.
-        self.major_versions = DEFAULT_SERVICE_VERSIONS.copy()
+        self.major_versions = service_versions.copy()
         self.major_versions.update(major_versions)
 
         # Avoid mutable kwarg.
         if service_mappings is None:
             service_mappings = {}
-        self._service_mappings = service_mappings
+        # Every set of equivalent URLs gets a pool tracking their health,
+        # URLs are built with the first (primary) one.
+        self._endpoint_pools = []
+        if mirrors:
+            self._endpoint_pools.append(EndpointPool([base_url] + mirrors))
+        self._service_mappings = {}
+        for service, urls in service_mappings.items():
+            if not isinstance(urls, str):
+                urls = [url.rstrip("/") for url in urls]
+                if len(urls) > 1:
+                    self._endpoint_pools.append(EndpointPool(urls))
+                urls = urls[0]
+            self._service_mappings[service] = urls
+        self._init_hedging()
+        # After the endpoint pools, logging in fails over to the mirrors.
+        self._set_opener(user, password)
 
         if self.debug is True:
             print("Base URL: %s" % self.base_url)
+            for pool in self._endpoint_pools:
+                print("Equivalent endpoints: %s" % ", ".join(
+                    endpoint.url for endpoint in pool.endpoints))
             if self._service_mappings:
                 print("Custom service mappings:")
                 for key, value in self._service_mappings.items():
@@ -177,9 +321,6 @@ class Client(object):
 
         self.services = DEFAULT_SERVICES
 
-        self.jwt_access_token = jwt_access_token
-        self.jwt_refresh_token = jwt_refresh_token
-
     def set_credentials(self, user, password):
         """
         Set user and password resulting in subsequent web service
@@ -194,45 +335,151 @@ class Client(object):
         self.user = user
         self._set_opener(user, password)
 
+    def set_rate_limit(self, rate_limit):
+        """
+        Limit the requests per second sent by this client, ``None``
+        removes the limit.
+        :type rate_limit: float or :class:`~ratelimit.RateLimiter`
+        :param rate_limit: Requests per second or a (shared) rate limiter.
+        """
+        if rate_limit is not None and not isinstance(rate_limit,
+                                                     RateLimiter):
+            rate_limit = RateLimiter(rate_limit)
+        self.rate_limiter = rate_limit
+
+    def __getstate__(self):
+        # The opener and the instrumentation (callbacks, locks) are local to
+        # a process, everything else including the tokens is carried over.
+        state = self.__dict__.copy()
+        del state["_url_opener"]
+        del state["instrumentation"]
+        del state["_hedge_executor"]
+        del state["_hedge_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.instrumentation = Instrumentation()
+        self._build_opener()
+        self._init_hedging()
+
+    def _init_hedging(self):
+        # Threads of the executor are only started on first use.
+        self._hedge_lock = threading.Lock()
+        self._hedge_executor = None
+        if self.hedge_after is not None:
+            self._get_hedge_executor()
+
+    def _get_hedge_executor(self):
+        """
+        Executor of hedged requests, sized for two threads per request the
+        client may have in flight (the adaptive concurrency maximum) so
+        that requests do not queue behind each other.
+        """
+        import concurrent.futures
+        with self._hedge_lock:
+            if self._hedge_executor is None:
+                requests = DEFAULT_HEDGE_REQUESTS
+                if self.concurrency is not None:
+                    requests = self.concurrency.maximum
+                self._hedge_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=2 * requests, thread_name_prefix="hedge")
+            return self._hedge_executor
+
     def _set_opener(self, user, password):
-        # Only add the authentication handler if required.
-        handlers = []
+        self._build_opener()
+
         if user is not None and password is not None:
             # Create a token for Json Web Token Authentication
             self._retrieve_jwt_token(user, password)
 
+    def _build_opener(self):
+        # The timing handlers fill in the connection breakdown of every
+        # request sent through the opener.
+        handlers = [TimingHTTPHandler(), TimingHTTPSHandler()]
+
         # Don't install globally to not mess with other codes.
         self._url_opener = urllib_request.build_opener(*handlers)
         if self.debug:
             print('Installed new opener with handlers: {!s}'.format(handlers))
 
+    def _token_cache_key(self):
+        return "{}|{}".format(urlparse(self.base_url).netloc, self.user)
+
+    def _open_token_url(self, path, data, operation):
+        """
+        POST a JSON payload to one of the token endpoints and return the
+        decoded JSON answer. With mirrors, the token endpoint of the next
+        (best ranked) server is tried if a server cannot be reached.
+        """
+        pool, _ = self._find_endpoint_pool(self.base_url + "/")
+        endpoints = pool.ranked() if pool is not None else [None]
+        headers = {"Content-Type": "application/json"}
+        for i, endpoint in enumerate(endpoints):
+            base_url = self.base_url if endpoint is None else endpoint.url
+            # force https so that we don't send around tokens unsecurely
+            url = 'https://{}{}'.format(urlparse(base_url).netloc, path)
+            # paranoid: check again that we only send the token to https
+            if urlparse(url).scheme != "https":
+                msg = 'This should not happen, please file a bug report.'
+                raise Exception(msg)
+            html = urllib_request.Request(url, data=data, headers=headers)
+            try:
+                with self.instrumentation.timer("token",
+                                                operation=operation):
+                    result = self._url_opener.open(
+                        html, timeout=self.timeout).read().decode("utf-8")
+            except urllib_error.HTTPError:
+                # The server answered, another one would not answer
+                # differently.
+                raise
+            except (urllib_error.URLError, socket_timeout) as e:
+                if endpoint is None:
+                    raise
+                pool.record(endpoint, None, ok=False)
+                if i == len(endpoints) - 1:
+                    raise
+                if self.debug is True:
+                    print("Failing over from %s (%s)" % (url, e))
+                continue
+            return json.loads(result)
+
     def _retrieve_jwt_token(self, user, password):
         """
         Fetch token from the server using the provided user, password
         resulting in subsequent web service requests for waveforms being
         authenticated for potential access to restricted data.
+        With a token cache, a still valid token pair of another process is
+        used instead.
         :type user: str
         :param user: User name of credentials.
         :type password: str
         :param password: Password for given user name.
         """
-        # force https so that we don't send around tokens unsecurely
-        url = 'https://{}/api/token'.format(urlparse(self.base_url).netloc)
-        
-        # paranoid: check again that we only send the token to https
-        if urlparse(url).scheme != "https":
-            msg = 'This should not happen, please file a bug report.'
-            raise Exception(msg)
+        if self.token_cache is None:
+            self._request_jwt_token(user, password)
+            return
 
+        key = self._token_cache_key()
+        with self.token_cache.lock():
+            entry = self.token_cache.load(key)
+            if entry and not is_expired(entry["refresh"]):
+                self.jwt_access_token = entry["access"]
+                self.jwt_refresh_token = entry["refresh"]
+                if self.debug:
+                    print('Using cached access/refresh token of {}'.format(
+                        key))
+                return
+            self._request_jwt_token(user, password)
+            self.token_cache.store(key, self.jwt_access_token,
+                                   self.jwt_refresh_token)
+
+    def _request_jwt_token(self, user, password):
         # convert to json
         data = json.dumps({"username": user, "password": password})
         # encode
         data = bytes(data, "utf-8")
-        headers = {"Content-Type": "application/json"}
-        html = urllib_request.Request(url, data=data, headers=headers)
-        # decode('utf-8')
-        result = urllib_request.urlopen(html).read().decode("utf-8")
-        dic = json.loads(result)
+        dic = self._open_token_url("/api/token", data, "retrieve")
         # get token
         self.jwt_access_token = dic['access']
         self.jwt_refresh_token = dic['refresh']
@@ -246,14 +493,6 @@ class Client(object):
         """
         A check if the jwt token is valid
         """
-        # force https so that we don't send around tokens unsecurely
-        url = 'https://{}/api/token/verify'.format(urlparse(self.base_url).netloc)
-        
-        # paranoid: check again that we only send the token to https
-        if urlparse(url).scheme != "https":
-            msg = 'This should not happen, please file a bug report.'
-            raise Exception(msg)
-
         if not self.jwt_access_token:
             raise FDSNUnauthorizedException("Unauthorized, authentication "
                                         "required.", )
@@ -262,12 +501,9 @@ class Client(object):
         data = json.dumps({"token": self.jwt_access_token})
         # encode
         data = bytes(data, "utf-8")
-        headers = {"Content-Type": "application/json"}
-        html = urllib_request.Request(url, data=data, headers=headers)
-        # decode('utf-8')
         try:
-            result = urllib_request.urlopen(html).read().decode("utf-8")
-            dic = json.loads(result)
+            dic = self._open_token_url("/api/token/verify", data,
+                                       "verify")
             valid = not bool(dic)
             if self.debug:
                 print('Valid token : {}'.format(valid))
@@ -278,15 +514,28 @@ class Client(object):
     def _refresh_access_token(self):
         """
         Get access token from refresh token
+        With a token cache, an access token refreshed in the meantime by
+        another process is used instead.
         """
-        # force https so that we don't send around tokens unsecurely
-        url = 'https://{}/api/token/refresh'.format(urlparse(self.base_url).netloc)
-        
-        # paranoid: check again that we only send the token to https
-        if urlparse(url).scheme != "https":
-            msg = 'This should not happen, please file a bug report.'
-            raise Exception(msg)
+        if self.token_cache is None:
+            self._request_access_token()
+            return
 
+        key = self._token_cache_key()
+        with self.token_cache.lock():
+            entry = self.token_cache.load(key)
+            if entry and entry["access"] != self.jwt_access_token and \
+                    not is_expired(entry["access"]):
+                self.jwt_access_token = entry["access"]
+                self.jwt_refresh_token = entry["refresh"]
+                if self.debug:
+                    print('Using cached access token of {}'.format(key))
+                return
+            self._request_access_token()
+            self.token_cache.store(key, self.jwt_access_token,
+                                   self.jwt_refresh_token)
+
+    def _request_access_token(self):
         if not self.jwt_refresh_token:
             raise FDSNUnauthorizedException("Unauthorized, authentication "
                                         "required.", )
@@ -295,12 +544,9 @@ class Client(object):
         data = json.dumps({"refresh": self.jwt_refresh_token})
         # encode
         data = bytes(data, "utf-8")
-        headers = {"Content-Type": "application/json"}
-        html = urllib_request.Request(url, data=data, headers=headers)
-        # decode('utf-8')
         try:
-            result = urllib_request.urlopen(html).read().decode("utf-8")
-            dic = json.loads(result)
+            dic = self._open_token_url("/api/token/refresh", data,
+                                       "refresh")
             self.jwt_access_token = dic['access']
 
             if self.debug:
@@ -319,7 +565,7 @@ class Client(object):
                         minradius=None, maxradius=None, level=None,
                         includerestricted=None, includeavailability=None,
                         updatedafter=None, matchtimeseries=None, filename=None,
-                        format=None, **kwargs):
+                        format=None, priority=None, deadline=None, **kwargs):
 
         if "station" not in self.services:
             msg = "The current client does not have a station service."
@@ -329,25 +575,51 @@ class Client(object):
 
         setup_query_dict('station', locs, kwargs)
 
-        url = self._create_url_from_parameters(
-            "station", DEFAULT_PARAMETERS['station'], kwargs)
-        data_stream = self._download(url)
+        return self.get_stations_query(Query("station", **kwargs),
+                                       filename=filename, priority=priority,
+                                       deadline=deadline)
+
+    def get_stations_query(self, query, filename=None, priority=None,
+                           deadline=None):
+        """
+        Query the station service with a prepared
+        :class:`~query.Query`. Queries are validated on creation and can
+        be reused for any number of calls.
+        >>> query = Query("station", network="TW", station="NSE*",
+        ...               level="response")
+        >>> inv = client.get_stations_query(query)  # doctest: +SKIP
+        """
+        if query.service != "station":
+            msg = "Expected a station query, got a '%s' query." % \
+                query.service
+            raise ValueError(msg)
+        url = query.url(self._build_url("station", "query"))
+        data_stream = self._download(url, priority=priority,
+                                     deadline=deadline_after(deadline))
         data_stream.seek(0, 0)
         if filename:
             self._write_to_file_object(filename, data_stream)
             data_stream.close()
         else:
+            from obspy import read_inventory
             # This works with XML and StationXML data.
-            inventory = read_inventory(data_stream)
+            with self.instrumentation.timer(
+                    "decode", format="STATIONXML",
+                    nbytes=_stream_size(data_stream)):
+                inventory = read_inventory(data_stream)
             data_stream.close()
             return inventory
 
     def get_waveforms(self, network, station, location, channel, starttime,
                       endtime, quality=None, minimumlength=None,
                       longestonly=None, filename=None, attach_response=False,
-                      **kwargs):
+                      priority=None, deadline=None, **kwargs):
         """
         Query the dataselect service of the client.
+        With a scheduler, ``priority`` is the class the request is queued
+        in (e.g. ``"interactive"`` or ``"batch"``) and requests not sent
+        within ``deadline`` seconds are cancelled with a
+        :class:`~header.FDSNDeadlineExceededException`.
         """
         if "dataselect" not in self.services:
             msg = "The current client does not have a dataselect service."
@@ -356,31 +628,323 @@ class Client(object):
         locs = locals()
         setup_query_dict('dataselect', locs, kwargs)
 
-        # Special location handling. Convert empty strings to "--".
-        if "location" in kwargs and not kwargs["location"]:
-            kwargs["location"] = "--"
+        return self.get_waveforms_query(Query("dataselect", **kwargs),
+                                        filename=filename,
+                                        attach_response=attach_response,
+                                        priority=priority, deadline=deadline)
 
-        url = self._create_url_from_parameters(
-            "dataselect", DEFAULT_PARAMETERS['dataselect'], kwargs)
-        # Gzip not worth it for MiniSEED and most likely disabled for this
-        # route in any case.
-        if not self._validate_jwt_token():
-            self._refresh_access_token()
-        data_stream = self._download(url, use_gzip=False, use_jwt=self.jwt_access_token)
-        data_stream.seek(0, 0)
+    def get_waveforms_query(self, query, filename=None,
+                            attach_response=False, priority=None,
+                            deadline=None):
+        """
+        Query the dataselect service with a prepared
+        :class:`~query.Query`. Queries are validated on creation and can
+        be reused for any number of calls.
+        >>> query = Query("dataselect", network="TW", station="NSE01",
+        ...               location="", channel="EHZ", starttime=t,
+        ...               endtime=t + 60)
+        >>> st = client.get_waveforms_query(query)  # doctest: +SKIP
+        """
+        if query.service != "dataselect":
+            msg = "Expected a dataselect query, got a '%s' query." % \
+                query.service
+            raise ValueError(msg)
+        data_stream = self._download_waveforms(
+            query, priority=priority, deadline=deadline_after(deadline))
         if filename:
             self._write_to_file_object(filename, data_stream)
             data_stream.close()
         else:
-            st = obspy.read(data_stream, format="MSEED")
+            from obspy import read
+            with self.instrumentation.timer(
+                    "decode", format="MSEED",
+                    nbytes=_stream_size(data_stream)):
+                st = read(data_stream, format="MSEED")
             data_stream.close()
             if attach_response:
-                self._attach_responses(st)
+                self._attach_responses(st, priority=priority)
             self._attach_dataselect_url_to_stream(st)
-            st.trim(starttime, endtime)
+            from obspy import UTCDateTime
+            starttime = query.get("starttime")
+            endtime = query.get("endtime")
+            st.trim(UTCDateTime(starttime) if starttime else None,
+                    UTCDateTime(endtime) if endtime else None)
             return st
 
-    def _attach_responses(self, st):
+    def _download_waveforms(self, query, priority=None, deadline=None):
+        """
+        Send a dataselect query, returns the undecoded MiniSEED stream.
+        ``deadline`` is absolute, see :func:`~scheduler.deadline_after`.
+        """
+        url = query.url(self._build_url("dataselect", "query"))
+        # Gzip not worth it for MiniSEED and most likely disabled for this
+        # route in any case.
+        # Only servers with token authentication (like TAPS) get a token,
+        # other FDSN data centers are queried anonymously.
+        if self.jwt_access_token or self.user is not None:
+            if not self._validate_jwt_token():
+                self._refresh_access_token()
+        data_stream = self._download(url, use_gzip=False,
+                                     use_jwt=self.jwt_access_token,
+                                     priority=priority, deadline=deadline)
+        data_stream.seek(0, 0)
+        return data_stream
+
+    def get_coverage(self, network, station, location, channel, starttime,
+                     endtime, tolerance=0.5, priority=None, deadline=None,
+                     **kwargs):
+        """
+        Coverage report (intervals, gaps, overlaps and sample totals per
+        channel) of the data available for a dataselect query. Only the
+        MiniSEED record headers are parsed, no sample is decoded. Arguments
+        as for :meth:`get_waveforms`.
+        >>> cov = client.get_coverage("TW", "NSE*", "--", "EHZ", t,
+        ...                           t + 86400)  # doctest: +SKIP
+        >>> print(cov)  # doctest: +SKIP
+        :rtype: :class:`~coverage.Coverage`
+        """
+        query = Query("dataselect", network=network, station=station,
+                      location=location, channel=channel,
+                      starttime=starttime, endtime=endtime, **kwargs)
+        data_stream = self._download_waveforms(
+            query, priority=priority, deadline=deadline_after(deadline))
+        with self.instrumentation.timer(
+                "decode", format="MSEED_HEADERS",
+                nbytes=_stream_size(data_stream)):
+            table = read_table(data_stream)
+        data_stream.close()
+        return Coverage(table, starttime=query.get("starttime"),
+                        endtime=query.get("endtime"), tolerance=tolerance)
+
+    def export_waveforms(self, path, network, station, location, channel,
+                         starttime, endtime, chunk_duration=3600, workers=4,
+                         **kwargs):
+        """
+        Stream waveforms into a chunked ``channel x time`` array store
+        (Zarr format 2 directory) with channel metadata of the station
+        service, see :func:`~export.export_waveforms` for the options.
+        Sub-windows are read back with
+        :meth:`~export.ArrayStore.read` without decoding MiniSEED again.
+        >>> store = client.export_waveforms(
+        ...     "nse.zarr", "TW", "NSE*", "--", "EH?", t, t + 86400,
+        ...     compression=None)  # doctest: +SKIP
+        >>> data = store.read("TW.NSE01..EHZ", t + 60,
+        ...                   t + 120)  # doctest: +SKIP
+        :rtype: :class:`~export.ArrayStore`
+        """
+        from export import export_waveforms
+        with self.instrumentation.timer("export", path=path):
+            return export_waveforms(
+                self, path, network, station, location, channel, starttime,
+                endtime, chunk_duration=chunk_duration, workers=workers,
+                **kwargs)
+
+    def get_waveforms_batch(self, requests, attach_response=False,
+                            max_items=DEFAULT_MAX_ITEMS, workers=1,
+                            priority=None, deadline=None):
+        """
+        Query the dataselect service for many requests at once.
+        Requests sharing time window and network are coalesced into queries
+        with station, location and channel lists by
+        :func:`~planner.plan_waveform_requests`, the returned traces are
+        distributed back to the requests.
+        >>> reqs = [("TW", "NSE01", "--", "EHZ", t, t + 60),
+        ...         ("TW", "NSE01", "--", "EHN", t, t + 60)]
+        >>> streams = client.get_waveforms_batch(reqs)  # doctest: +SKIP
+        :type requests: list
+        :param requests: List of ``(network, station, location, channel,
+            starttime, endtime)`` tuples.
+        :type max_items: int
+        :param max_items: Maximum number of channels per query.
+        :type workers: int or str
+        :param workers: Number of queries sent concurrently, ``"auto"``
+            leaves it to the adaptive concurrency limit of the client.
+        :type priority: str
+        :param priority: Scheduler priority class of the queries.
+        :type deadline: float
+        :param deadline: Seconds within which all queries must have been
+            sent, see :meth:`get_waveforms`. Queries still queued when it
+            passes are cancelled, their requests get an empty stream and a
+            warning is issued, the other queries complete.
+        :rtype: list of :class:`~obspy.core.stream.Stream`
+        :returns: One stream per request, in the order of the requests.
+            Requests without data get an empty stream.
+        """
+        results = [None] * len(requests)
+        for i, st in self.iter_waveforms_batch(
+                requests, attach_response=attach_response,
+                max_items=max_items, workers=workers, priority=priority,
+                deadline=deadline):
+            results[i] = st
+        return results
+
+    def iter_waveforms_batch(self, requests, attach_response=False,
+                             max_items=DEFAULT_MAX_ITEMS, workers=1,
+                             priority=None, deadline=None):
+        """
+        Like :meth:`get_waveforms_batch` but yields ``(index, stream)``
+        pairs as soon as the query serving a request has finished.
+        With a memory budget, the decoded data of a query is accounted in
+        the budget until the caller asks for the next result, so workers
+        hold back new requests while results pile up unconsumed. Requests
+        the caller sends while handling a result are not held back (see
+        :meth:`~budget.MemoryBudget.exempt`), they would wait for
+        reservations only the caller can release.
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        from obspy import Stream
+        requests = [WaveformRequest(*req) for req in requests]
+        queries = plan_waveform_requests(requests, max_items=max_items)
+        if self.debug:
+            print("Planned %d queries for %d requests" % (
+                len(queries), len(requests)))
+        budget = self.memory_budget
+        workers = self._resolve_workers(workers)
+        deadline = deadline_after(deadline)
+        expired = []
+
+        def fetch(query):
+            try:
+                st = self.get_waveforms(
+                    query.network, query.station, query.location,
+                    query.channel, query.starttime, query.endtime,
+                    attach_response=attach_response, priority=priority,
+                    deadline=None if deadline is None else
+                    deadline - time.monotonic())
+            except FDSNNoDataException:
+                st = Stream()
+            except FDSNDeadlineExceededException:
+                # Only this query is given up, the others go on.
+                expired.append(query)
+                st = Stream()
+            nbytes = sum(tr.data.nbytes for tr in st)
+            if budget is not None:
+                budget.reserve(nbytes)
+            return st, nbytes
+
+        def release(nbytes):
+            if budget is not None:
+                budget.release(nbytes)
+
+        def exempt():
+            if budget is None:
+                return contextlib.nullcontext()
+            return budget.exempt()
+
+        if workers <= 1:
+            for query in queries:
+                st, nbytes = fetch(query)
+                try:
+                    with exempt():
+                        for item in sorted(demultiplex(st, query,
+                                                       requests).items()):
+                            yield item
+                finally:
+                    release(nbytes)
+            _warn_expired(expired, len(queries))
+            return
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        futures = dict((executor.submit(fetch, query), query)
+                       for query in queries)
+        consumed = set()
+        try:
+            for future in as_completed(futures):
+                consumed.add(future)
+                st, nbytes = future.result()
+                try:
+                    with exempt():
+                        for item in sorted(demultiplex(st, futures[future],
+                                                       requests).items()):
+                            yield item
+                finally:
+                    release(nbytes)
+            _warn_expired(expired, len(queries))
+        finally:
+            # The caller stopped early, drop queued queries and give back
+            # the reservations of results that were (or will be) never
+            # consumed. Not waiting here, running queries may be blocked
+            # on the budget until those reservations are released.
+            def release_unconsumed(future):
+                if not future.cancelled() and future.exception() is None:
+                    release(future.result()[1])
+
+            for future in futures:
+                if future not in consumed and not future.cancel():
+                    future.add_done_callback(release_unconsumed)
+            executor.shutdown(wait=False)
+
+    def get_waveforms_chunked(self, network, station, location, channel,
+                              starttime, endtime, chunk_duration=3600,
+                              workers=1, method="first", fill_value=None,
+                              attach_response=False, priority=None,
+                              deadline=None):
+        """
+        Download a long time window in chunks of ``chunk_duration`` seconds
+        (concurrently with ``workers``, see :meth:`get_waveforms_batch`)
+        and stitch them with :func:`~merge.merge_traces` into one trace
+        per channel.
+        >>> st = client.get_waveforms_chunked(
+        ...     "TW", "NSE01", "--", "EHZ", t, t + 86400, chunk_duration=60,
+        ...     workers=8, fill_value=0)  # doctest: +SKIP
+        :type method: str
+        :param method: Overlap resolution, ``"first"`` or ``"last"``.
+        :type fill_value: int, float, str or None
+        :param fill_value: Gap fill, see :func:`~merge.merge_traces`.
+        :rtype: :class:`~obspy.core.stream.Stream`
+        """
+        from obspy import UTCDateTime
+        starttime, endtime = UTCDateTime(starttime), UTCDateTime(endtime)
+        requests = []
+        t = starttime
+        while t < endtime:
+            t_end = min(t + chunk_duration, endtime)
+            requests.append((network, station, location, channel, t, t_end))
+            t = t_end
+        traces = [None] * len(requests)
+        for i, st in self.iter_waveforms_batch(
+                requests, attach_response=attach_response, workers=workers,
+                priority=priority, deadline=deadline):
+            traces[i] = st
+        # Chunks in time order, "first" and "last" refer to time then.
+        segments = [tr for st in traces if st is not None for tr in st]
+        if not segments:
+            raise FDSNNoDataException("No data available for request.")
+        with self.instrumentation.timer("merge", traces=len(segments)):
+            return merge_traces(segments, method=method,
+                                fill_value=fill_value)
+
+    def _resolve_workers(self, workers):
+        """
+        Number of worker threads for ``workers="auto"``: the upper bound of
+        the adaptive concurrency limit, which then throttles them.
+        """
+        if workers == "auto":
+            if self.concurrency is None:
+                return DEFAULT_AUTO_WORKERS
+            return self.concurrency.maximum
+        return workers
+
+    def get_stats(self):
+        """
+        Statistics of the client: aggregated request, token and decode
+        timings, the adaptive concurrency limit with its history, scheduler
+        queues, memory budget, mirror endpoint health and response cache
+        usage.
+        """
+        stats = {"events": self.instrumentation.get_stats()}
+        if self.concurrency is not None:
+            stats["concurrency"] = self.concurrency.get_stats()
+        if self.scheduler is not None:
+            stats["scheduler"] = self.scheduler.get_stats()
+        if self.memory_budget is not None:
+            stats["memory_budget"] = self.memory_budget.get_stats()
+        if self._endpoint_pools:
+            stats["endpoints"] = self.get_endpoint_stats()
+        stats["response_cache"] = self.response_cache.get_stats()
+        return stats
+
+    def _attach_responses(self, st, priority=None):
         """
         Helper method to fetch response via get_stations() and attach it to
         each trace in stream.
@@ -394,20 +958,44 @@ class Client(object):
                 min(tr.stats.starttime, netids[tr.id][0]),
                 max(tr.stats.endtime, netids[tr.id][1]))
 
-        inventories = []
-        for key, value in netids.items():
-            net, sta, loc, chan = key.split(".")
-            starttime, endtime = value
-            try:
-                inventories.append(self.get_stations(
-                    network=net, station=sta, location=loc, channel=chan,
-                    starttime=starttime, endtime=endtime, level="response"))
-            except Exception as e:
-                warnings.warn(str(e))
-        st.attach_response(inventories)
+        with self.instrumentation.timer("attach_responses",
+                                        channels=len(netids)):
+            inventories = []
+            for key, value in netids.items():
+                net, sta, loc, chan = key.split(".")
+                starttime, endtime = value
+                try:
+                    inventories.append(self.get_stations(
+                        network=net, station=sta, location=loc,
+                        channel=chan, starttime=starttime, endtime=endtime,
+                        level="response", priority=priority))
+                except Exception as e:
+                    warnings.warn(str(e))
+            attach_responses(st, inventories)
+
+    def remove_response(self, traces, inventory=None, **kwargs):
+        """
+        Remove the instrument response of many traces (e.g. short windows)
+        in place with the deconvolution filters cached in
+        :attr:`response_cache`, see
+        :meth:`~response_cache.ResponseCache.remove_response` for the
+        arguments. Without ``inventory`` the responses attached by
+        ``attach_response=True`` are used.
+        >>> st = client.get_waveforms("TW", "NSE01", "", "EHZ", t, t + 3600,
+        ...                           attach_response=True)  # doctest: +SKIP
+        >>> windows = [tr.slice(t + 60 * i, t + 60 * (i + 1))
+        ...            for i in range(60) for tr in st]  # doctest: +SKIP
+        >>> client.remove_response(windows, output="DISP")  # doctest: +SKIP
+        """
+        with self.instrumentation.timer("remove_response",
+                                        traces=len(traces)):
+            return self.response_cache.remove_response(
+                traces, inventory=inventory, **kwargs)
 
     def __str__(self):
-        versions = dict([(s, self._get_webservice_versionstring(s))
+        # Never block on the network, unknown versions show up as "?".
+        versions = dict([(s, self._get_webservice_versionstring(s,
+                                                               block=False))
                             for s in self.services if s in FDSNWS])
         services_string = ["'%s' (v%s)" % (s, versions[s])
                             for s in FDSNWS if s in self.services]
@@ -425,79 +1013,211 @@ class Client(object):
 
     def _write_to_file_object(self, filename_or_object, data_stream):
         if hasattr(filename_or_object, "write"):
-            filename_or_object.write(data_stream.read())
+            shutil.copyfileobj(data_stream, filename_or_object)
             return
         with open(filename_or_object, "wb") as fh:
-            fh.write(data_stream.read())
+            shutil.copyfileobj(data_stream, fh)
+
+    def _download(self, url, return_string=False, data=None, use_gzip=True,
+                  use_jwt=None, priority=None, deadline=None):
+        if self.memory_budget is not None:
+            # Backpressure: do not add more in-flight data to an exhausted
+            # budget.
+            self.memory_budget.wait_for_capacity()
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        kwargs = dict(return_string=return_string, data=data,
+                      use_gzip=use_gzip, use_jwt=use_jwt, priority=priority,
+                      deadline=deadline)
+        pool, path = self._find_endpoint_pool(url)
+        if pool is None:
+            code, data, _ = self._request(url, **kwargs)
+        else:
+            code, data = self._download_from_pool(pool, path, **kwargs)
+        raise_on_error(code, data)
+        return data
 
-    def _create_url_from_parameters(self, service, default_params, parameters):
+    def _request(self, url, retries=0, throttle_retries=THROTTLE_RETRIES,
+                 **kwargs):
         """
+        Send a request, emit its timing and return code, data and timing.
+        With adaptive concurrency, throttled requests are sent again after
+        the limit was cut (honouring ``Retry-After``, but not waiting past
+        the deadline), up to ``throttle_retries`` times.
         """
-        service_params = self.services[service]
-        # Get all required parameters and make sure they are available!
-        required_parameters = [
-            key for key, value in service_params.items()
-            if value["required"] is True]
-        for req_param in required_parameters:
-            if req_param not in parameters:
-                msg = "Parameter '%s' is required." % req_param
-                raise TypeError(msg)
-
-        final_parameter_set = {}
-
-        # Now loop over all parameters, convert them and make sure they are
-        # accepted by the service.
-        for key, value in parameters.items():
-            if key not in service_params:
-                # If it is not in the service but in the default parameters
-                # raise a warning.
-                if key in default_params:
-                    msg = ("The standard parameter '%s' is not supported by "
-                           "the webservice. It will be silently ignored." %
-                           key)
-                    warnings.warn(msg)
-                    continue
-                elif key in WADL_PARAMETERS_NOT_TO_BE_PARSED:
-                    msg = ("The parameter '%s' is ignored because it is not "
-                           "useful within ObsPy")
-                    warnings.warn(msg % key)
-                    continue
-                # Otherwise raise an error.
-                else:
-                    msg = \
-                        "The parameter '%s' is not supported by the service." \
-                        % key
-                    raise TypeError(msg)
-            # Now attempt to convert the parameter to the correct type.
-            this_type = service_params[key]["type"]
-
-            # Try to decode to be able to work with bytes.
-            if this_type is str:
-                try:
-                    value = value.decode()
-                except AttributeError:
-                    pass
+        deadline = kwargs.get("deadline")
+        for attempt in range(throttle_retries + 1):
+            code, data, timing = self._send(url, retries + attempt, **kwargs)
+            if self.concurrency is None or code not in THROTTLE_CODES or \
+                    attempt == throttle_retries:
+                break
+            delay = _retry_after(data, attempt)
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+                if delay <= 0:
+                    break
+            if self.debug:
+                print("Throttled (%s), retrying in %.1f s" % (code, delay))
+            time.sleep(delay)
+        return code, data, timing
 
+    def _send(self, url, retries=0, priority=None, deadline=None, sent=None,
+              **kwargs):
+        """
+        Send a single request, emit its timing and return code, data and
+        timing. With a scheduler the request first waits for a slot of its
+        ``priority`` class, until ``deadline`` at most. The event ``sent``
+        is set once the request leaves all queues.
+        """
+        timing = RequestTiming(
+            url, method="GET" if kwargs.get("data") is None else "POST")
+        timing.retries = retries
+        if self.scheduler is not None:
             try:
-                value = this_type(value)
-            except Exception:
-                msg = "'%s' could not be converted to type '%s'." % (
-                    str(value), this_type.__name__)
-                raise TypeError(msg)
-            # Now convert to a string that is accepted by the webservice.
-            value = convert_to_string(value)
-            final_parameter_set[key] = value
-
-        return self._build_url(service, "query",
-                               parameters=final_parameter_set)
-
-    def _download(self, url, return_string=False, data=None, use_gzip=True, use_jwt=None):
-        code, data = download_url(
-            url, opener=self._url_opener, headers=self.request_headers,
-            debug=self.debug, return_string=return_string, data=data,
-            timeout=self.timeout, use_gzip=use_gzip, use_jwt=use_jwt)
-        raise_on_error(code, data)
-        return data
+                self.scheduler.acquire(priority, deadline)
+            except FDSNDeadlineExceededException:
+                self.instrumentation.emit("deadline", {
+                    "url": url, "priority": priority or DEFAULT_PRIORITY})
+                raise
+        elif deadline is not None and time.monotonic() >= deadline:
+            raise FDSNDeadlineExceededException(
+                "Deadline passed before the request was sent.")
+        if self.concurrency is not None:
+            self.concurrency.acquire()
+        if sent is not None:
+            # Hedging delays are measured from here.
+            sent.set()
+        code, data = None, None
+        try:
+            code, data = download_url(
+                url, opener=self._url_opener, headers=self.request_headers,
+                debug=self.debug, timeout=self.timeout, timing=timing,
+                budget=self.memory_budget, **kwargs)
+        finally:
+            if self.concurrency is not None:
+                self._release_concurrency(code, data, timing)
+            # After the limit was adjusted, the scheduler hands out the
+            # slot with the new capacity.
+            if self.scheduler is not None:
+                self.scheduler.release(priority)
+        timing.status = code
+        if code != 200:
+            timing.error = code if code is not None else \
+                data.__class__.__name__
+        self.instrumentation.emit("request", timing.as_dict())
+        return code, data, timing
+
+    def _release_concurrency(self, code, data, timing):
+        # Only answered requests are throughput and latency samples.
+        answered = code is not None and code < 500
+        change = self.concurrency.release(
+            duration=timing.duration if answered else None,
+            nbytes=timing.bytes_wire, code=code,
+            timeout=code is None and "timed out" in str(data).lower())
+        if change is not None:
+            self.instrumentation.emit("concurrency", dict(
+                (key, value) for key, value in change.items()
+                if key != "time"))
+            if self.debug:
+                print("Concurrency limit %(limit)d (%(reason)s)" % change)
+
+    def _find_endpoint_pool(self, url):
+        """
+        Return the endpoint pool serving ``url`` and the remainder of the
+        URL below the endpoint, or ``(None, None)``.
+        """
+        for pool in self._endpoint_pools:
+            for endpoint in pool.endpoints:
+                if url.startswith(endpoint.url + "/"):
+                    return pool, url[len(endpoint.url):]
+        return None, None
+
+    def _request_endpoint(self, pool, endpoint, path, retries=0,
+                          failover=False, **kwargs):
+        # Throttled requests go to the next endpoint right away instead of
+        # waiting for this one, as long as there is a next one.
+        throttle_retries = 0 if failover else THROTTLE_RETRIES
+        code, data, timing = self._request(endpoint.url + path,
+                                           retries=retries,
+                                           throttle_retries=throttle_retries,
+                                           **kwargs)
+        pool.record(endpoint, timing.duration, code not in FAILOVER_CODES)
+        return code, data
+
+    def _download_from_pool(self, pool, path, **kwargs):
+        """
+        Send a request to the best endpoint of a pool, failing over to the
+        next ones on connection errors, throttling and server errors.
+        """
+        endpoints = pool.ranked()
+        if self.hedge_after is not None and len(endpoints) > 1:
+            delay = endpoints[0].percentile(self.hedge_after)
+            if delay is not None:
+                return self._hedged_download(pool, endpoints, path, delay,
+                                             **kwargs)
+        for retries, endpoint in enumerate(endpoints):
+            code, data = self._request_endpoint(
+                pool, endpoint, path, retries=retries,
+                failover=retries < len(endpoints) - 1, **kwargs)
+            if code not in FAILOVER_CODES:
+                break
+            if self.debug is True:
+                print("Failing over from %s (%s)" % (endpoint.url, code))
+        return code, data
+
+    def _hedged_download(self, pool, endpoints, path, delay, **kwargs):
+        """
+        Send the request to the best endpoint and, if it did not answer
+        within ``delay`` seconds after it was actually sent (not counting
+        time waiting for a thread or a request slot), a duplicate to the
+        second best one. The first usable response wins, the other one is
+        discarded.
+        """
+        import concurrent.futures
+        executor = self._get_hedge_executor()
+
+        def submit(endpoint, retries, sent=None):
+            return executor.submit(self._request_endpoint, pool, endpoint,
+                                   path, retries=retries,
+                                   failover=retries < len(endpoints) - 1,
+                                   sent=sent, **kwargs)
+
+        sent = threading.Event()
+        primary = submit(endpoints[0], 0, sent)
+        primary.add_done_callback(lambda future: sent.set())
+        pending = {primary: endpoints[0]}
+        sent.wait()
+        done, _ = concurrent.futures.wait(pending, timeout=delay)
+        if not done:
+            pending[submit(endpoints[1], 1)] = endpoints[1]
+            self.instrumentation.emit("hedge", {
+                "url": endpoints[1].url + path, "delay": delay})
+        remaining = [e for e in endpoints if e not in pending.values()]
+        code, data = None, None
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                del pending[future]
+                code, data = future.result()
+                if code not in FAILOVER_CODES:
+                    # The slower duplicate is thrown away when it arrives.
+                    for loser in pending:
+                        loser.add_done_callback(_discard_response)
+                    return code, data
+            if not pending and remaining:
+                endpoint = remaining.pop(0)
+                pending[submit(endpoint, len(endpoints) -
+                               len(remaining) - 1)] = endpoint
+        return code, data
+
+    def get_endpoint_stats(self):
+        """
+        Health statistics of all configured mirror endpoints: recent
+        latency, error rate, number of requests and failures per URL.
+        """
+        return [stats for pool in self._endpoint_pools
+                for stats in pool.get_stats()]
 
     def _build_url(self, service, resource_type, parameters={}):
         """
@@ -517,9 +1237,20 @@ class Client(object):
     def get_webservice_version(self, service):
         """
         Get full version information of webservice (as a tuple of ints).
-        This method is cached and will only be called once for each service
-        per client object.
+        This method is cached in :attr:`version_cache` and will only be
+        called once for each service and server per process (or, with a
+        persistent cache, per TTL).
         """
+        url = self._version_url(service)
+        # Access cache.
+        version = self.version_cache.get(url)
+        if version is None:
+            version = self._fetch_webservice_version(url)
+            # Store in cache.
+            self.version_cache.put(url, version)
+        return version
+
+    def _version_url(self, service):
         if service is not None and service not in self.services:
             msg = "Service '%s' not available for current client." % service
             raise ValueError(msg)
@@ -528,25 +1259,38 @@ class Client(object):
             msg = "Service '%s is not a valid FDSN web service." % service
             raise ValueError(msg)
 
-        # Access cache.
-        if service in self.__version_cache:
-            return self.__version_cache[service]
-
-        url = self._build_url(service, "version")
+        return self._build_url(service, "version")
 
+    def _fetch_webservice_version(self, url):
         version = self._download(url, return_string=True)
-        version = list(map(int, version.split(b".")))
+        return list(map(int, version.split(b".")))
 
-        # Store in cache.
-        self.__version_cache[service] = version
-
-        return version
+    def prefetch_webservice_versions(self):
+        """
+        Probe the versions of all services that are not cached yet in
+        background threads, without waiting for them.
+        """
+        for service in self.services:
+            if service in FDSNWS:
+                url = self._version_url(service)
+                self.version_cache.probe(
+                    url, lambda url=url: self._fetch_webservice_version(url))
 
-    def _get_webservice_versionstring(self, service):
+    def _get_webservice_versionstring(self, service, block=True):
         """
         Get full version information of webservice as a string.
+        With ``block=False`` only cached versions are used, unknown ones
+        are returned as ``"?"`` and probed in the background.
         """
-        version = self.get_webservice_version(service)
+        if block:
+            version = self.get_webservice_version(service)
+        else:
+            url = self._version_url(service)
+            version = self.version_cache.get(url)
+            if version is None:
+                self.version_cache.probe(
+                    url, lambda: self._fetch_webservice_version(url))
+                return "?"
         return ".".join(map(str, version))
 
     def _attach_dataselect_url_to_stream(self, st):
@@ -557,6 +1301,43 @@ class Client(object):
         for tr in st:
             tr.stats._fdsnws_dataselect_url = url
 
+def _retry_after(error, attempt, maximum=60.0):
+    """
+    Seconds to wait before repeating a throttled request: the server's
+    ``Retry-After`` (in seconds) if given, otherwise exponential.
+    """
+    try:
+        return min(float(error.headers["Retry-After"]), maximum)
+    except Exception:
+        return min(0.5 * 2 ** attempt, maximum)
+
+
+def _warn_expired(expired, total):
+    if expired:
+        msg = ("%d of %d queries passed the deadline before they were sent, "
+               "their requests got empty streams." % (len(expired), total))
+        warnings.warn(msg)
+
+
+def _discard_response(future):
+    if future.exception() is not None:
+        return
+    code, data = future.result()
+    try:
+        data.close()
+    except Exception:
+        pass
+
+
+def _stream_size(data_stream):
+    """
+    Size of a seekable stream, leaves the position at the start.
+    """
+    data_stream.seek(0, 2)
+    size = data_stream.tell()
+    data_stream.seek(0, 0)
+    return size
+
 def convert_to_string(value):
     """
     Takes any value and converts it to a string compliant with the FDSN
@@ -568,6 +1349,7 @@ def convert_to_string(value):
     1
     >>> print(convert_to_string(1.2))
     1.2
+    >>> from obspy import UTCDateTime
     >>> print(convert_to_string( \
               UTCDateTime(2012, 1, 2, 3, 4, 5, 666666)))
     2012-01-02T03:04:05.666666
@@ -585,7 +1367,10 @@ def convert_to_string(value):
         return str(value)
     elif isinstance(value, float):
         return str(value)
-    elif isinstance(value, UTCDateTime):
+    # Only UTCDateTime is left, it has to be instantiated already so ObsPy
+    # is imported at this point.
+    from obspy import UTCDateTime
+    if isinstance(value, UTCDateTime):
         return str(value).replace("Z", "")
     else:
         raise TypeError("Unexpected type %s" % repr(value))
@@ -694,11 +1479,11 @@ def raise_on_error(code, data):
     # Request URI too large.
     elif code == 414:
         msg = ("The request URI is too large. Please contact the ObsPy "
-               "developers.", server_info)
-        raise NotImplementedError(msg)
+               "developers.")
+        raise NotImplementedError(msg, server_info)
     elif code == 429:
         msg = ("Sent too many requests in a given amount of time ('rate "
-               "limiting'). Wait before making a new request.", server_info)
+               "limiting'). Wait before making a new request.")
         raise FDSNTooManyRequestsException(msg, server_info)
     elif code == 500:
         raise FDSNInternalServerException("Service responds: Internal server "
@@ -718,7 +1503,8 @@ def raise_on_error(code, data):
         raise FDSNException("Unknown HTTP code: %i" % code, server_info)
 
 def download_url(url, opener, timeout=10, headers={}, debug=False,
-                 return_string=True, data=None, use_gzip=True, use_jwt=None):
+                 return_string=True, data=None, use_gzip=True, use_jwt=None,
+                 timing=None, budget=None):
     """
     Returns a pair of tuples.
     The first one is the returned HTTP code and the second the data as
@@ -727,7 +1513,14 @@ def download_url(url, opener, timeout=10, headers={}, debug=False,
     All encountered exceptions will get raised unless `debug=True` is
     specified.
     Performs a http GET if data=None, otherwise a http POST.
+    If a :class:`~instrumentation.RequestTiming` is given as `timing` it is
+    filled with the timing breakdown and transferred byte counts.
+    With a :class:`~budget.MemoryBudget` as `budget`, the body is accounted
+    in the budget and spilled to a temporary file if it does not fit.
     """
+    if timing is None:
+        timing = RequestTiming(url)
+    t0 = time.perf_counter()
     if debug is True:
         print("Downloading %s %s requesting gzip compression" % (
             url, "with" if use_gzip else "without"))
@@ -745,38 +1538,64 @@ def download_url(url, opener, timeout=10, headers={}, debug=False,
         if use_jwt:
             request.add_header("accept", "application/json")
             request.add_header("Authorization", f'JWT {use_jwt}')
+        request.timing = timing
 
         url_obj = opener.open(request, timeout=timeout, data=data)
     # Catch HTTP errors.
     except urllib_request.HTTPError as e:
+        timing.duration = time.perf_counter() - t0
         if debug is True:
             msg = "HTTP error %i, reason %s, while downloading '%s': %s" % \
                   (e.code, str(e.reason), url, e.read())
             print(msg)
         return e.code, e
     except Exception as e:
+        timing.duration = time.perf_counter() - t0
         if debug is True:
             print("Error while downloading: %s" % url)
         return None, e
 
+    t1 = time.perf_counter()
+    timing.ttfb = t1 - t0 - sum(
+        getattr(timing, key) or 0 for key in ("dns", "connect", "tls"))
     code = url_obj.getcode()
 
     # Unpack gzip if necessary.
-    if url_obj.info().get("Content-Encoding") == "gzip":
+    is_gzip = url_obj.info().get("Content-Encoding") == "gzip"
+    if is_gzip:
         if debug is True:
             print("Uncompressing gzipped response for %s" % url)
+        import gzip
         # Cannot directly stream to gzip from urllib!
         # http://www.enricozini.org/2011/cazzeggio/python-gzip/
-        buf = io.BytesIO(url_obj.read())
+        raw = url_obj.read()
+        timing.bytes_wire = len(raw)
+        buf = io.BytesIO(raw)
         buf.seek(0, 0)
         f = gzip.GzipFile(fileobj=buf)
     else:
         f = url_obj
 
-    if return_string is False:
-        data = io.BytesIO(f.read())
+    if return_string is False and budget is not None:
+        # Read in chunks, a body not fitting into the budget any more is
+        # continued in a temporary file.
+        data = BudgetedBuffer(budget)
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            data.write(chunk)
+        nbytes = data.tell()
+        data.seek(0, 0)
     else:
-        data = f.read()
+        content = f.read()
+        nbytes = len(content)
+        if return_string is False:
+            data = io.BytesIO(content)
+        else:
+            data = content
+    if not is_gzip:
+        timing.bytes_wire = nbytes
+    timing.bytes_decoded = nbytes
+    timing.transfer = time.perf_counter() - t1
+    timing.duration = time.perf_counter() - t0
 
     if debug is True:
         print("Downloaded %s with HTTP code: %i" % (url, code))
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive request concurrency.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+An :class:`AdaptiveConcurrency` limits the number of requests in flight
+and tunes the limit with an AIMD controller: after every window of
+completed requests the limit grows by one while throughput keeps improving
+and latency stays near its baseline, and it is cut multiplicatively as soon
+as the server throttles (HTTP 429/503) or requests time out::
+
+    >>> limiter = AdaptiveConcurrency(initial=4, maximum=32)
+    >>> client = Client("TAPS", concurrency=limiter)  # doctest: +SKIP
+    >>> client.get_waveforms_batch(reqs, workers="auto")  # doctest: +SKIP
+    >>> client.get_stats()["concurrency"]["limit"]  # doctest: +SKIP
+    12
+"""
+import threading
+import time
+from collections import deque
+
+# HTTP status codes meaning the server asks us to slow down.
+THROTTLE_CODES = (429, 503)
+
+# Times a throttled request is repeated after the limit was cut.
+THROTTLE_RETRIES = 3
+
+
+class AdaptiveConcurrency(object):
+    """
+    Concurrency limit adjusted to observed throughput, latency and
+    throttling.
+    :type initial: int
+    :param initial: Limit to start with.
+    :type minimum: int
+    :param minimum: Lower bound of the limit.
+    :type maximum: int
+    :param maximum: Upper bound of the limit, also the number of worker
+        threads used with ``workers="auto"``.
+    :type backoff: float
+    :param backoff: Factor the limit is multiplied with on throttling or
+        timeouts.
+    :type gain: float
+    :param gain: Relative throughput improvement needed to keep growing.
+    :type latency_tolerance: float
+    :param latency_tolerance: The limit shrinks by one while the median
+        latency exceeds this multiple of its baseline.
+    :type min_samples: int
+    :param min_samples: Minimum number of completed requests per window.
+    """
+    def __init__(self, initial=4, minimum=1, maximum=32, backoff=0.5,
+                 gain=0.05, latency_tolerance=2.0, min_samples=8,
+                 history=100):
+        if not 1 <= minimum <= initial <= maximum:
+            raise ValueError("Expected 1 <= minimum <= initial <= maximum.")
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.gain = gain
+        self.latency_tolerance = latency_tolerance
+        self.min_samples = min_samples
+        self.history_length = history
+        self._init_state()
+
+    def _init_state(self):
+        self._cond = threading.Condition()
+        self.limit = self.initial
+        self.in_flight = 0
+        self.throughput = None
+        self.latency = None
+        self.baseline_latency = None
+        self.history = deque(maxlen=self.history_length)
+        self._samples = []
+        self._window_start = time.monotonic()
+        self._saturated = False
+        self._last_decrease = 0.0
+
+    def __getstate__(self):
+        # The controller state is per process, only the configuration is
+        # pickled.
+        return dict((key, getattr(self, key)) for key in (
+            "initial", "minimum", "maximum", "backoff", "gain",
+            "latency_tolerance", "min_samples", "history_length"))
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def __repr__(self):
+        return "AdaptiveConcurrency(limit=%d, in_flight=%d)" % (
+            self.limit, self.in_flight)
+
+    def acquire(self):
+        """
+        Wait until fewer than ``limit`` requests are in flight and take a
+        slot.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+            if self.in_flight >= self.limit:
+                self._saturated = True
+
+    def release(self, duration=None, nbytes=0, code=200, timeout=False):
+        """
+        Give back a slot and record the outcome of the request. Returns
+        the new history entry if the limit changed, otherwise ``None``.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            entry = None
+            if code in THROTTLE_CODES or timeout:
+                # Requests sent before the last cut fail together, count
+                # them as one signal.
+                now = time.monotonic()
+                if now - self._last_decrease > (self.latency or 1.0):
+                    self._last_decrease = now
+                    entry = self._set_limit(
+                        int(self.limit * self.backoff),
+                        "timeout" if timeout else "throttled (%s)" % code)
+                self._reset_window()
+            elif duration is not None:
+                self._samples.append((duration, nbytes))
+                if len(self._samples) >= max(self.limit, self.min_samples):
+                    entry = self._evaluate()
+            self._cond.notify_all()
+            return entry
+
+    def _reset_window(self):
+        self._samples = []
+        self._window_start = time.monotonic()
+        self._saturated = False
+
+    def _evaluate(self):
+        now = time.monotonic()
+        elapsed = max(now - self._window_start, 1e-9)
+        durations = sorted(duration for duration, _ in self._samples)
+        latency = durations[len(durations) // 2]
+        throughput = sum(nbytes for _, nbytes in self._samples) / elapsed
+        if self.baseline_latency is None:
+            self.baseline_latency = latency
+        else:
+            # Follow slow drifts (e.g. larger requests) but keep the
+            # minimum as reference.
+            self.baseline_latency = min(latency,
+                                        self.baseline_latency * 1.05)
+        previous = self.throughput
+        self.throughput = throughput
+        self.latency = latency
+        saturated = self._saturated
+        self._reset_window()
+        if latency > self.baseline_latency * self.latency_tolerance:
+            return self._set_limit(self.limit - 1, "latency")
+        if saturated and (previous is None or
+                          throughput >= previous * (1.0 + self.gain)):
+            return self._set_limit(self.limit + 1, "throughput")
+        return None
+
+    def _set_limit(self, limit, reason):
+        limit = min(max(limit, self.minimum), self.maximum)
+        if limit == self.limit:
+            return None
+        self.limit = limit
+        entry = {"time": time.time(), "limit": limit, "reason": reason,
+                 "throughput": self.throughput, "latency": self.latency}
+        self.history.append(entry)
+        return entry
+
+    def get_stats(self):
+        with self._cond:
+            return {"limit": self.limit, "in_flight": self.in_flight,
+                    "throughput": self.throughput, "latency": self.latency,
+                    "baseline_latency": self.baseline_latency,
+                    "history": list(self.history)}
@@ -0,0 +1,583 @@
+# -*- coding: utf-8 -*-
+"""
+Header-only MiniSEED scanning and coverage reports.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+Only the fixed section of the data header (plus blockettes 100, 1000 and
+1001) of every record is read, no sample is decoded. The record start
+times, sampling rates and sample counts give per channel coverage
+intervals, gaps, overlaps and sample totals at a small fraction of the
+cost of reading the data with ObsPy::
+
+    >>> cov = get_coverage("TW.NSE01..EHZ.2008.107.mseed")  # doctest: +SKIP
+    >>> for row in cov.rows():  # doctest: +SKIP
+    ...     print(row)
+    ('TW.NSE01..EHZ', 1208304000000000000, 1208390400000000000, 8639000, 1,
+     0, 99.98842592592592)
+"""
+import datetime
+import mmap
+import struct
+from collections import OrderedDict, namedtuple
+
+# Byte offsets of the fixed section of the data header.
+FIXED_HEADER_LENGTH = 48
+
+_ORDINAL_EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+
+class RecordHeader(namedtuple("RecordHeader", [
+        "offset", "reclen", "network", "station", "location", "channel",
+        "starttime", "sampling_rate", "npts", "encoding", "byteorder",
+        "data_offset"])):
+    """
+    Header of a single MiniSEED record. ``starttime`` is in nanoseconds
+    since 1970-01-01 with the time correction applied, ``byteorder`` is
+    ``">"`` or ``"<"``.
+    """
+    __slots__ = ()
+
+    @property
+    def id(self):
+        return "%s.%s.%s.%s" % (self.network, self.station, self.location,
+                                self.channel)
+
+    @property
+    def endtime(self):
+        """
+        Time of the last sample in nanoseconds.
+        """
+        if not self.sampling_rate or not self.npts:
+            return self.starttime
+        return self.starttime + int(round((self.npts - 1) * 1e9 /
+                                          self.sampling_rate))
+
+    @property
+    def next_starttime(self):
+        """
+        Expected start time of a directly following record.
+        """
+        if not self.sampling_rate:
+            return self.starttime
+        return self.starttime + int(round(self.npts * 1e9 /
+                                          self.sampling_rate))
+
+
+def _sampling_rate(factor, multiplier):
+    if factor == 0 or multiplier == 0:
+        return 0.0
+    if factor > 0 and multiplier > 0:
+        return float(factor * multiplier)
+    if factor > 0 > multiplier:
+        return -float(factor) / multiplier
+    if factor < 0 < multiplier:
+        return -float(multiplier) / factor
+    return 1.0 / (factor * multiplier)
+
+
+_DAYS = {}
+
+
+def _btime_ns(year, jday, hour, minute, second, fract):
+    try:
+        days = _DAYS[year]
+    except KeyError:
+        days = _DAYS[year] = \
+            datetime.date(year, 1, 1).toordinal() - _ORDINAL_EPOCH
+    seconds = (days + jday - 1) * 86400 + hour * 3600 + minute * 60 + second
+    return seconds * 1000000000 + fract * 100000
+
+
+def _byteorder(buf, offset):
+    year, = struct.unpack_from(">H", buf, offset + 20)
+    if 1900 <= year <= 2100:
+        return ">"
+    return "<"
+
+
+def _looks_like_header(buf, offset):
+    if offset + FIXED_HEADER_LENGTH > len(buf):
+        return False
+    head = bytes(buf[offset:offset + 7])
+    return (head[:6].strip(b" ").isdigit() or head[:6] == b"      ") and \
+        head[6:7] in (b"D", b"R", b"Q", b"M")
+
+
+def _guess_reclen(buf, offset):
+    # Records without blockette 1000: look for the next header.
+    reclen = 256
+    while reclen <= 65536:
+        if offset + reclen >= len(buf) or _looks_like_header(
+                buf, offset + reclen):
+            return min(reclen, len(buf) - offset)
+        reclen *= 2
+    raise ValueError("Unable to determine the record length at byte %d."
+                     % offset)
+
+
+def parse_record_header(buf, offset=0):
+    """
+    Parse the header of the record starting at ``offset`` of ``buf``
+    (bytes, memoryview or mmap). Returns a :class:`RecordHeader`.
+    """
+    if not _looks_like_header(buf, offset):
+        raise ValueError("No MiniSEED record at byte %d." % offset)
+    bo = _byteorder(buf, offset)
+    (station, location, channel, network, year, jday, hour, minute, second,
+     fract, npts, factor, multiplier, activity, nblockettes, correction,
+     data_offset, blockette_offset) = struct.unpack_from(
+        bo + "5s2s3s2sHHBBBxHHhhBxxBiHH", buf, offset + 8)
+    starttime = _btime_ns(year, jday, hour, minute, second, fract)
+    # Time correction not applied yet (activity flag bit 1).
+    if correction and not activity & 0x02:
+        starttime += correction * 100000
+    sampling_rate = _sampling_rate(factor, multiplier)
+    reclen = None
+    encoding = None
+    seen = 0
+    while blockette_offset and seen < nblockettes:
+        pos = offset + blockette_offset
+        if pos + 4 > len(buf):
+            break
+        btype, next_offset = struct.unpack_from(bo + "HH", buf, pos)
+        if btype == 1000:
+            encoding, _, exponent = struct.unpack_from("BBB", buf, pos + 4)
+            reclen = 2 ** exponent
+        elif btype == 1001:
+            microseconds, = struct.unpack_from("b", buf, pos + 5)
+            starttime += microseconds * 1000
+        elif btype == 100:
+            sampling_rate, = struct.unpack_from(bo + "f", buf, pos + 4)
+            sampling_rate = float(sampling_rate)
+        seen += 1
+        if next_offset <= blockette_offset:
+            break
+        blockette_offset = next_offset
+    if reclen is None:
+        reclen = _guess_reclen(buf, offset)
+    return RecordHeader(
+        offset, reclen, network.decode("ascii", "replace").strip(),
+        station.decode("ascii", "replace").strip(),
+        location.decode("ascii", "replace").strip(),
+        channel.decode("ascii", "replace").strip(), starttime,
+        sampling_rate, npts, encoding, bo, data_offset)
+
+
+def scan_records(buf):
+    """
+    Yield the :class:`RecordHeader` of every record of a MiniSEED buffer.
+    Blank padding between records is skipped.
+    """
+    offset = 0
+    length = len(buf)
+    while offset + FIXED_HEADER_LENGTH <= length:
+        if not _looks_like_header(buf, offset):
+            # Padding or garbage, continue at the next 256 byte boundary.
+            offset = (offset // 256 + 1) * 256
+            continue
+        header = parse_record_header(buf, offset)
+        yield header
+        offset += header.reclen
+
+
+def _fixed_header_dtype(bo, reclen):
+    import numpy as np
+    fields = [("quality", "S1", 6), ("codes", "S12", 8),
+              ("year", bo + "u2", 20), ("jday", bo + "u2", 22),
+              ("hour", "u1", 24), ("minute", "u1", 25), ("second", "u1", 26),
+              ("fract", bo + "u2", 28), ("npts", bo + "u2", 30),
+              ("factor", bo + "i2", 32), ("multiplier", bo + "i2", 34),
+              ("activity", "u1", 36), ("nblockettes", "u1", 39),
+              ("correction", bo + "i4", 40),
+              ("blockette_offset", bo + "u2", 46)]
+    return np.dtype({"names": [f[0] for f in fields],
+                     "formats": [f[1] for f in fields],
+                     "offsets": [f[2] for f in fields],
+                     "itemsize": reclen})
+
+
+def _blockette_chain(buf, bo):
+    # Positions and types of the blockettes of the first record.
+    chain = []
+    nblockettes, = struct.unpack_from("B", buf, 39)
+    pos, = struct.unpack_from(bo + "H", buf, 46)
+    while pos and len(chain) < nblockettes and pos + 4 <= len(buf):
+        btype, next_pos = struct.unpack_from(bo + "HH", buf, pos)
+        chain.append((pos, btype))
+        if next_pos <= pos:
+            break
+        pos = next_pos
+    return chain
+
+
+def _uniform_table(buf):
+    """
+    Vectorized header parsing for the common case of records of a single
+    length and blockette layout. Returns ``None`` for other data.
+    """
+    import numpy as np
+    first = parse_record_header(buf, 0)
+    reclen = first.reclen
+    if len(buf) % reclen or first.encoding is None:
+        return None
+    n = len(buf) // reclen
+    bo = first.byteorder
+    rec = np.frombuffer(buf, _fixed_header_dtype(bo, reclen), count=n)
+    chain = _blockette_chain(buf, bo)
+    if not np.isin(rec["quality"], [b"D", b"R", b"Q", b"M"]).all() or \
+            (rec["blockette_offset"] != rec["blockette_offset"][0]).any() \
+            or (rec["nblockettes"] != rec["nblockettes"][0]).any():
+        return None
+    microseconds = None
+    sampling_rate = None
+    for pos, btype in chain:
+        extra = np.frombuffer(buf, np.dtype({
+            "names": ["type", "b4", "b5", "b6", "f4"],
+            "formats": [bo + "u2", "u1", "i1", "u1", bo + "f4"],
+            "offsets": [pos, pos + 4, pos + 5, pos + 6, pos + 4],
+            "itemsize": reclen}), count=n)
+        if (extra["type"] != btype).any():
+            return None
+        if btype == 1000 and (extra["b6"] != extra["b6"][0]).any():
+            return None
+        elif btype == 1001:
+            microseconds = extra["b5"].astype(np.int64)
+        elif btype == 100:
+            sampling_rate = extra["f4"].astype(np.float64)
+
+    days = np.empty(n, dtype=np.int64)
+    years = rec["year"]
+    for year in np.unique(years):
+        days[years == year] = \
+            datetime.date(int(year), 1, 1).toordinal() - _ORDINAL_EPOCH
+    seconds = (days + rec["jday"].astype(np.int64) - 1) * 86400 + \
+        rec["hour"].astype(np.int64) * 3600 + \
+        rec["minute"].astype(np.int64) * 60 + rec["second"]
+    starts = seconds * 1000000000 + rec["fract"].astype(np.int64) * 100000
+    correction = rec["correction"].astype(np.int64) * 100000
+    correction[(rec["activity"] & 0x02) != 0] = 0
+    starts += correction
+    if microseconds is not None:
+        starts += microseconds * 1000
+    if sampling_rate is None:
+        sampling_rate = np.array([
+            _sampling_rate(int(f), int(m)) for f, m in
+            zip(rec["factor"], rec["multiplier"])]) \
+            if (rec["factor"] != rec["factor"][0]).any() or \
+            (rec["multiplier"] != rec["multiplier"][0]).any() \
+            else np.full(n, _sampling_rate(int(rec["factor"][0]),
+                                           int(rec["multiplier"][0])))
+    codes, inverse = np.unique(rec["codes"], return_inverse=True)
+    ids = []
+    for code in codes:
+        code = code.ljust(12)
+        ids.append("%s.%s.%s.%s" % tuple(
+            part.decode("ascii", "replace").strip() for part in (
+                code[10:12], code[0:5], code[5:7], code[7:10])))
+    return RecordTable(ids, inverse, np.arange(n, dtype=np.int64) * reclen,
+                       np.full(n, reclen, dtype=np.int64), starts,
+                       rec["npts"].astype(np.int64), sampling_rate)
+
+
+class RecordTable(object):
+    """
+    Column store of the record headers of a MiniSEED buffer: record
+    offsets and lengths, start times (ns), sample counts and sampling
+    rates as NumPy arrays, ``channel`` indexing into the list of SEED ids
+    ``ids``.
+    """
+    def __init__(self, ids, channel, offset, reclen, starttime, npts,
+                 sampling_rate):
+        import numpy as np
+        self.ids = ids
+        self.channel = np.asarray(channel, dtype=np.int64)
+        self.offset = np.asarray(offset, dtype=np.int64)
+        self.reclen = np.asarray(reclen, dtype=np.int64)
+        self.starttime = np.asarray(starttime, dtype=np.int64)
+        self.npts = np.asarray(npts, dtype=np.int64)
+        self.sampling_rate = np.asarray(sampling_rate, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.offset)
+
+    @property
+    def next_starttime(self):
+        """
+        Expected start times of directly following records.
+        """
+        import numpy as np
+        with np.errstate(divide="ignore", invalid="ignore"):
+            duration = np.where(self.sampling_rate > 0,
+                                self.npts * 1e9 / self.sampling_rate, 0)
+        return self.starttime + np.round(duration).astype(np.int64)
+
+    @classmethod
+    def from_headers(cls, headers):
+        headers = list(headers)
+        ids = []
+        index = {}
+        channel = []
+        for h in headers:
+            if h.id not in index:
+                index[h.id] = len(ids)
+                ids.append(h.id)
+            channel.append(index[h.id])
+        return cls(ids, channel, [h.offset for h in headers],
+                   [h.reclen for h in headers],
+                   [h.starttime for h in headers],
+                   [h.npts for h in headers],
+                   [h.sampling_rate for h in headers])
+
+    @classmethod
+    def concatenate(cls, tables):
+        import numpy as np
+        ids = []
+        index = {}
+        channel = []
+        for table in tables:
+            mapping = []
+            for seed_id in table.ids:
+                if seed_id not in index:
+                    index[seed_id] = len(ids)
+                    ids.append(seed_id)
+                mapping.append(index[seed_id])
+            channel.append(np.asarray(mapping, dtype=np.int64)[
+                table.channel] if len(table) else table.channel)
+        if not tables:
+            return cls([], [], [], [], [], [], [])
+        return cls(ids, np.concatenate(channel),
+                   *[np.concatenate([getattr(t, name) for t in tables])
+                     for name in ("offset", "reclen", "starttime", "npts",
+                                  "sampling_rate")])
+
+
+def scan_table(buf):
+    """
+    Parse all record headers of a MiniSEED buffer into a
+    :class:`RecordTable`, vectorized if all records share length and
+    blockette layout.
+    """
+    if len(buf) >= FIXED_HEADER_LENGTH and _looks_like_header(buf, 0):
+        table = _uniform_table(buf)
+        if table is not None:
+            return table
+    return RecordTable.from_headers(scan_records(buf))
+
+
+def format_time(ns):
+    """
+    ISO 8601 string of a nanosecond timestamp (microsecond precision).
+    >>> print(format_time(1208304000000000000))
+    2008-04-16T00:00:00.000000
+    """
+    seconds, rest = divmod(ns, 1000000000)
+    dt = datetime.datetime(1970, 1, 1) + datetime.timedelta(
+        seconds=seconds, microseconds=rest // 1000)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+def _to_ns(t):
+    if t is None or isinstance(t, int):
+        return t
+    if not hasattr(t, "ns"):
+        from obspy import UTCDateTime
+        t = UTCDateTime(t)
+    return t.ns
+
+
+class ChannelCoverage(object):
+    """
+    Coverage of a single channel. Intervals, gaps and overlaps are lists
+    of ``(start, end)`` nanosecond timestamps, intervals end at the
+    expected start of the next sample.
+    """
+    __slots__ = ("id", "sampling_rate", "intervals", "gaps", "overlaps",
+                 "samples", "records")
+
+    def __init__(self, id, sampling_rate):
+        self.id = id
+        self.sampling_rate = sampling_rate
+        self.intervals = []
+        self.gaps = []
+        self.overlaps = []
+        self.samples = 0
+        self.records = 0
+
+    def __repr__(self):
+        return "ChannelCoverage(%r, intervals=%d, gaps=%d, overlaps=%d)" % (
+            self.id, len(self.intervals), len(self.gaps), len(self.overlaps))
+
+    @property
+    def starttime(self):
+        return self.intervals[0][0] if self.intervals else None
+
+    @property
+    def endtime(self):
+        return self.intervals[-1][1] if self.intervals else None
+
+    @property
+    def gap_duration(self):
+        """
+        Total duration of the gaps in seconds.
+        """
+        return sum(end - start for start, end in self.gaps) / 1e9
+
+    def percent(self, starttime=None, endtime=None):
+        """
+        Percentage of the time window covered by data, by default the
+        window spanned by the data.
+        """
+        start = _to_ns(starttime)
+        end = _to_ns(endtime)
+        if start is None:
+            start = self.starttime
+        if end is None:
+            end = self.endtime
+        if not self.intervals or end <= start:
+            return 0.0
+        covered = sum(max(min(e, end) - max(s, start), 0)
+                      for s, e in self.intervals)
+        return 100.0 * covered / (end - start)
+
+
+class Coverage(object):
+    """
+    Per channel coverage built from the record headers of a
+    :class:`RecordTable`, see :func:`get_coverage`.
+    """
+    def __init__(self, table, starttime=None, endtime=None, tolerance=0.5):
+        import numpy as np
+        self.starttime = _to_ns(starttime)
+        self.endtime = _to_ns(endtime)
+        self.channels = OrderedDict()
+        nexts = table.next_starttime
+        for index in sorted(range(len(table.ids)),
+                            key=lambda i: table.ids[i]):
+            mask = table.channel == index
+            order = np.argsort(table.starttime[mask], kind="stable")
+            self.channels[table.ids[index]] = self._channel_coverage(
+                table.ids[index], table.starttime[mask][order],
+                nexts[mask][order], table.npts[mask][order],
+                table.sampling_rate[mask][order], tolerance)
+
+    def _channel_coverage(self, seed_id, starts, ends, npts, rates,
+                          tolerance):
+        import numpy as np
+        cov = ChannelCoverage(seed_id, float(rates[0]))
+        cov.records = len(starts)
+        cov.samples = int(npts.sum())
+        keep = npts > 0
+        starts, ends, rates = starts[keep], ends[keep], rates[keep]
+        if len(starts):
+            with np.errstate(divide="ignore"):
+                tol = np.where(rates > 0, np.round(tolerance * 1e9 / rates),
+                               0).astype(np.int64)
+            # End of the data seen so far before each record.
+            covered = np.maximum.accumulate(ends)[:-1]
+            gaps = np.nonzero(starts[1:] > covered + tol[1:])[0] + 1
+            overlaps = np.nonzero(starts[1:] < covered - tol[1:])[0] + 1
+            bounds = [0] + list(gaps) + [len(starts)]
+            for i, j in zip(bounds[:-1], bounds[1:]):
+                cov.intervals.append((int(starts[i]), int(ends[i:j].max())))
+            cov.gaps = [(int(covered[i - 1]), int(starts[i])) for i in gaps]
+            for i in overlaps:
+                overlap = (int(starts[i]), int(min(covered[i - 1], ends[i])))
+                # Interleaved records of overlapping segments form a
+                # single overlap.
+                if cov.overlaps and overlap[0] <= cov.overlaps[-1][1] + \
+                        tol[i]:
+                    overlap = (cov.overlaps[-1][0],
+                               max(cov.overlaps[-1][1], overlap[1]))
+                    cov.overlaps[-1] = overlap
+                else:
+                    cov.overlaps.append(overlap)
+        # Missing data at the edges of the requested window.
+        if self.starttime is not None and cov.intervals and \
+                cov.intervals[0][0] > self.starttime:
+            cov.gaps.insert(0, (self.starttime, cov.intervals[0][0]))
+        if self.endtime is not None and cov.intervals and \
+                cov.intervals[-1][1] < self.endtime:
+            cov.gaps.append((cov.intervals[-1][1], self.endtime))
+        return cov
+
+    def __len__(self):
+        return len(self.channels)
+
+    def __iter__(self):
+        return iter(self.channels.values())
+
+    def __getitem__(self, seed_id):
+        return self.channels[seed_id]
+
+    def rows(self):
+        """
+        The report as a list of ``(id, starttime, endtime, samples, gaps,
+        overlaps, percent)`` tuples, times in nanoseconds.
+        """
+        return [(cov.id, cov.starttime, cov.endtime, cov.samples,
+                 len(cov.gaps), len(cov.overlaps),
+                 cov.percent(self.starttime, self.endtime))
+                for cov in self]
+
+    def __str__(self):
+        lines = ["%-16s %-26s  %-26s  %9s  %4s  %8s  %7s" % (
+            "channel", "start", "end", "samples", "gaps", "overlaps",
+            "percent")]
+        for seed_id, start, end, samples, gaps, overlaps, percent in \
+                self.rows():
+            lines.append("%-16s %-26s  %-26s  %9d  %4d  %8d  %7.2f" % (
+                seed_id, format_time(start) if start is not None else "-",
+                format_time(end) if end is not None else "-", samples,
+                gaps, overlaps, percent))
+        return "\n".join(lines)
+
+
+def read_table(source):
+    """
+    :class:`RecordTable` of a MiniSEED file name, buffer or file object.
+    Files are memory mapped, only the header pages are touched.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return scan_table(source)
+    if hasattr(source, "getbuffer"):
+        return scan_table(source.getbuffer())
+    if hasattr(source, "read"):
+        return scan_table(source.read())
+    with open(source, "rb") as fh:
+        try:
+            buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file.
+            return RecordTable.concatenate([])
+        try:
+            return scan_table(buf)
+        finally:
+            try:
+                buf.close()
+            except BufferError:
+                # Still referenced by NumPy views, closed when collected.
+                pass
+
+
+def get_coverage(sources, starttime=None, endtime=None, tolerance=0.5):
+    """
+    Coverage report of MiniSEED data without decoding any sample.
+    :type sources: str, bytes, file-like object or list of them
+    :param sources: MiniSEED file names, buffers or file objects.
+    :type starttime: :class:`~obspy.core.utcdatetime.UTCDateTime`
+    :param starttime: Start of the window of interest, missing data
+        before the first record is reported as gap.
+    :type endtime: :class:`~obspy.core.utcdatetime.UTCDateTime`
+    :param endtime: End of the window of interest.
+    :type tolerance: float
+    :param tolerance: Misalignment in samples still treated as
+        contiguous.
+    :rtype: :class:`Coverage`
+    """
+    if not isinstance(sources, (list, tuple)):
+        sources = [sources]
+    table = RecordTable.concatenate([read_table(source)
+                                     for source in sources])
+    return Coverage(table, starttime=starttime, endtime=endtime,
+                    tolerance=tolerance)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Health tracking of equivalent service endpoints (mirrors).
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+An :class:`EndpointPool` holds the base URLs that serve the same data and
+ranks them by recent latency and error rate. The client sends a request to
+the best endpoint and fails over to the next one on connection errors,
+throttling and server errors::
+
+    >>> pool = EndpointPool(["https://a.example.org",
+    ...                      "https://b.example.org"])
+    >>> pool.record(pool.endpoints[0], 0.5, ok=False)
+    >>> print(pool.ranked()[0].url)
+    https://b.example.org
+"""
+import math
+import threading
+import time
+from collections import deque
+
+# HTTP status codes (None: no response at all) that trigger a failover.
+FAILOVER_CODES = (None, 429, 500, 502, 503, 504)
+
+# Latency samples needed before an endpoint is considered for hedging.
+MIN_HEDGE_SAMPLES = 10
+
+
+class Endpoint(object):
+    """
+    A base URL with its recent latency and error statistics.
+    """
+    def __init__(self, url, alpha=0.2, window=200):
+        self.url = url
+        self.alpha = alpha
+        self.latency = None
+        self.error_rate = 0.0
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+
+    def __repr__(self):
+        return "Endpoint(%r, latency=%s, error_rate=%.2f)" % (
+            self.url, "%.3f" % self.latency if self.latency is not None
+            else None, self.error_rate)
+
+    def score(self):
+        """
+        Expected cost of a request, lower is better. Endpoints without
+        measurements rank behind measured healthy ones.
+        """
+        if self.latency is None:
+            return math.inf
+        return self.latency * (1.0 + 4.0 * self.error_rate)
+
+    def percentile(self, q):
+        if len(self.latencies) < MIN_HEDGE_SAMPLES:
+            return None
+        values = sorted(self.latencies)
+        index = min(int(math.ceil(q / 100.0 * len(values))) - 1,
+                    len(values) - 1)
+        return values[max(index, 0)]
+
+
+class EndpointPool(object):
+    """
+    Equivalent base URLs, the first one is the primary.
+    :type urls: list of str
+    :param urls: Base URLs serving the same data.
+    :type max_backoff: float
+    :param max_backoff: Upper limit in seconds an endpoint is skipped after
+        consecutive failures.
+    """
+    def __init__(self, urls, max_backoff=60.0):
+        if not urls:
+            raise ValueError("At least one endpoint is required.")
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+
+    @property
+    def primary(self):
+        return self.endpoints[0]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def ranked(self):
+        """
+        Endpoints ordered by preference. Endpoints backing off after
+        failures come last but stay available as last resort.
+        """
+        now = time.time()
+        with self._lock:
+            order = sorted(
+                enumerate(self.endpoints),
+                key=lambda item: (item[1].down_until > now, item[1].score(),
+                                  item[0]))
+        return [endpoint for _, endpoint in order]
+
+    def record(self, endpoint, latency, ok):
+        """
+        Update the statistics of an endpoint after a request.
+        """
+        with self._lock:
+            endpoint.requests += 1
+            alpha = endpoint.alpha
+            endpoint.error_rate = (1 - alpha) * endpoint.error_rate + \
+                alpha * (0.0 if ok else 1.0)
+            if ok:
+                endpoint.consecutive_failures = 0
+                endpoint.down_until = 0.0
+                endpoint.latencies.append(latency)
+                if endpoint.latency is None:
+                    endpoint.latency = latency
+                else:
+                    endpoint.latency = (1 - alpha) * endpoint.latency + \
+                        alpha * latency
+            else:
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                backoff = min(2.0 ** (endpoint.consecutive_failures - 1),
+                              self.max_backoff)
+                endpoint.down_until = time.time() + backoff
+
+    def get_stats(self):
+        with self._lock:
+            return [{"url": e.url, "latency": e.latency,
+                     "error_rate": e.error_rate, "requests": e.requests,
+                     "failures": e.failures} for e in self.endpoints]
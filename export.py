@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+"""
+Export of downloaded waveforms into a chunked on-disk array store.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+Data is written to a Zarr (format 2) directory store, readable with
+``zarr.open(path)``, without depending on the zarr package. Every sampling
+rate gets a two dimensional array ``channel x time`` (e.g. ``100Hz``) on a
+common time grid, chunked per channel and ``chunk_length`` samples and
+optionally zlib compressed. Channel metadata of the station service is
+kept in the attributes. Each chunk belongs to a single channel, so
+channels can be written in parallel. Uncompressed chunks are read back as
+memory mapped slices::
+
+    >>> client.export_waveforms("nse.zarr", "TW", "NSE*", "--", "EH?", t,
+    ...                         t + 86400, workers=8)  # doctest: +SKIP
+    >>> store = ArrayStore("nse.zarr")  # doctest: +SKIP
+    >>> data = store.read("TW.NSE01..EHZ", t + 3600,
+    ...                   t + 3660)  # doctest: +SKIP
+"""
+import json
+import math
+import os
+import threading
+import warnings
+import zlib
+from collections import OrderedDict
+
+# Samples per chunk and channel, one hour at 100 Hz.
+DEFAULT_CHUNK_LENGTH = 360000
+
+ZARR_FORMAT = 2
+
+
+def _write_json(path, content):
+    tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    with open(tmp, "w") as fh:
+        json.dump(content, fh, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    with open(path, "r") as fh:
+        return json.load(fh)
+
+
+def _to_ns(t):
+    if isinstance(t, int):
+        return t
+    if not hasattr(t, "ns"):
+        from obspy import UTCDateTime
+        t = UTCDateTime(t)
+    return t.ns
+
+
+def rate_matches(sampling_rate, expected, npts):
+    """
+    True if ``npts`` samples at ``sampling_rate`` stay within half a sample
+    of the time grid of ``expected``.
+    >>> rate_matches(100.0, 100.0, 360000), rate_matches(50.0, 100.0, 2)
+    (True, False)
+    """
+    return abs(sampling_rate - expected) * max(npts, 1) < 0.5 * expected
+
+
+def array_name(sampling_rate):
+    """
+    Name of the array holding the channels of a sampling rate.
+    >>> print(array_name(100.0), array_name(0.1))
+    100Hz 0.1Hz
+    """
+    return "%gHz" % sampling_rate
+
+
+def channel_metadata(inventory, seed_id, time=None):
+    """
+    Coordinates, orientation and sensitivity of a channel from the
+    station service, ``None`` values for unknown ones.
+    """
+    net, sta, loc, cha = seed_id.split(".")
+    meta = {"id": seed_id, "latitude": None, "longitude": None,
+            "elevation": None, "local_depth": None, "azimuth": None,
+            "dip": None, "sensitivity": None, "input_units": None}
+    if inventory is None:
+        return meta
+    selected = inventory.select(network=net, station=sta, location=loc,
+                                channel=cha, time=time)
+    for network in selected:
+        for station in network:
+            for channel in station:
+                for key in ("latitude", "longitude", "elevation",
+                            "azimuth", "dip"):
+                    value = getattr(channel, key)
+                    meta[key] = float(value) if value is not None else None
+                if channel.depth is not None:
+                    meta["local_depth"] = float(channel.depth)
+                response = channel.response
+                sensitivity = getattr(response, "instrument_sensitivity",
+                                      None)
+                if sensitivity is not None:
+                    meta["sensitivity"] = sensitivity.value
+                    meta["input_units"] = sensitivity.input_units
+                return meta
+    return meta
+
+
+class ChunkedArray(object):
+    """
+    A ``channel x time`` array of a Zarr directory store.
+    """
+    def __init__(self, path):
+        import numpy as np
+        self.path = path
+        meta = _read_json(os.path.join(path, ".zarray"))
+        self.shape = tuple(meta["shape"])
+        self.chunks = tuple(meta["chunks"])
+        self.dtype = np.dtype(meta["dtype"])
+        self.compressor = meta["compressor"]
+        fill_value = meta["fill_value"]
+        self.fill_value = float("nan") if fill_value == "NaN" else fill_value
+        self.attrs = _read_json(os.path.join(path, ".zattrs"))
+        self.channels = self.attrs["channels"]
+        self.index = dict((meta["id"], i)
+                          for i, meta in enumerate(self.channels))
+        self._locks = dict((i, threading.Lock())
+                           for i in range(len(self.channels)))
+
+    @property
+    def chunk_length(self):
+        return self.chunks[1]
+
+    @property
+    def starttime(self):
+        return self.attrs["starttime_ns"]
+
+    @property
+    def sampling_rate(self):
+        return self.attrs["sampling_rate"]
+
+    def _chunk_path(self, row, chunk):
+        return os.path.join(self.path, "%d.%d" % (row, chunk))
+
+    def _empty_chunk(self):
+        import numpy as np
+        return np.full(self.chunk_length, self.fill_value, dtype=self.dtype)
+
+    def read_chunk(self, row, chunk):
+        """
+        Return the samples of a chunk; uncompressed chunks are memory
+        mapped read only, missing chunks are filled with the fill value.
+        """
+        import numpy as np
+        filename = self._chunk_path(row, chunk)
+        if not os.path.exists(filename):
+            return self._empty_chunk()
+        if self.compressor is None:
+            return np.memmap(filename, dtype=self.dtype, mode="r",
+                             shape=(self.chunk_length,))
+        with open(filename, "rb") as fh:
+            raw = zlib.decompress(fh.read())
+        return np.frombuffer(raw, dtype=self.dtype)
+
+    def _write_chunk(self, row, chunk, data):
+        raw = data.astype(self.dtype, copy=False).tobytes()
+        if self.compressor is not None:
+            raw = zlib.compress(raw, self.compressor.get("level", 1))
+        filename = self._chunk_path(row, chunk)
+        tmp = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.get_ident())
+        with open(tmp, "wb") as fh:
+            fh.write(raw)
+        os.replace(tmp, filename)
+
+    def write(self, row, start, data):
+        """
+        Write ``data`` to channel ``row`` starting at sample ``start``.
+        Samples outside the array are dropped, chunks are rewritten as a
+        whole. Different rows may be written concurrently.
+        """
+        import numpy as np
+        data = np.asarray(data)
+        if start < 0:
+            data = data[-start:]
+            start = 0
+        data = data[:max(self.shape[1] - start, 0)]
+        if not len(data):
+            return
+        length = self.chunk_length
+        with self._locks[row]:
+            first = start // length
+            last = (start + len(data) - 1) // length
+            for chunk in range(first, last + 1):
+                chunk_start = chunk * length
+                lo = max(start, chunk_start)
+                hi = min(start + len(data), chunk_start + length)
+                if lo == chunk_start and hi == chunk_start + length:
+                    block = data[lo - start:hi - start]
+                else:
+                    block = np.array(self.read_chunk(row, chunk))
+                    block[lo - chunk_start:hi - chunk_start] = \
+                        data[lo - start:hi - start]
+                self._write_chunk(row, chunk, block)
+
+    def write_trace(self, trace):
+        """
+        Place a trace on the time grid of the array by its start time.
+        Raises a ``ValueError`` if the sampling rate of the trace does not
+        match the one of the array.
+        """
+        if not rate_matches(trace.stats.sampling_rate, self.sampling_rate,
+                            trace.stats.npts):
+            msg = ("Sampling rate of %s (%g Hz) does not match the array "
+                   "(%g Hz)." % (trace.id, trace.stats.sampling_rate,
+                                 self.sampling_rate))
+            raise ValueError(msg)
+        row = self.index[trace.id]
+        offset = (trace.stats.starttime.ns - self.starttime) * \
+            self.sampling_rate / 1e9
+        self.write(row, int(round(offset)), trace.data)
+
+    def read(self, seed_id, starttime=None, endtime=None):
+        """
+        Samples of a channel between ``starttime`` and ``endtime`` (end
+        exclusive). A window inside a single uncompressed chunk is a view
+        of the memory mapped chunk file.
+        """
+        import numpy as np
+        row = self.index[seed_id]
+        start, stop = 0, self.shape[1]
+        if starttime is not None:
+            start = max(int(math.ceil(round(
+                (_to_ns(starttime) - self.starttime) *
+                self.sampling_rate / 1e9, 6))), 0)
+        if endtime is not None:
+            stop = min(int(math.ceil(round(
+                (_to_ns(endtime) - self.starttime) *
+                self.sampling_rate / 1e9, 6))), self.shape[1])
+        if stop <= start:
+            return np.empty(0, dtype=self.dtype)
+        length = self.chunk_length
+        first, last = start // length, (stop - 1) // length
+        parts = [self.read_chunk(row, chunk)[
+            max(start - chunk * length, 0):
+            min(stop - chunk * length, length)]
+            for chunk in range(first, last + 1)]
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def read_trace(self, seed_id, starttime=None, endtime=None):
+        """
+        Like :meth:`read` but returns an :class:`~obspy.core.trace.Trace`.
+        """
+        from obspy import Trace, UTCDateTime
+        data = self.read(seed_id, starttime, endtime)
+        start = 0
+        if starttime is not None:
+            start = max(int(math.ceil(round(
+                (_to_ns(starttime) - self.starttime) *
+                self.sampling_rate / 1e9, 6))), 0)
+        net, sta, loc, cha = seed_id.split(".")
+        header = {"network": net, "station": sta, "location": loc,
+                  "channel": cha, "sampling_rate": self.sampling_rate,
+                  "starttime": UTCDateTime(ns=self.starttime + int(round(
+                      start * 1e9 / self.sampling_rate)))}
+        return Trace(data=data, header=header)
+
+
+class ArrayStore(object):
+    """
+    Zarr format 2 directory store holding one :class:`ChunkedArray` per
+    sampling rate.
+    :type path: str
+    :param path: Directory of the store.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.attrs = _read_json(os.path.join(path, ".zattrs"))
+        self.arrays = dict(
+            (name, ChunkedArray(os.path.join(path, name)))
+            for name in self.attrs.get("arrays", []))
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def _array_of(self, seed_id):
+        for array in self.arrays.values():
+            if seed_id in array.index:
+                return array
+        raise KeyError(seed_id)
+
+    @property
+    def channels(self):
+        return [meta["id"] for array in self.arrays.values()
+                for meta in array.channels]
+
+    def read(self, seed_id, starttime=None, endtime=None):
+        return self._array_of(seed_id).read(seed_id, starttime, endtime)
+
+    def read_trace(self, seed_id, starttime=None, endtime=None):
+        return self._array_of(seed_id).read_trace(seed_id, starttime,
+                                                  endtime)
+
+    def write_trace(self, trace):
+        self._array_of(trace.id).write_trace(trace)
+
+    @classmethod
+    def create(cls, path, channels, starttime, endtime,
+               chunk_length=DEFAULT_CHUNK_LENGTH, dtype="float32",
+               compression="zlib", level=1, fill_value=None, attrs=None):
+        """
+        Create an empty store.
+        :type channels: list
+        :param channels: ``(seed_id, sampling_rate, metadata)`` tuples,
+            ``metadata`` is a dictionary (e.g. from
+            :func:`channel_metadata`) or ``None``.
+        :type dtype: str
+        :param dtype: Sample type, e.g. ``"float32"`` or ``"int32"``.
+        :type compression: str
+        :param compression: ``"zlib"`` or ``None``. Only uncompressed
+            chunks can be memory mapped.
+        :type fill_value: float
+        :param fill_value: Value of samples without data, defaults to NaN
+            for floating point and 0 for integer types.
+        """
+        import numpy as np
+        dtype = np.dtype(dtype)
+        if fill_value is None:
+            fill_value = float("nan") if dtype.kind == "f" else 0
+        start_ns, end_ns = _to_ns(starttime), _to_ns(endtime)
+        by_rate = {}
+        for seed_id, sampling_rate, metadata in channels:
+            meta = dict(metadata or {})
+            meta["id"] = seed_id
+            by_rate.setdefault(float(sampling_rate), []).append(meta)
+        os.makedirs(path, exist_ok=True)
+        _write_json(os.path.join(path, ".zgroup"),
+                    {"zarr_format": ZARR_FORMAT})
+        names = []
+        for sampling_rate, metas in sorted(by_rate.items()):
+            name = array_name(sampling_rate)
+            names.append(name)
+            npts = int(math.ceil(round(
+                (end_ns - start_ns) * sampling_rate / 1e9, 6)))
+            directory = os.path.join(path, name)
+            os.makedirs(directory, exist_ok=True)
+            _write_json(os.path.join(directory, ".zarray"), {
+                "zarr_format": ZARR_FORMAT,
+                "shape": [len(metas), npts],
+                "chunks": [1, min(chunk_length, max(npts, 1))],
+                "dtype": dtype.str,
+                "compressor": {"id": "zlib", "level": level}
+                if compression == "zlib" else None,
+                "fill_value": "NaN" if isinstance(fill_value, float) and
+                math.isnan(fill_value) else fill_value,
+                "order": "C",
+                "filters": None,
+                "dimension_separator": "."})
+            _write_json(os.path.join(directory, ".zattrs"), {
+                "channels": sorted(metas, key=lambda m: m["id"]),
+                "sampling_rate": sampling_rate,
+                "starttime_ns": start_ns,
+                "starttime": _format_ns(start_ns),
+                "dimensions": ["channel", "time"]})
+        root_attrs = dict(attrs or {})
+        root_attrs["arrays"] = names
+        _write_json(os.path.join(path, ".zattrs"), root_attrs)
+        return cls(path)
+
+
+def _format_ns(ns):
+    from coverage import format_time
+    return format_time(ns)
+
+
+def export_waveforms(client, path, network, station, location, channel,
+                     starttime, endtime, chunk_duration=3600, workers=4,
+                     inventory=None, priority="batch", **kwargs):
+    """
+    Download waveforms window by window and write them into a new
+    :class:`ArrayStore`. Channels and metadata come from the station
+    service (or ``inventory``); each window is requested with
+    :meth:`~client.Client.iter_waveforms_batch` and the traces are written
+    by a pool of ``workers`` threads while the next window downloads.
+    Requests are queued with ``priority`` if the client has a scheduler.
+    Further keyword arguments go to :meth:`ArrayStore.create`.
+    A channel is exported at the sampling rate of its epoch at
+    ``starttime`` (or of its first epoch in the window), traces at another
+    rate are skipped with a warning.
+    :rtype: :class:`ArrayStore`
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from obspy import UTCDateTime
+    workers = client._resolve_workers(workers)
+    starttime, endtime = UTCDateTime(starttime), UTCDateTime(endtime)
+    if inventory is None:
+        inventory = client.get_stations(
+            network=network, station=station, location=location,
+            channel=channel, starttime=starttime, endtime=endtime,
+            level="response", priority=priority)
+    epochs = OrderedDict()
+    for net in inventory:
+        for sta in net:
+            for cha in sta:
+                if cha.sample_rate:
+                    seed_id = "%s.%s.%s.%s" % (net.code, sta.code,
+                                               cha.location_code, cha.code)
+                    epochs.setdefault(seed_id, []).append(cha)
+    channels = []
+    rates = {}
+    for seed_id, chas in epochs.items():
+        active = [cha for cha in chas if cha.is_active(time=starttime)]
+        rate = rates[seed_id] = float((active or chas)[0].sample_rate)
+        if any(float(cha.sample_rate) != rate for cha in chas):
+            msg = ("Sampling rate of %s changes within the window, only "
+                   "data at %g Hz is exported." % (seed_id, rate))
+            warnings.warn(msg)
+        channels.append((seed_id, rate, channel_metadata(
+            inventory, seed_id, time=starttime)))
+    store = ArrayStore.create(path, channels, starttime, endtime, **kwargs)
+
+    requests = []
+    t = starttime
+    while t < endtime:
+        t_end = min(t + chunk_duration, endtime)
+        for seed_id, _, _ in channels:
+            net, sta, loc, cha = seed_id.split(".")
+            requests.append((net, sta, loc or "--", cha, t, t_end))
+        t = t_end
+
+    with ThreadPoolExecutor(max_workers=workers) as writers:
+        pending = []
+        for _, st in client.iter_waveforms_batch(requests, workers=workers,
+                                                 priority=priority):
+            for tr in st:
+                if tr.id not in rates:
+                    continue
+                if not rate_matches(tr.stats.sampling_rate, rates[tr.id],
+                                    tr.stats.npts):
+                    msg = ("Skipped %s, sampled at %g Hz instead of %g Hz." %
+                           (tr, tr.stats.sampling_rate, rates[tr.id]))
+                    warnings.warn(msg)
+                    continue
+                pending.append(writers.submit(store.write_trace, tr))
+            # Surface write errors early and keep the queue short.
+            while len(pending) > 4 * workers:
+                pending.pop(0).result()
+        for future in pending:
+            future.result()
+    return store
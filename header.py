@@ -4,12 +4,26 @@ FDSN Web service client for TAPS.
 :copyright:
     The TAPS Development Team (dmc@earth.sinica.edu.tw)
 """
-import platform
-import sys
-
-from obspy import UTCDateTime
 version = '0.0.1'
 
+
+class _LazyUTCDateTime(object):
+    """
+    Stand-in for :class:`obspy.UTCDateTime` in the type tables below. ObsPy
+    is only imported once a value actually has to be converted.
+    """
+    __name__ = "UTCDateTime"
+
+    def __call__(self, *args, **kwargs):
+        from obspy import UTCDateTime
+        return UTCDateTime(*args, **kwargs)
+
+    def __repr__(self):
+        return "<class 'obspy.core.utcdatetime.UTCDateTime'>"
+
+
+UTCDateTime = _LazyUTCDateTime()
+
 class FDSNException(Exception):
     status_code = None
 
@@ -64,6 +78,10 @@ class FDSNTimeoutException(FDSNException):
     pass
 
 
+class FDSNDeadlineExceededException(FDSNTimeoutException):
+    pass
+
+
 class FDSNRedirectException(FDSNException):
     pass
 
@@ -86,17 +104,63 @@ class FDSNNoServiceException(FDSNException):
 # https://www.fdsn.org/webservices/datacenters/
 URL_MAPPINGS = {
     "TAPS": "https://taps.earth.sinica.edu.tw",
+    "BGR": "https://eida.bgr.de",
+    "ETH": "https://eida.ethz.ch",
+    "GEOFON": "https://geofon.gfz-potsdam.de",
+    "INGV": "https://webservices.ingv.it",
+    "IRIS": "https://service.iris.edu",
+    "NCEDC": "https://service.ncedc.org",
+    "ODC": "https://www.orfeus-eu.org",
+    "RESIF": "https://ws.resif.fr",
+    "SCEDC": "https://service.scedc.caltech.edu",
+    }
+
+# Major version of the services of the data centers in URL_MAPPINGS,
+# TAPS serves version 0, the standard FDSN web services version 1.
+URL_MAJOR_VERSIONS = {
+    "TAPS": 0,
+    "BGR": 1,
+    "ETH": 1,
+    "GEOFON": 1,
+    "INGV": 1,
+    "IRIS": 1,
+    "NCEDC": 1,
+    "ODC": 1,
+    "RESIF": 1,
+    "SCEDC": 1,
     }
 
 URL_DEFAULT_SUBPATH = '/fdsnws'
 
 FDSNWS = ("dataselect", "station")
 
-encoding = sys.getdefaultencoding() or "UTF-8"
-platform_ = platform.platform().encode(encoding).decode("ascii", "ignore")
-# The default User Agent that will be sent with every request.
-DEFAULT_USER_AGENT = "TAPSCliennnt/%s (%s, Python %s)" % (
-    version, platform_, platform.python_version())
+_DEFAULT_USER_AGENT = None
+
+
+def get_default_user_agent():
+    """
+    The default User Agent that will be sent with every request. Computed
+    on first use and built from :func:`platform.uname` only,
+    :func:`platform.platform` inspects the libc and takes milliseconds.
+    """
+    global _DEFAULT_USER_AGENT
+    if _DEFAULT_USER_AGENT is None:
+        import platform
+        import sys
+        encoding = sys.getdefaultencoding() or "UTF-8"
+        uname = platform.uname()
+        platform_ = "-".join((uname.system, uname.release, uname.machine))
+        platform_ = platform_.encode(encoding).decode("ascii", "ignore")
+        _DEFAULT_USER_AGENT = "TAPSCliennnt/%s (%s, Python %s)" % (
+            version, platform_, platform.python_version())
+    return _DEFAULT_USER_AGENT
+
+
+def __getattr__(name):
+    # Keep ``from header import DEFAULT_USER_AGENT`` working.
+    if name == "DEFAULT_USER_AGENT":
+        return get_default_user_agent()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
 PARAMETER_ALIASES = {
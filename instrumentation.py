@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Request and decode instrumentation for the TAPS client.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+Every :class:`~client.Client` owns an :class:`Instrumentation` object that
+receives an event for each HTTP request, token operation, decode step and
+response attachment::
+
+    >>> from client import Client
+    >>> client = Client("TAPS")
+    >>> def callback(event, data):
+    ...     print(event, data.get("duration"))
+    >>> client.instrumentation.subscribe(callback)
+    >>> client.instrumentation.get_stats()  # doctest: +SKIP
+    >>> print(client.instrumentation.to_prometheus())  # doctest: +SKIP
+"""
+import functools
+import http.client
+import socket
+import threading
+import time
+import urllib.request as urllib_request
+import warnings
+from contextlib import contextmanager
+
+# Numeric event fields that are not summed up in the aggregate stats.
+NOT_AGGREGATED = ("error", "status")
+
+
+class RequestTiming(object):
+    """
+    Timing breakdown of a single HTTP request. All times in seconds.
+    ``dns``, ``connect`` and ``tls`` stay ``None`` if the request did not
+    open a new connection or was not sent through a timing handler.
+    """
+    __slots__ = ("url", "method", "status", "error", "dns", "connect", "tls",
+                 "ttfb", "transfer", "duration", "bytes_wire",
+                 "bytes_decoded", "retries")
+
+    def __init__(self, url, method="GET"):
+        self.url = url
+        self.method = method
+        self.status = None
+        self.error = None
+        self.dns = None
+        self.connect = None
+        self.tls = None
+        self.ttfb = None
+        self.transfer = None
+        self.duration = None
+        self.bytes_wire = 0
+        self.bytes_decoded = 0
+        self.retries = 0
+
+    def as_dict(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__)
+
+    def __repr__(self):
+        return "RequestTiming(%s)" % ", ".join(
+            "%s=%r" % (key, getattr(self, key)) for key in self.__slots__)
+
+
+class Instrumentation(object):
+    """
+    Event hub and statistics aggregator.
+
+    Callbacks are called as ``callback(event, data)`` with the event name
+    (``"request"``, ``"token"``, ``"decode"``, ``"attach_responses"``) and a
+    dictionary of measurements. Exceptions raised by callbacks are turned
+    into warnings so that instrumentation can never break a request.
+    """
+    def __init__(self):
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def subscribe(self, callback):
+        """
+        Register a callable that is invoked for every event.
+        """
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._callbacks.remove(callback)
+
+    def emit(self, event, data):
+        """
+        Record an event in the aggregate stats and pass it to all
+        subscribers.
+        """
+        with self._lock:
+            self._aggregate(event, data)
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback(event, data)
+            except Exception as e:
+                warnings.warn("Instrumentation callback %r failed: %s" % (
+                    callback, e))
+
+    @contextmanager
+    def timer(self, event, **data):
+        """
+        Context manager emitting ``event`` with the wall clock ``duration``
+        of the block. The yielded dictionary can be filled with further
+        measurements. Failures are recorded with an ``error`` entry.
+        """
+        data["error"] = None
+        t0 = time.perf_counter()
+        try:
+            yield data
+        except Exception as e:
+            data["error"] = e.__class__.__name__
+            raise
+        finally:
+            data["duration"] = time.perf_counter() - t0
+            self.emit(event, data)
+
+    def _aggregate(self, event, data):
+        stats = self._stats.setdefault(event, {"count": 0, "errors": 0})
+        stats["count"] += 1
+        if data.get("error") is not None:
+            stats["errors"] += 1
+        for key, value in data.items():
+            if key in NOT_AGGREGATED or isinstance(value, bool) or \
+                    not isinstance(value, (int, float)):
+                continue
+            stats[key + "_sum"] = stats.get(key + "_sum", 0) + value
+            stats[key + "_max"] = max(stats.get(key + "_max", value), value)
+
+    def get_stats(self):
+        """
+        Return a copy of the aggregate statistics, a dictionary with one
+        entry per event name holding ``count``, ``errors`` and the sum and
+        maximum of every numeric measurement.
+        """
+        with self._lock:
+            return dict((event, dict(stats))
+                        for event, stats in self._stats.items())
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def to_prometheus(self, prefix="tapsclient"):
+        """
+        Export the aggregate statistics in the Prometheus text exposition
+        format.
+        """
+        lines = []
+        for event, stats in sorted(self.get_stats().items()):
+            for key, value in sorted(stats.items()):
+                lines.append('%s_%s{event="%s"} %s' % (
+                    prefix, key, event, repr(float(value))))
+        return "\n".join(lines)
+
+
+def _timed_create_connection(timing, address, timeout=None,
+                             source_address=None, **kwargs):
+    """
+    Replacement of :func:`socket.create_connection` measuring name
+    resolution and TCP connect separately.
+    """
+    host, port = address
+    t0 = time.perf_counter()
+    infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    t1 = time.perf_counter()
+    timing.dns = t1 - t0
+    err = None
+    for family, type_, proto, _, sockaddr in infos:
+        sock = None
+        try:
+            sock = socket.socket(family, type_, proto)
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            timing.connect = time.perf_counter() - t1
+            return sock
+        except OSError as e:
+            err = e
+            if sock is not None:
+                sock.close()
+    if err is not None:
+        raise err
+    raise OSError("getaddrinfo returns an empty list")
+
+
+class _TimingConnectionMixin(object):
+    def __init__(self, *args, **kwargs):
+        self._timing = kwargs.pop("timing", None)
+        super(_TimingConnectionMixin, self).__init__(*args, **kwargs)
+        if self._timing is not None:
+            self._create_connection = functools.partial(
+                _timed_create_connection, self._timing)
+
+    def connect(self):
+        t0 = time.perf_counter()
+        super(_TimingConnectionMixin, self).connect()
+        timing = self._timing
+        if timing is not None and \
+                isinstance(self, http.client.HTTPSConnection):
+            timing.tls = time.perf_counter() - t0 - (timing.dns or 0) - \
+                (timing.connect or 0)
+
+
+class TimingHTTPConnection(_TimingConnectionMixin,
+                           http.client.HTTPConnection):
+    pass
+
+
+class TimingHTTPSConnection(_TimingConnectionMixin,
+                            http.client.HTTPSConnection):
+    pass
+
+
+class TimingHTTPHandler(urllib_request.HTTPHandler):
+    """
+    HTTP handler filling the :class:`RequestTiming` attached to a request
+    as ``request.timing``.
+    """
+    def http_open(self, req):
+        return self.do_open(functools.partial(
+            TimingHTTPConnection, timing=getattr(req, "timing", None)), req)
+
+
+class TimingHTTPSHandler(urllib_request.HTTPSHandler):
+    """
+    HTTPS handler filling the :class:`RequestTiming` attached to a request
+    as ``request.timing``.
+    """
+    def https_open(self, req):
+        return self.do_open(functools.partial(
+            TimingHTTPSConnection, timing=getattr(req, "timing", None)), req,
+            context=self._context)
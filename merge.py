@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Merging of chunked and multi-source waveform results.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+:func:`merge_traces` stitches the segments of each channel (e.g. the
+results of chunked, retried or federated downloads) into one trace. The
+sample grid of a channel is computed once from all segments, the output
+array is allocated once and every segment is copied into it exactly once,
+so merging stays linear in the number of samples where
+:meth:`~obspy.core.stream.Stream.merge` concatenates pair by pair::
+
+    >>> chunks = [client.get_waveforms("TW", "NSE01", "--", "EHZ",
+    ...                                t + 60 * i, t + 60 * (i + 1))
+    ...           for i in range(1440)]  # doctest: +SKIP
+    >>> st = merge_traces([tr for st in chunks for tr in st],
+    ...                   fill_value=0)  # doctest: +SKIP
+"""
+import warnings
+from collections import OrderedDict
+
+# How overlapping samples are resolved.
+OVERLAP_METHODS = ("first", "last")
+
+
+def _group_key(tr):
+    return (tr.id, float(tr.stats.sampling_rate))
+
+
+def merge_traces(traces, method="first", fill_value=None):
+    """
+    Merge the traces of each channel and sampling rate into one trace.
+    Segments are placed on the sample grid of the earliest segment of the
+    channel (snapped to the nearest sample) and the metadata of that
+    segment is kept.
+    :type traces: :class:`~obspy.core.stream.Stream` or list
+    :param traces: Segments in the order they were received.
+    :type method: str
+    :param method: Which segment wins where segments overlap, the
+        ``"first"`` or the ``"last"`` received one. For segments in time
+        order ``"last"`` gives the result of
+        ``Stream.merge(method=1)``, ``"first"`` keeps the data received
+        first instead.
+    :type fill_value: int, float, str or None
+    :param fill_value: Value of samples in gaps and of masked samples of
+        the segments, ``"interpolate"`` to interpolate linearly between
+        the samples next to them, or ``None`` to return a masked array
+        for channels with missing samples (as
+        :meth:`~obspy.core.stream.Stream.merge` does). Missing samples at
+        the start or end cannot be interpolated and stay masked.
+    :rtype: :class:`~obspy.core.stream.Stream`
+    :returns: One trace per channel and sampling rate, in the order the
+        channels first appear.
+    """
+    from obspy import Stream
+    if method not in OVERLAP_METHODS:
+        msg = "method must be one of %s, got '%s'." % (
+            ", ".join(OVERLAP_METHODS), method)
+        raise ValueError(msg)
+    groups = OrderedDict()
+    for tr in traces:
+        if tr.stats.npts:
+            groups.setdefault(_group_key(tr), []).append(tr)
+    merged = Stream()
+    for segments in groups.values():
+        if len(segments) == 1:
+            merged.append(segments[0])
+        else:
+            merged.append(_merge_segments(segments, method, fill_value))
+    return merged
+
+
+def _merge_segments(segments, method, fill_value):
+    import numpy as np
+    from obspy import Trace, UTCDateTime
+    sampling_rate = segments[0].stats.sampling_rate
+    starts = np.array([tr.stats.starttime.ns for tr in segments],
+                      dtype=np.int64)
+    lengths = np.array([len(tr.data) for tr in segments], dtype=np.int64)
+    first = int(np.argmin(starts))
+    offsets = np.rint((starts - starts[first]) * (sampling_rate / 1e9))
+    offsets = offsets.astype(np.int64)
+    ends = offsets + lengths
+    dtype = np.result_type(*[tr.data.dtype for tr in segments])
+    masked = [np.ma.is_masked(tr.data) for tr in segments]
+
+    # Every segment is copied once, for "first" the earlier segments are
+    # written last so they overwrite the later ones.
+    data = np.empty(int(ends.max()), dtype=dtype)
+    order = range(len(segments))
+    if method == "first":
+        order = reversed(order)
+    if any(masked):
+        # Masked samples are missing data, they never replace samples of
+        # another segment.
+        missing = np.ones(len(data), dtype=bool)
+        for i in order:
+            target = data[offsets[i]:ends[i]]
+            if masked[i]:
+                valid = ~np.ma.getmaskarray(segments[i].data)
+                target[valid] = np.ma.getdata(segments[i].data)[valid]
+                missing[offsets[i]:ends[i]] &= ~valid
+            else:
+                target[:] = segments[i].data
+                missing[offsets[i]:ends[i]] = False
+    else:
+        for i in order:
+            data[offsets[i]:ends[i]] = segments[i].data
+        # Gaps are the holes between the running maximum of the segment
+        # ends and the next segment start.
+        missing = None
+        index = np.argsort(offsets, kind="stable")
+        covered = np.maximum.accumulate(ends[index])[:-1]
+        following = offsets[index][1:]
+        holes = following > covered
+        if holes.any():
+            missing = np.zeros(len(data), dtype=bool)
+            for start, end in zip(covered[holes].tolist(),
+                                  following[holes].tolist()):
+                missing[start:end] = True
+
+    if missing is not None and missing.any():
+        if fill_value is None:
+            data = np.ma.masked_array(data, mask=missing)
+        elif fill_value == "interpolate":
+            edges = np.flatnonzero(np.diff(np.concatenate((
+                [0], missing.view(np.int8), [0]))))
+            for start, end in zip(edges[0::2].tolist(),
+                                  edges[1::2].tolist()):
+                if start == 0 or end == len(data):
+                    continue
+                data[start:end] = np.linspace(
+                    data[start - 1], data[end], end - start + 2)[1:-1]
+                missing[start:end] = False
+            if missing.any():
+                data = np.ma.masked_array(data, mask=missing)
+        else:
+            if np.issubdtype(dtype, np.integer) and \
+                    float(fill_value) != int(fill_value):
+                data = data.astype(np.float64)
+            data[missing] = fill_value
+
+    stats = segments[first].stats.copy()
+    stats.starttime = UTCDateTime(ns=int(starts[first]))
+    stats.npts = len(data)
+    misaligned = np.abs((starts - starts[first]) * (sampling_rate / 1e9) -
+                        offsets).max()
+    if misaligned > 0.01:
+        msg = ("Segments of %s are not on a common sample grid, shifted by "
+               "up to %.2f samples." % (segments[0].id, misaligned))
+        warnings.warn(msg)
+    stats.processing = list(stats.get("processing", [])) + [
+        "merge:merge_traces(method=%r, fill_value=%r, segments=%d)" % (
+            method, fill_value, len(segments))]
+    return Trace(data=data, header=stats)
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Random access to local MiniSEED files through memory maps.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+An :class:`MSeedIndex` memory maps MiniSEED files (e.g. the day files of
+the bulk downloader), builds a record index per channel from the record
+headers (see :func:`~coverage.scan_table`) and decodes only the records
+overlapping a requested window, straight from the mapped pages. Small
+windows of large files are cheap to read repeatedly and the file is never
+read as a whole::
+
+    >>> index = MSeedIndex(["data/TW/NSE01"])  # doctest: +SKIP
+    >>> index.channels  # doctest: +SKIP
+    ['TW.NSE01..EHE', 'TW.NSE01..EHN', 'TW.NSE01..EHZ']
+    >>> st = index.read("TW.NSE01..EH?", t + 3600, t + 3660)  # doctest: +SKIP
+"""
+import fnmatch
+import glob
+import mmap
+import os
+import threading
+
+from coverage import RecordTable, scan_table
+from merge import merge_traces
+
+# File name patterns indexed when a directory is given.
+MSEED_PATTERNS = ("*.mseed", "*.msd", "*.miniseed")
+
+
+def _expand(source):
+    if os.path.isdir(source):
+        paths = []
+        for root, _, files in os.walk(source):
+            for pattern in MSEED_PATTERNS:
+                paths.extend(os.path.join(root, name) for name in
+                             fnmatch.filter(files, pattern))
+        return sorted(paths)
+    if glob.has_magic(source):
+        return sorted(glob.glob(source))
+    return [source]
+
+
+def _to_ns(t):
+    if t is None:
+        return None
+    if not hasattr(t, "ns"):
+        from obspy import UTCDateTime
+        t = UTCDateTime(t)
+    return t.ns
+
+
+class _MappedFile(object):
+    __slots__ = ("path", "buffer", "data", "table")
+
+    def __init__(self, path):
+        import numpy as np
+        self.path = path
+        with open(path, "rb") as fh:
+            self.buffer = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(self.buffer, "madvise"):
+            # Reads jump around the file, read ahead would only fill the
+            # page cache with records nobody asked for.
+            self.buffer.madvise(mmap.MADV_RANDOM)
+        self.data = np.frombuffer(self.buffer, dtype=np.int8)
+        self.table = scan_table(self.buffer)
+
+    def close(self):
+        self.data = None
+        try:
+            self.buffer.close()
+        except BufferError:
+            # Still referenced by decoded views, closed when collected.
+            pass
+
+
+class MSeedIndex(object):
+    """
+    Record index of memory mapped MiniSEED files.
+    :type sources: list of str
+    :param sources: File names, glob patterns or directories (searched
+        recursively for :data:`MSEED_PATTERNS`).
+    """
+    def __init__(self, sources=()):
+        if isinstance(sources, str):
+            sources = [sources]
+        self._files = []
+        self._paths = set()
+        self._lock = threading.Lock()
+        self._channels = None
+        for source in sources:
+            self.add(source)
+
+    def __repr__(self):
+        return "MSeedIndex(files=%d, channels=%d)" % (
+            len(self._files), len(self._channel_index()))
+
+    def __len__(self):
+        return len(self._files)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, source):
+        """
+        Map and index a file (or all files of a glob pattern or directory),
+        files already in the index are skipped.
+        """
+        for path in _expand(source):
+            path = os.path.abspath(path)
+            if path in self._paths or not os.path.getsize(path):
+                continue
+            mapped = _MappedFile(path)
+            with self._lock:
+                self._files.append(mapped)
+                self._paths.add(path)
+                self._channels = None
+
+    def close(self):
+        with self._lock:
+            for mapped in self._files:
+                mapped.close()
+            self._files = []
+            self._paths = set()
+            self._channels = None
+
+    @property
+    def channels(self):
+        return sorted(self._channel_index())
+
+    @property
+    def table(self):
+        """
+        :class:`~coverage.RecordTable` of all records, e.g. for a
+        :class:`~coverage.Coverage` report.
+        """
+        return RecordTable.concatenate([f.table for f in self._files])
+
+    def _channel_index(self):
+        """
+        ``{seed_id: (file, offset, reclen, start, end, reach)}`` arrays
+        sorted by record start, ``end`` is the expected start of the next
+        record and ``reach`` the running maximum of ``end``.
+        """
+        import numpy as np
+        with self._lock:
+            if self._channels is not None:
+                return self._channels
+            parts = {}
+            for number, mapped in enumerate(self._files):
+                table = mapped.table
+                if not len(table):
+                    continue
+                ends = table.next_starttime
+                order = np.argsort(table.channel, kind="stable")
+                bounds = np.searchsorted(table.channel[order],
+                                         np.arange(len(table.ids) + 1))
+                for i, seed_id in enumerate(table.ids):
+                    rows = order[bounds[i]:bounds[i + 1]]
+                    parts.setdefault(seed_id, []).append((
+                        np.full(len(rows), number, dtype=np.int64),
+                        table.offset[rows], table.reclen[rows],
+                        table.starttime[rows], ends[rows]))
+            channels = {}
+            for seed_id, columns in parts.items():
+                columns = [np.concatenate(column) for column in zip(*columns)]
+                order = np.argsort(columns[3], kind="stable")
+                columns = [column[order] for column in columns]
+                columns.append(np.maximum.accumulate(columns[4]))
+                channels[seed_id] = tuple(columns)
+            self._channels = channels
+            return channels
+
+    def select(self, seed_id):
+        """
+        SEED ids of the index matching ``seed_id`` (wildcards allowed).
+        """
+        return [cha for cha in self.channels
+                if fnmatch.fnmatchcase(cha, seed_id)]
+
+    def records(self, seed_id, starttime=None, endtime=None):
+        """
+        Records of a channel overlapping the window as list of
+        ``(path, offset, reclen)`` in time order.
+        """
+        return [(self._files[number].path, offset, reclen)
+                for number, offset, reclen in self._find(seed_id, starttime,
+                                                         endtime)]
+
+    def _find(self, seed_id, starttime, endtime):
+        import numpy as np
+        try:
+            files, offsets, reclens, starts, ends, reach = \
+                self._channel_index()[seed_id]
+        except KeyError:
+            return []
+        t0, t1 = _to_ns(starttime), _to_ns(endtime)
+        lo = 0 if t0 is None else int(np.searchsorted(reach, t0,
+                                                      side="right"))
+        hi = len(starts) if t1 is None else int(np.searchsorted(
+            starts, t1, side="right"))
+        rows = np.arange(lo, hi)
+        if t0 is not None:
+            rows = rows[ends[rows] > t0]
+        return list(zip(files[rows].tolist(), offsets[rows].tolist(),
+                        reclens[rows].tolist()))
+
+    def _buffer(self, records):
+        """
+        The records in time order as one buffer: a view into the mapped
+        file if they are adjacent there, otherwise a copy of just these
+        records (e.g. of multiplexed or several files).
+        """
+        import numpy as np
+        runs = []
+        for number, offset, reclen in records:
+            if runs and runs[-1][0] == number and runs[-1][2] == offset:
+                runs[-1][2] = offset + reclen
+            else:
+                runs.append([number, offset, offset + reclen])
+        views = [self._files[number].data[start:end]
+                 for number, start, end in runs]
+        if len(views) == 1:
+            return views[0]
+        return np.concatenate(views)
+
+    def read(self, seed_id, starttime=None, endtime=None, merge=True):
+        """
+        Decode the data of all channels matching ``seed_id`` (wildcards
+        allowed) in the window. Only the records overlapping the window
+        are decoded.
+        :type merge: bool
+        :param merge: Merge the records of each channel with
+            :func:`~merge.merge_traces` (gaps masked) instead of returning
+            the contiguous segments.
+        :rtype: :class:`~obspy.core.stream.Stream`
+        """
+        from obspy import Stream, UTCDateTime
+        from obspy.io.mseed.core import _read_mseed
+        st = Stream()
+        for cha in self.select(seed_id):
+            records = self._find(cha, starttime, endtime)
+            if not records:
+                continue
+            part = _read_mseed(self._buffer(records))
+            if merge and len(part) > 1:
+                part.sort(keys=["starttime"])
+                part = merge_traces(part)
+            st += part
+        st.trim(UTCDateTime(starttime) if starttime is not None else None,
+                UTCDateTime(endtime) if endtime is not None else None)
+        return st
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Query planner coalescing many fine grained waveform requests into few
+dataselect queries.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+Requests for the same time window and network are merged into queries
+using comma separated station, location and channel lists. Stations are
+only merged if they ask for exactly the same locations and channels and
+every query is a full cross product of its lists, so no data is fetched
+that was not asked for. The returned traces are then handed back to the
+original requests::
+
+    >>> reqs = [WaveformRequest("TW", sta, "", cha, 0, 60)
+    ...         for sta in ("NSE01", "NSE02") for cha in ("EHZ", "EHN")]
+    >>> for query in plan_waveform_requests(reqs):
+    ...     print(query)
+    TW NSE01,NSE02 -- EHN,EHZ 0-60 (4 requests)
+"""
+import fnmatch
+from collections import OrderedDict, namedtuple
+
+# Upper limit of channels (stations x locations x channels) per query.
+DEFAULT_MAX_ITEMS = 120
+# Upper limit of the length of the station/location/channel lists of a
+# query, keeps URLs well below common server limits.
+DEFAULT_MAX_LIST_LENGTH = 1500
+
+
+class WaveformRequest(namedtuple("WaveformRequest", [
+        "network", "station", "location", "channel", "starttime",
+        "endtime"])):
+    """
+    A single logical waveform request, arguments as for
+    :meth:`~client.Client.get_waveforms`.
+    """
+    __slots__ = ()
+
+    def matches(self, trace):
+        """
+        True if the trace belongs to this request. ``None`` matches any
+        code, as an omitted parameter of the query does.
+        """
+        stats = trace.stats
+        return (_match(stats.network, self.network) and
+                _match(stats.station, self.station) and
+                _match(stats.location, self.location) and
+                _match(stats.channel, self.channel))
+
+
+def _match(code, pattern):
+    if pattern is None:
+        return True
+    for pat in pattern.split(","):
+        pat = pat.strip()
+        if pat == "--":
+            pat = ""
+        if code == pat or fnmatch.fnmatchcase(code, pat):
+            return True
+    return False
+
+
+class PlannedQuery(object):
+    """
+    One dataselect query serving the requests at the indices ``members``.
+    """
+    __slots__ = ("network", "station", "location", "channel", "starttime",
+                 "endtime", "members")
+
+    def __init__(self, network, station, location, channel, starttime,
+                 endtime, members):
+        self.network = network
+        self.station = station
+        self.location = location
+        self.channel = channel
+        self.starttime = starttime
+        self.endtime = endtime
+        self.members = members
+
+    def __str__(self):
+        return "%s %s %s %s %s-%s (%d requests)" % (
+            self.network, self.station, self.location, self.channel,
+            self.starttime, self.endtime, len(self.members))
+
+    def __repr__(self):
+        return "PlannedQuery(%s)" % str(self)
+
+
+def _time_key(t):
+    # UTCDateTime is not hashable, use its nanosecond timestamp.
+    return getattr(t, "ns", t)
+
+
+def _location_code(location):
+    # Like an omitted location parameter, None asks for any location.
+    if location is None:
+        return "*"
+    location = location.strip()
+    return "--" if location in ("", "--") else location
+
+
+def plan_waveform_requests(requests, max_items=DEFAULT_MAX_ITEMS,
+                           max_list_length=DEFAULT_MAX_LIST_LENGTH):
+    """
+    Group requests into as few queries as possible.
+    :type requests: list of :class:`WaveformRequest`
+    :param requests: The logical requests.
+    :type max_items: int
+    :param max_items: Maximum number of station/location/channel
+        combinations per query.
+    :type max_list_length: int
+    :param max_list_length: Maximum length of the comma separated station
+        list of a query.
+    :rtype: list of :class:`PlannedQuery`
+    """
+    # (starttime, endtime, network) -> station -> location -> {channel: [i]}
+    windows = OrderedDict()
+    times = {}
+    for i, req in enumerate(requests):
+        key = (_time_key(req.starttime), _time_key(req.endtime),
+               req.network)
+        times.setdefault(key, (req.starttime, req.endtime))
+        locations = windows.setdefault(key, OrderedDict()).setdefault(
+            req.station, OrderedDict())
+        locations.setdefault(_location_code(req.location), OrderedDict()) \
+            .setdefault(req.channel, []).append(i)
+
+    queries = []
+    for key, stations in windows.items():
+        starttime, endtime = times[key]
+        network = key[2]
+        # Stations requesting the same cross product of locations and
+        # channels can share a query.
+        groups = OrderedDict()
+        for station, locations in stations.items():
+            channel_sets = set(tuple(sorted(channels))
+                               for channels in locations.values())
+            if len(channel_sets) == 1:
+                signatures = [(tuple(sorted(locations)),
+                               channel_sets.pop())]
+            else:
+                signatures = [((loc,), tuple(sorted(channels)))
+                              for loc, channels in locations.items()]
+            for signature in signatures:
+                members = [i for loc in signature[0]
+                           for cha in signature[1]
+                           for i in locations[loc][cha]]
+                groups.setdefault(signature, []).append((station, members))
+
+        for (locs, chas), members_by_station in groups.items():
+            per_station = max(len(locs) * len(chas), 1)
+            max_stations = max(max_items // per_station, 1)
+            chunk, chunk_length = [], 0
+            for station, members in members_by_station:
+                if chunk and (len(chunk) >= max_stations or
+                              chunk_length + len(station) + 1 >
+                              max_list_length):
+                    queries.append(_make_query(network, chunk, locs, chas,
+                                               starttime, endtime))
+                    chunk, chunk_length = [], 0
+                chunk.append((station, members))
+                chunk_length += len(station) + 1
+            if chunk:
+                queries.append(_make_query(network, chunk, locs, chas,
+                                           starttime, endtime))
+    return queries
+
+
+def _make_query(network, chunk, locations, channels, starttime, endtime):
+    members = sorted(i for _, station_members in chunk
+                     for i in station_members)
+    return PlannedQuery(network, ",".join(station for station, _ in chunk),
+                        ",".join(locations), ",".join(channels), starttime,
+                        endtime, members)
+
+
+def demultiplex(stream, query, requests):
+    """
+    Distribute the traces returned for a planned query to the requests it
+    serves. Returns a dictionary mapping request index to
+    :class:`~obspy.core.stream.Stream`. Traces matching more than one
+    request (e.g. duplicate requests) are copied.
+    """
+    from obspy import Stream
+    result = dict((i, Stream()) for i in query.members)
+    for tr in stream:
+        owners = [i for i in query.members if requests[i].matches(tr)]
+        for n, i in enumerate(owners):
+            result[i].append(tr if n == 0 else tr.copy())
+    return result
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Canonical, immutable FDSN web service queries.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+A :class:`Query` resolves parameter aliases, converts and validates all
+values once and stores them in canonical form. Equivalent queries compare
+equal, hash equal and produce the same URL regardless of parameter order,
+time precision or empty location spelling::
+
+    >>> from obspy import UTCDateTime
+    >>> q1 = Query("dataselect", net="TW", sta="NSE01", loc="",
+    ...            cha="EHZ", starttime=UTCDateTime(2008, 4, 16),
+    ...            endtime="2008-04-16T01:00:00")
+    >>> q2 = Query("dataselect", channel="EHZ", location="--",
+    ...            endtime=UTCDateTime(2008, 4, 16, 1), network="TW",
+    ...            station="NSE01", starttime="2008-04-16")
+    >>> q1 == q2, hash(q1) == hash(q2)
+    (True, True)
+    >>> print(q1.query_string)  # doctest: +NORMALIZE_WHITESPACE
+    starttime=2008-04-16T00:00:00.000000&endtime=2008-04-16T01:00:00.000000&network=TW&station=NSE01&location=--&channel=EHZ
+    >>> print(q1.post_line())
+    TW NSE01 -- EHZ 2008-04-16T00:00:00.000000 2008-04-16T01:00:00.000000
+"""
+import datetime
+import re
+import warnings
+from urllib.parse import quote_plus
+
+from header import (DEFAULT_PARAMETERS, DEFAULT_SERVICES, OPTIONAL_PARAMETERS,
+                    PARAMETER_ALIASES, WADL_PARAMETERS_NOT_TO_BE_PARSED)
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+_NO_QUOTING = re.compile(r"^[A-Za-z0-9_.\-~:,*]*$")
+
+
+def canonical_time(value):
+    """
+    Canonical string of a point in time, microsecond precision without
+    time zone designator as expected by the FDSN web services.
+    >>> print(canonical_time("2012-01-02T03:04:05.6666666"))
+    2012-01-02T03:04:05.666667
+    """
+    from obspy import UTCDateTime
+    if not isinstance(value, UTCDateTime):
+        value = UTCDateTime(value)
+    seconds, rest = divmod(value.ns, 1000000000)
+    microseconds = (rest + 500) // 1000
+    if microseconds == 1000000:
+        seconds, microseconds = seconds + 1, 0
+    dt = _EPOCH + datetime.timedelta(seconds=seconds)
+    return "%04d-%02d-%02dT%02d:%02d:%02d.%06d" % (
+        dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second,
+        microseconds)
+
+
+def canonical_location(value):
+    """
+    Canonical location code (list), empty codes are spelled ``--``.
+    >>> print(canonical_location(" ,00, ,10,"))
+    --,00,--,10,--
+    """
+    codes = [code.strip() for code in value.split(",")]
+    return ",".join(code if code else "--" for code in codes)
+
+
+def _to_str(value):
+    try:
+        value = value.decode()
+    except AttributeError:
+        pass
+    return str(value).strip()
+
+
+def _to_bool(value):
+    return "true" if bool(value) else "false"
+
+
+def _to_float(value):
+    return str(float(value))
+
+
+def _to_int(value):
+    return str(int(value))
+
+
+def _converter(name, this_type):
+    if name == "location":
+        return lambda value: canonical_location(_to_str(value))
+    if this_type is str:
+        return _to_str
+    if this_type is bool:
+        return _to_bool
+    if this_type is float:
+        return _to_float
+    if this_type is int:
+        return _to_int
+    # UTCDateTime
+    return canonical_time
+
+
+def _compile(service):
+    """
+    Parameter order and converters of a service, computed once per process.
+    """
+    order = []
+    for param in DEFAULT_PARAMETERS[service] + OPTIONAL_PARAMETERS[service]:
+        if param not in order:
+            order.append(param)
+    converters = dict(
+        (name, _converter(name, spec["type"]))
+        for name, spec in DEFAULT_SERVICES[service].items())
+    return dict((name, i) for i, name in enumerate(order)), converters
+
+
+_COMPILED = {}
+
+
+def _compiled(service):
+    try:
+        return _COMPILED[service]
+    except KeyError:
+        if service not in DEFAULT_SERVICES:
+            msg = "Service '%s' is not a valid FDSN web service." % service
+            raise ValueError(msg)
+        _COMPILED[service] = _compile(service)
+        return _COMPILED[service]
+
+
+class Query(object):
+    """
+    Immutable, normalized query of the ``dataselect`` or ``station``
+    service. Parameters and aliases are the ones accepted by
+    :meth:`~client.Client.get_waveforms` and
+    :meth:`~client.Client.get_stations`, ``None`` values are dropped.
+    """
+    __slots__ = ("service", "items", "_hash", "_query_string")
+
+    def __init__(self, service, **parameters):
+        order, converters = _compiled(service)
+        canonical = {}
+        for key, value in parameters.items():
+            if value is None:
+                continue
+            key = PARAMETER_ALIASES.get(key, key)
+            if key not in converters:
+                if key in WADL_PARAMETERS_NOT_TO_BE_PARSED:
+                    msg = ("The parameter '%s' is ignored because it is not "
+                           "useful within ObsPy")
+                    warnings.warn(msg % key)
+                    continue
+                msg = "The parameter '%s' is not supported by the service." \
+                    % key
+                raise TypeError(msg)
+            if key in canonical:
+                msg = ("two parameters were provided for the same option: "
+                       "%s" % key)
+                raise TypeError(msg)
+            try:
+                canonical[key] = converters[key](value)
+            except Exception:
+                msg = "'%s' could not be converted to type '%s'." % (
+                    str(value), DEFAULT_SERVICES[service][key]["type"]
+                    .__name__)
+                raise TypeError(msg)
+        items = tuple(sorted(canonical.items(),
+                             key=lambda item: order.get(item[0], 0)))
+        object.__setattr__(self, "service", service)
+        object.__setattr__(self, "items", items)
+        object.__setattr__(self, "_hash", hash((service, items)))
+        object.__setattr__(self, "_query_string", None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Query objects are immutable.")
+
+    def __reduce__(self):
+        return (_restore_query, (self.service, self.items))
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, Query):
+            return NotImplemented
+        return self._hash == other._hash and \
+            self.service == other.service and self.items == other.items
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return "Query(%r, %s)" % (self.service, ", ".join(
+            "%s=%r" % item for item in self.items))
+
+    def __getitem__(self, key):
+        key = PARAMETER_ALIASES.get(key, key)
+        for name, value in self.items:
+            if name == key:
+                return value
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def parameters(self):
+        """
+        The canonical parameters as a new dictionary.
+        """
+        return dict(self.items)
+
+    def replace(self, **parameters):
+        """
+        Return a new query with some parameters replaced (or removed when
+        set to ``None``).
+        """
+        new = dict(self.items)
+        for key, value in parameters.items():
+            new[PARAMETER_ALIASES.get(key, key)] = value
+        return Query(self.service, **new)
+
+    @property
+    def query_string(self):
+        """
+        The URL encoded parameters, computed once.
+        """
+        if self._query_string is None:
+            # Same result as urlencode(self.items, safe=':,*') but values
+            # that need no quoting (almost all of them) are used as is.
+            object.__setattr__(self, "_query_string", "&".join(
+                key + "=" + (value if _NO_QUOTING.match(value)
+                             else quote_plus(value, safe=':,*'))
+                for key, value in self.items))
+        return self._query_string
+
+    def url(self, prefix):
+        """
+        Full query URL below ``prefix``, e.g.
+        ``https://taps.earth.sinica.edu.tw/fdsnws/dataselect/0/query``.
+        """
+        if not self.items:
+            return prefix
+        return prefix + "?" + self.query_string
+
+    def post_line(self):
+        """
+        The query as a line of a POST bulk request,
+        ``NET STA LOC CHA STARTTIME ENDTIME``.
+        """
+        values = dict(self.items)
+        return " ".join(values.get(key, "*") for key in (
+            "network", "station", "location", "channel", "starttime",
+            "endtime"))
+
+
+def _restore_query(service, items):
+    return Query(service, **dict(items))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Request rate limiting.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+A :class:`RateLimiter` is a token bucket shared by all threads of a client.
+Each request takes one token, tokens are refilled at ``rate`` per second up
+to ``burst``::
+
+    >>> limiter = RateLimiter(10, burst=2)
+    >>> limiter.acquire(), limiter.acquire()
+    (0.0, 0.0)
+"""
+import threading
+import time
+
+
+class RateLimiter(object):
+    """
+    Thread safe token bucket.
+    :type rate: float
+    :param rate: Requests per second.
+    :type burst: int
+    :param burst: Number of requests that may be sent at once after a
+        quiet period, defaults to one second worth of requests.
+    """
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive.")
+        self.rate = float(rate)
+        self.burst = max(int(burst if burst is not None else rate), 1)
+        self._init_state()
+
+    def _init_state(self):
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self.waited = 0.0
+
+    def __getstate__(self):
+        # Rate limits are per process, only the configuration is pickled.
+        return {"rate": self.rate, "burst": self.burst}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def __repr__(self):
+        return "RateLimiter(rate=%s, burst=%d)" % (self.rate, self.burst)
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available. Returns the time
+        waited in seconds.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._tokens + (now - self._updated) *
+                               self.rate, self.burst)
+            self._updated = now
+            # Tokens may go negative, later callers queue up behind.
+            self._tokens -= 1.0
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.waited += wait
+        if wait:
+            time.sleep(wait)
+        return wait
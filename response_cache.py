@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+Cached instrument response spectra and batched response removal.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+Evaluating the response stage chain of a channel is the expensive part of
+:meth:`obspy.core.trace.Trace.remove_response`. A :class:`ResponseCache`
+keeps the deconvolution filter (inverted complex response, water level and
+pre-filter applied) per channel, response content, sampling rate, FFT
+length and output unit in a bounded LRU cache, optionally persisted to a
+directory. :meth:`ResponseCache.remove_response` removes the response of
+many traces at once, windows of the same channel, response and length
+share one filter and one batched FFT::
+
+    >>> cache = ResponseCache(maxsize=512)
+    >>> st = client.get_waveforms("TW", "NSE01", "", "EHZ", t,
+    ...                           t + 3600)  # doctest: +SKIP
+    >>> windows = [tr.slice(t + 60 * i, t + 60 * (i + 1))
+    ...            for i in range(60) for tr in st]  # doctest: +SKIP
+    >>> cache.remove_response(windows, inventory=inv, output="VEL",
+    ...                       pre_filt=(0.01, 0.02, 40, 45),
+    ...                       )  # doctest: +SKIP
+"""
+import hashlib
+import os
+import threading
+import warnings
+from collections import OrderedDict
+
+# Number of filters kept in memory.
+DEFAULT_MAXSIZE = 256
+
+
+# Descriptive attributes of responses and stages, not part of the
+# fingerprint.
+_DESCRIPTIVE = ("resource_id", "resource_id2", "description", "name",
+                "input_units_description", "output_units_description")
+
+
+def _time_ns(t):
+    return None if t is None else t.ns
+
+
+def _feed(digest, obj):
+    if isinstance(obj, float):
+        digest.update(float.__repr__(obj).encode())
+    elif isinstance(obj, complex):
+        digest.update(complex.__repr__(obj).encode())
+    elif obj is None or isinstance(obj, (bool, int, str, bytes)):
+        digest.update(repr(obj).encode())
+    elif isinstance(obj, (list, tuple)):
+        digest.update(b"[")
+        for item in obj:
+            _feed(digest, item)
+            digest.update(b",")
+        digest.update(b"]")
+    elif hasattr(obj, "tobytes"):
+        digest.update(str(obj.dtype).encode())
+        digest.update(obj.tobytes())
+    elif hasattr(obj, "__dict__"):
+        digest.update(type(obj).__name__.encode())
+        digest.update(b"{")
+        for key, value in sorted(vars(obj).items()):
+            if key.lstrip("_") in _DESCRIPTIVE:
+                continue
+            digest.update(key.encode())
+            _feed(digest, value)
+        digest.update(b"}")
+    else:
+        digest.update(repr(obj).encode())
+
+
+def response_fingerprint(response):
+    """
+    Hash of the content of a response (all stages with their poles,
+    zeros, coefficients, gains and decimation, and the sensitivity),
+    equal for equal responses and independent of the object identity.
+    """
+    digest = hashlib.sha1()
+    _feed(digest, response)
+    return digest.hexdigest()
+
+
+class ChannelEpochIndex(object):
+    """
+    Lookup of channel epochs and their responses by SEED id and time,
+    built once from one or more inventories.
+    :type inventories: :class:`~obspy.core.inventory.inventory.Inventory`
+        or list
+    :param inventories: Station metadata at response level.
+    """
+    def __init__(self, inventories):
+        if not isinstance(inventories, (list, tuple)):
+            inventories = [inventories]
+        self._epochs = {}
+        for inv in inventories:
+            networks = getattr(inv, "networks", [inv])
+            for net in networks:
+                for sta in net.stations:
+                    for cha in sta.channels:
+                        if cha.response is None:
+                            continue
+                        seed_id = "%s.%s.%s.%s" % (
+                            net.code, sta.code, cha.location_code, cha.code)
+                        self._epochs.setdefault(seed_id, []).append(
+                            (_time_ns(cha.start_date), _time_ns(cha.end_date),
+                             cha.start_date, cha.response))
+        for epochs in self._epochs.values():
+            epochs.sort(key=lambda epoch: epoch[0] or 0)
+
+    def lookup(self, seed_id, time):
+        """
+        Return ``(epoch_start, response)`` of the channel epoch covering
+        ``time``. Raises :class:`ValueError` if there is none.
+        """
+        t = time.ns
+        for start, end, start_date, response in self._epochs.get(seed_id,
+                                                                 ()):
+            if (start is None or start <= t) and (end is None or t <= end):
+                return start_date, response
+        raise ValueError("No matching response information found.")
+
+
+def attach_responses(st, inventories):
+    """
+    Set ``stats.response`` and ``stats.response_epoch`` (start of the
+    channel epoch) of all traces. Returns the traces without response.
+    """
+    index = ChannelEpochIndex(inventories)
+    skipped = []
+    for tr in st:
+        try:
+            epoch, response = index.lookup(tr.id, tr.stats.starttime)
+        except ValueError as e:
+            warnings.warn(str(e))
+            skipped.append(tr)
+            continue
+        tr.stats.response = response
+        tr.stats.response_epoch = epoch
+    return skipped
+
+
+def _is_polynomial(response):
+    from obspy.core.inventory.response import PolynomialResponseStage
+    if not response.response_stages:
+        return response.instrument_polynomial is not None
+    return isinstance(response.response_stages[0], PolynomialResponseStage)
+
+
+class ResponseCache(object):
+    """
+    Bounded LRU cache of deconvolution filters.
+    :type maxsize: int
+    :param maxsize: Number of filters kept in memory.
+    :type path: str
+    :param path: Optional directory the filters are persisted in, shared
+        by all processes using the same directory.
+    """
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, path=None):
+        if path is not None:
+            path = os.path.abspath(os.path.expanduser(path))
+        self.maxsize = maxsize
+        self.path = path
+        self._init_state()
+
+    def _init_state(self):
+        self._lock = threading.Lock()
+        self._filters = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        # Only the configuration is pickled, filters are per process.
+        return {"maxsize": self.maxsize, "path": self.path}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def __repr__(self):
+        return "ResponseCache(maxsize=%d, path=%r)" % (self.maxsize,
+                                                      self.path)
+
+    def __len__(self):
+        return len(self._filters)
+
+    def get_stats(self):
+        return {"size": len(self._filters), "maxsize": self.maxsize,
+                "hits": self.hits, "misses": self.misses}
+
+    def clear(self):
+        with self._lock:
+            self._filters.clear()
+
+    def _filename(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.path, digest + ".npy")
+
+    def _load(self, key):
+        import numpy as np
+        if self.path is None:
+            return None
+        try:
+            return np.load(self._filename(key), allow_pickle=False)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save(self, key, value):
+        import numpy as np
+        filename = self._filename(key)
+        tmp = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp, "wb") as fh:
+                np.save(fh, value, allow_pickle=False)
+            os.replace(tmp, filename)
+        except (IOError, OSError):
+            # The cache is an optimization only.
+            pass
+
+    def _store(self, key, value):
+        with self._lock:
+            self._filters[key] = value
+            self._filters.move_to_end(key)
+            while len(self._filters) > self.maxsize:
+                self._filters.popitem(last=False)
+
+    def deconvolution_filter(self, response, seed_id, sampling_rate, nfft,
+                             output="VEL", water_level=60, pre_filt=None,
+                             fingerprint=None):
+        """
+        Return the spectrum the data spectrum is multiplied with to remove
+        the response: the inverted complex response with water level and
+        frequency domain pre-filter applied, exactly as in
+        :meth:`~obspy.core.trace.Trace.remove_response`.
+        Filters are keyed on the content of the response (see
+        :func:`response_fingerprint`, pass ``fingerprint`` if already
+        known), re-issued metadata with changed stages gets a new filter.
+        """
+        if fingerprint is None:
+            fingerprint = response_fingerprint(response)
+        key = (seed_id, fingerprint, float(sampling_rate), int(nfft),
+               output.upper(), water_level,
+               tuple(pre_filt) if pre_filt is not None else None)
+        with self._lock:
+            value = self._filters.get(key)
+            if value is not None:
+                self._filters.move_to_end(key)
+                self.hits += 1
+                return value
+        value = self._load(key)
+        if value is None:
+            with self._lock:
+                self.misses += 1
+            value = self._compute(response, sampling_rate, nfft, output,
+                                  water_level, pre_filt)
+            if self.path is not None:
+                self._save(key, value)
+        else:
+            with self._lock:
+                self.hits += 1
+        self._store(key, value)
+        return value
+
+    @staticmethod
+    def _compute(response, sampling_rate, nfft, output, water_level,
+                 pre_filt):
+        from obspy.signal.invsim import cosine_sac_taper, invert_spectrum
+        freq_response, freqs = response.get_evalresp_response(
+            1.0 / sampling_rate, nfft, output=output)
+        if water_level is None:
+            freq_response[0] = 0.0
+            freq_response[1:] = 1.0 / freq_response[1:]
+        else:
+            invert_spectrum(freq_response, water_level)
+        if pre_filt:
+            freq_response *= cosine_sac_taper(freqs, flimit=pre_filt)
+        return freq_response
+
+    def remove_response(self, traces, inventory=None, output="VEL",
+                        water_level=60, pre_filt=None, zero_mean=True,
+                        taper=True, taper_fraction=0.05):
+        """
+        Remove the instrument response of many traces in place, same
+        result as calling :meth:`~obspy.core.trace.Trace.remove_response`
+        on each of them. Responses come from ``inventory`` or, without
+        it, from ``stats.response`` (see :func:`attach_responses`).
+        Traces of the same channel, response, sampling rate and length are
+        transformed together in one batched FFT.
+        :type traces: :class:`~obspy.core.stream.Stream` or list
+        :param traces: Traces to correct.
+        :returns: The traces.
+        """
+        import numpy as np
+        from obspy.signal.invsim import cosine_taper
+        from obspy.signal.util import _npts2nfft
+        index = ChannelEpochIndex(inventory) if inventory is not None \
+            else None
+        groups = OrderedDict()
+        # Fingerprints of the responses seen in this call, the objects are
+        # alive until it returns so their ids are unique.
+        fingerprints = {}
+        for tr in traces:
+            if index is not None:
+                _, response = index.lookup(tr.id, tr.stats.starttime)
+            else:
+                try:
+                    response = tr.stats.response
+                except AttributeError:
+                    msg = "No response information found for %s." % tr.id
+                    raise ValueError(msg)
+            if _is_polynomial(response):
+                # Nothing to precompute, leave it to ObsPy.
+                tr.remove_response(response=response, output=output,
+                                   water_level=water_level,
+                                   pre_filt=pre_filt, zero_mean=zero_mean,
+                                   taper=taper, taper_fraction=taper_fraction)
+                continue
+            fingerprint = fingerprints.get(id(response))
+            if fingerprint is None:
+                fingerprint = fingerprints[id(response)] = \
+                    response_fingerprint(response)
+            key = (tr.id, fingerprint, tr.stats.sampling_rate,
+                   tr.stats.npts)
+            groups.setdefault(key, (response, []))[1].append(tr)
+
+        for (seed_id, fingerprint, sampling_rate, npts), (response, group) \
+                in groups.items():
+            nfft = _npts2nfft(npts)
+            spectrum_filter = self.deconvolution_filter(
+                response, seed_id, sampling_rate, nfft, output=output,
+                water_level=water_level, pre_filt=pre_filt,
+                fingerprint=fingerprint)
+            data = np.empty((len(group), npts), dtype=np.float64)
+            for row, tr in zip(data, group):
+                row[:] = tr.data
+            if zero_mean:
+                data -= data.mean(axis=1)[:, np.newaxis]
+            if taper:
+                data *= cosine_taper(npts, taper_fraction, sactaper=True,
+                                     halfcosine=False)
+            spectra = np.fft.rfft(data, n=nfft, axis=1)
+            spectra *= spectrum_filter
+            spectra[:, -1] = np.abs(spectra[:, -1]) + 0.0j
+            data = np.fft.irfft(spectra, axis=1)[:, :npts]
+            info = ("response_cache:remove_response(output=%r, "
+                    "water_level=%r, pre_filt=%r)" % (output, water_level,
+                                                      pre_filt))
+            for row, tr in zip(data, group):
+                tr.data = row.copy()
+                tr.stats.setdefault("processing", []).append(info)
+        return traces
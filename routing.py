@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""
+Routing client federating several FDSN data centers.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+A :class:`RoutingClient` holds one :class:`~client.Client` per data center
+and maps network codes to centers, from a static table and/or by asking
+the station services which networks they serve. Mixed requests are split
+by center, the parts run concurrently (each center with its own threads
+and rate limit) and the results are merged::
+
+    >>> client = RoutingClient(["TAPS", "IRIS"],
+    ...                        routes={"TW": "TAPS", "IU": "IRIS"},
+    ...                        rate_limits={"IRIS": 5})
+    >>> client.split_networks("TW,IU,TW")
+    OrderedDict([('TAPS', ['TW']), ('IRIS', ['IU'])])
+    >>> st = client.get_waveforms("TW,IU", "*", "00", "BHZ", t,
+    ...                           t + 60)  # doctest: +SKIP
+"""
+import fnmatch
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from client import Client
+from header import FDSNNoDataException
+from merge import merge_traces
+
+# Threads per data center.
+DEFAULT_WORKERS = 4
+
+
+def _join(codes):
+    # None (any network) is passed on as it is.
+    if codes is None:
+        return None
+    return ",".join(codes)
+
+
+def _ns(t):
+    # UTCDateTime is not hashable.
+    return None if t is None else t.ns
+
+
+def _unique_traces(streams):
+    """
+    Combine streams of several centers, a trace already delivered by an
+    earlier center (same id, time span and sampling rate) is dropped.
+    """
+    from obspy import Stream
+    st = Stream()
+    seen = set()
+    for part in streams:
+        for tr in part:
+            key = (tr.id, tr.stats.starttime.ns, tr.stats.endtime.ns,
+                   tr.stats.sampling_rate)
+            if key not in seen:
+                seen.add(key)
+                st.append(tr)
+    return st
+
+
+def _merge_inventories(parts):
+    """
+    Combine inventories of several centers, stations already delivered by
+    an earlier center (same network, station and start date) are dropped.
+    """
+    inv = parts[0]
+    networks = dict(((net.code, _ns(net.start_date)), net) for net in inv)
+    for part in parts[1:]:
+        for net in part:
+            key = (net.code, _ns(net.start_date))
+            known = networks.get(key)
+            if known is None:
+                networks[key] = net
+                inv.networks.append(net)
+                continue
+            stations = set((sta.code, _ns(sta.start_date)) for sta in known)
+            known.stations.extend(
+                sta for sta in net
+                if (sta.code, _ns(sta.start_date)) not in stations)
+    return inv
+
+
+def _is_pattern(code):
+    return any(char in code for char in "*?[")
+
+
+class RoutingClient(object):
+    """
+    Client dispatching requests to several data centers by network code.
+    :type clients: dict or list
+    :param clients: Mapping of center name to :class:`~client.Client`, or a
+        list of clients, ``URL_MAPPINGS`` keys or base URLs (named by the
+        key or base URL).
+    :type routes: dict
+    :param routes: Mapping of network code (or ``fnmatch`` pattern, e.g.
+        ``"X*"``) to center name. Static routes take precedence over
+        discovered ones.
+    :type discover: bool
+    :param discover: Ask the station services of all centers which networks
+        they serve when a network code is not routed statically.
+    :type default: str
+    :param default: Center of network codes without a route. Without it,
+        such codes raise a :class:`ValueError`.
+    :type workers: int
+    :param workers: Number of concurrent requests per center.
+    :type rate_limits: dict
+    :param rate_limits: Mapping of center name to the maximum number of
+        requests per second sent to that center.
+    :type client_kwargs: dict
+    :param client_kwargs: Keyword arguments for clients created from keys
+        or base URLs, e.g. credentials.
+    """
+    def __init__(self, clients, routes=None, discover=False, default=None,
+                 workers=DEFAULT_WORKERS, rate_limits=None,
+                 client_kwargs=None, debug=False):
+        self.debug = debug
+        if client_kwargs is None:
+            client_kwargs = {}
+        if not isinstance(clients, dict):
+            clients = OrderedDict(
+                (c.base_url if isinstance(c, Client) else c, c)
+                for c in clients)
+        self.clients = OrderedDict()
+        for name, client in clients.items():
+            if not isinstance(client, Client):
+                client = Client(client, debug=debug, **client_kwargs)
+            self.clients[name] = client
+        if not self.clients:
+            raise ValueError("At least one data center is required.")
+        for name, rate in (rate_limits or {}).items():
+            self.clients[name].set_rate_limit(rate)
+
+        self.routes = OrderedDict(routes or {})
+        for name in self.routes.values():
+            if name not in self.clients:
+                msg = "Route to unknown data center '%s'." % name
+                raise ValueError(msg)
+        if default is not None and default not in self.clients:
+            msg = "Unknown default data center '%s'." % default
+            raise ValueError(msg)
+        self.default = default
+        self.discover = discover
+        self.workers = workers
+        # Network code -> centers, filled by discover_routes().
+        self.discovered = None
+        self._lock = threading.Lock()
+        # Separate from _lock, discovery needs the executors.
+        self._discover_lock = threading.Lock()
+        self._executors = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        del state["_discover_lock"]
+        state["_executors"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._discover_lock = threading.Lock()
+
+    def __str__(self):
+        lines = ["Routing Client with %d data centers:" % len(self.clients)]
+        for name, client in self.clients.items():
+            networks = sorted(code for code, target in self.routes.items()
+                              if target == name)
+            lines.append("    %s (%s): %s" % (name, client.base_url,
+                                              ",".join(networks) or "-"))
+        return "\n".join(lines)
+
+    def _executor(self, name):
+        # One pool per center, a slow center does not hold up the others.
+        with self._lock:
+            if name not in self._executors:
+                self._executors[name] = ThreadPoolExecutor(
+                    max_workers=self.workers)
+            return self._executors[name]
+
+    def close(self):
+        """
+        Shut down the worker threads of all centers.
+        """
+        with self._lock:
+            executors, self._executors = self._executors, {}
+        for executor in executors.values():
+            executor.shutdown(wait=True)
+
+    def discover_routes(self):
+        """
+        Ask the station service of every center for the networks it serves.
+        Returns (and stores) a mapping of network code to the list of
+        centers serving it.
+        """
+        def networks(name):
+            inv = self.clients[name].get_stations(level="network")
+            return set(net.code for net in inv)
+
+        discovered = OrderedDict()
+        for name, codes in self._map(
+                dict((name, (networks, (name,), {}))
+                     for name in self.clients)).items():
+            for code in sorted(codes):
+                discovered.setdefault(code, []).append(name)
+        self.discovered = discovered
+        if self.debug:
+            print("Discovered networks: %s" % dict(discovered))
+        return discovered
+
+    def route(self, network):
+        """
+        Return the list of centers serving a single network code or
+        pattern.
+        """
+        if network in self.routes:
+            return [self.routes[network]]
+        if _is_pattern(network):
+            # A pattern goes to every center that may serve a match.
+            known = dict((code, [name]) for code, name in self.routes.items())
+            known.update(self.discovered or {})
+            centers = [name for name in self.clients if any(
+                fnmatch.fnmatchcase(code, network) and name in names
+                for code, names in known.items())]
+            return centers or list(self.clients)
+        for pattern, name in self.routes.items():
+            if _is_pattern(pattern) and fnmatch.fnmatchcase(network, pattern):
+                return [name]
+        if self.discover:
+            if self.discovered is None:
+                # Concurrent first requests discover the routes only once.
+                with self._discover_lock:
+                    if self.discovered is None:
+                        self.discover_routes()
+            discovered = self.discovered
+            if network in discovered:
+                return list(discovered[network])
+        if self.default is not None:
+            return [self.default]
+        msg = "No data center is known for network '%s'." % network
+        raise ValueError(msg)
+
+    def split_networks(self, network):
+        """
+        Split a comma separated list of network codes by center. Returns an
+        ordered mapping of center name to network codes.
+        """
+        if network is None:
+            return OrderedDict((name, None) for name in self.clients)
+        split = OrderedDict()
+        for code in network.split(","):
+            code = code.strip()
+            for name in self.route(code):
+                codes = split.setdefault(name, [])
+                if code not in codes:
+                    codes.append(code)
+        return split
+
+    def _map(self, calls):
+        """
+        Run ``{center: (function, args, kwargs)}`` concurrently on the
+        executors of the centers and return ``{center: result}``. Centers
+        without data are left out, errors of single centers are turned into
+        warnings unless all centers failed.
+        """
+        futures = OrderedDict(
+            (name, self._executor(name).submit(func, *args, **kwargs))
+            for name, (func, args, kwargs) in calls.items())
+        results = OrderedDict()
+        errors = OrderedDict()
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except FDSNNoDataException:
+                continue
+            except Exception as e:
+                errors[name] = e
+        if errors:
+            if not results and len(errors) == len(futures):
+                raise next(iter(errors.values()))
+            for name, e in errors.items():
+                warnings.warn("Data center '%s' failed: %s" % (name, e))
+        return results
+
+    def get_waveforms(self, network, station, location, channel, starttime,
+                      endtime, filename=None, merge=False, **kwargs):
+        """
+        Query the dataselect services of all centers serving the requested
+        networks, arguments as for :meth:`~client.Client.get_waveforms`.
+        ``network=None`` queries all centers. Returns the combined
+        :class:`~obspy.core.stream.Stream`. Where several centers serve a
+        network, traces delivered identically by more than one of them are
+        kept once. Partially overlapping segments are kept unless
+        ``merge=True``, which stitches the segments of each channel with
+        :func:`~merge.merge_traces`, data of the center routed first wins.
+        """
+        calls = OrderedDict(
+            (name, (self.clients[name].get_waveforms,
+                    (_join(codes), station, location, channel, starttime,
+                     endtime), kwargs))
+            for name, codes in self.split_networks(network).items())
+        results = self._map(calls)
+        if not results:
+            raise FDSNNoDataException("No data available for request.")
+        st = _unique_traces(results.values())
+        if merge:
+            st = merge_traces(st, method="first")
+        if filename:
+            st.write(filename, format="MSEED")
+            return None
+        return st
+
+    def get_stations(self, network=None, filename=None, **kwargs):
+        """
+        Query the station services of all centers serving the requested
+        networks (all centers without ``network``), arguments as for
+        :meth:`~client.Client.get_stations`. Returns the merged
+        :class:`~obspy.core.inventory.inventory.Inventory`, stations served
+        by several centers are taken from the center routed first.
+        """
+        calls = OrderedDict()
+        for name, codes in self.split_networks(network).items():
+            part_kwargs = dict(kwargs)
+            if codes is not None:
+                part_kwargs["network"] = _join(codes)
+            calls[name] = (self.clients[name].get_stations, (), part_kwargs)
+        results = self._map(calls)
+        if not results:
+            raise FDSNNoDataException("No data available for request.")
+        inv = _merge_inventories(list(results.values()))
+        if filename:
+            inv.write(filename, format="STATIONXML")
+            return None
+        return inv
+
+    def get_waveforms_batch(self, requests, **kwargs):
+        """
+        Like :meth:`~client.Client.get_waveforms_batch`, the requests of
+        each center are coalesced and sent by that center's client while
+        all centers are queried concurrently. ``workers`` defaults to the
+        per center worker count.
+        """
+        kwargs.setdefault("workers", self.workers)
+        per_center = OrderedDict()
+        for i, req in enumerate(requests):
+            for name, codes in self.split_networks(req[0]).items():
+                reqs, indices = per_center.setdefault(name, ([], []))
+                reqs.append((_join(codes),) + tuple(req[1:]))
+                indices.append(i)
+        parts = [[] for _ in requests]
+        calls = OrderedDict(
+            (name, (self.clients[name].get_waveforms_batch, (reqs,), kwargs))
+            for name, (reqs, _) in per_center.items())
+        for name, streams in self._map(calls).items():
+            for i, st in zip(per_center[name][1], streams):
+                parts[i].append(st)
+        return [_unique_traces(streams) for streams in parts]
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Priority scheduling of the requests of a client.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+A :class:`PriorityScheduler` hands out the request slots of a client
+(``capacity``, or the current limit of an
+:class:`~concurrency.AdaptiveConcurrency`) to waiting requests by priority
+class. Classes are served in proportion to their shares (stride
+scheduling), so interactive requests overtake queued bulk work without
+starving it, and a class may be capped to a fraction of the slots to keep
+some free for the others. Requests still queued when their deadline
+passes are cancelled with a
+:class:`~header.FDSNDeadlineExceededException`::
+
+    >>> client = Client("TAPS", scheduler=True)  # doctest: +SKIP
+    >>> client.get_waveforms_batch(reqs, workers=16,
+    ...                            priority="batch")  # doctest: +SKIP
+    >>> client.get_waveforms("TW", "NSE01", "--", "EHZ", t, t + 60,
+    ...                      priority="interactive",
+    ...                      deadline=5)  # doctest: +SKIP
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from header import FDSNDeadlineExceededException
+
+# Priority classes and their shares of the dispatched requests.
+DEFAULT_SHARES = {"interactive": 8, "normal": 4, "batch": 1}
+
+# Fraction of the slots a class may occupy at most.
+DEFAULT_LIMITS = {"batch": 0.75}
+
+DEFAULT_PRIORITY = "normal"
+
+# Number of request slots without an adaptive concurrency limit.
+DEFAULT_CAPACITY = 8
+
+
+def deadline_after(seconds):
+    """
+    Absolute deadline (:func:`time.monotonic`) ``seconds`` from now,
+    ``None`` stays ``None``.
+    """
+    if seconds is None:
+        return None
+    return time.monotonic() + seconds
+
+
+class _Ticket(object):
+    __slots__ = ("priority", "deadline", "enqueued", "granted", "expired")
+
+    def __init__(self, priority, deadline):
+        self.priority = priority
+        self.deadline = deadline
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.expired = False
+
+
+class _PriorityClass(object):
+    __slots__ = ("name", "share", "limit", "queue", "running", "pass_",
+                 "dispatched", "expired", "wait", "max_wait")
+
+    def __init__(self, name, share, limit):
+        if share <= 0:
+            raise ValueError("Share of priority '%s' must be positive." %
+                             name)
+        self.name = name
+        self.share = float(share)
+        self.limit = limit
+        self.queue = deque()
+        self.running = 0
+        self.pass_ = 0.0
+        self.dispatched = 0
+        self.expired = 0
+        self.wait = 0.0
+        self.max_wait = 0.0
+
+
+class PriorityScheduler(object):
+    """
+    Shares the request slots of a client between priority classes.
+    :type capacity: int or :class:`~concurrency.AdaptiveConcurrency`
+    :param capacity: Number of requests in flight, or the adaptive limit
+        to follow. A client binds its own limit if not given.
+    :type shares: dict
+    :param shares: Relative share of the slots handed out per priority
+        class, defaults to :data:`DEFAULT_SHARES`.
+    :type limits: dict
+    :param limits: Maximum fraction of the capacity a class may occupy,
+        defaults to :data:`DEFAULT_LIMITS`. At least one slot is always
+        allowed.
+    """
+    def __init__(self, capacity=None, shares=None, limits=None):
+        if shares is None:
+            shares = DEFAULT_SHARES
+        if limits is None:
+            limits = DEFAULT_LIMITS
+        unknown = set(limits) - set(shares)
+        if unknown:
+            msg = "Limits given for unknown priorities: %s" % ", ".join(
+                sorted(unknown))
+            raise ValueError(msg)
+        self.capacity = capacity
+        self.shares = dict(shares)
+        self.limits = dict(limits)
+        self._init_state()
+
+    def _init_state(self):
+        self._cond = threading.Condition()
+        self._classes = dict(
+            (name, _PriorityClass(name, share, self.limits.get(name)))
+            for name, share in self.shares.items())
+        self._running = 0
+        self._vtime = 0.0
+
+    def __getstate__(self):
+        # Queues are per process, only the configuration is pickled.
+        return {"capacity": self.capacity, "shares": self.shares,
+                "limits": self.limits}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def __repr__(self):
+        return "PriorityScheduler(capacity=%d, running=%d, queued=%d)" % (
+            self._capacity(), self._running,
+            sum(len(c.queue) for c in self._classes.values()))
+
+    def _capacity(self):
+        capacity = self.capacity
+        if capacity is None:
+            return DEFAULT_CAPACITY
+        return max(int(getattr(capacity, "limit", capacity)), 1)
+
+    def _class_limit(self, cls, capacity):
+        if cls.limit is None:
+            return capacity
+        return max(int(capacity * cls.limit), 1)
+
+    def _get_class(self, priority):
+        if priority is None:
+            priority = DEFAULT_PRIORITY
+        try:
+            return self._classes[priority]
+        except KeyError:
+            msg = "Unknown priority '%s', expected one of: %s" % (
+                priority, ", ".join(sorted(self._classes)))
+            raise ValueError(msg)
+
+    def _dispatch(self):
+        # Called with the lock held: grant free slots to the eligible class
+        # with the smallest pass, dropping expired tickets on the way.
+        capacity = self._capacity()
+        now = time.monotonic()
+        granted = False
+        while self._running < capacity:
+            eligible = [cls for cls in self._classes.values()
+                        if cls.queue and
+                        cls.running < self._class_limit(cls, capacity)]
+            if not eligible:
+                break
+            cls = min(eligible, key=lambda c: c.pass_)
+            ticket = cls.queue.popleft()
+            if ticket.deadline is not None and now >= ticket.deadline:
+                ticket.expired = True
+                cls.expired += 1
+                granted = True
+                continue
+            ticket.granted = True
+            granted = True
+            cls.running += 1
+            self._running += 1
+            cls.dispatched += 1
+            wait = now - ticket.enqueued
+            cls.wait += wait
+            cls.max_wait = max(cls.max_wait, wait)
+            self._vtime = cls.pass_
+            cls.pass_ += 1.0 / cls.share
+        if granted:
+            self._cond.notify_all()
+
+    def acquire(self, priority=None, deadline=None):
+        """
+        Wait for a request slot. Returns the time waited in seconds.
+        :type priority: str
+        :param priority: Priority class of the request.
+        :type deadline: float
+        :param deadline: Absolute :func:`time.monotonic` time, see
+            :func:`deadline_after`. Raises
+            :class:`~header.FDSNDeadlineExceededException` if no slot was
+            granted until then.
+        """
+        with self._cond:
+            cls = self._get_class(priority)
+            ticket = _Ticket(cls.name, deadline)
+            if deadline is not None and ticket.enqueued >= deadline:
+                cls.expired += 1
+                raise FDSNDeadlineExceededException(
+                    "Deadline passed before the request was sent.")
+            if not cls.queue:
+                # A class becoming active must not use up the credit it
+                # (did not) earn while idle.
+                cls.pass_ = max(cls.pass_, self._vtime)
+            cls.queue.append(ticket)
+            self._dispatch()
+            while not ticket.granted and not ticket.expired:
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        cls.queue.remove(ticket)
+                        cls.expired += 1
+                        ticket.expired = True
+                        # Others may be eligible now.
+                        self._dispatch()
+                        break
+                self._cond.wait(timeout)
+            if ticket.expired:
+                raise FDSNDeadlineExceededException(
+                    "Request cancelled, its deadline passed after %.3f s in "
+                    "the '%s' queue." % (time.monotonic() - ticket.enqueued,
+                                         cls.name))
+            return time.monotonic() - ticket.enqueued
+
+    def release(self, priority=None):
+        """
+        Give back the slot of a request of class ``priority``.
+        """
+        with self._cond:
+            cls = self._get_class(priority)
+            cls.running -= 1
+            self._running -= 1
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, priority=None, deadline=None):
+        """
+        Context manager holding a request slot.
+        """
+        self.acquire(priority, deadline)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    def get_stats(self):
+        with self._cond:
+            classes = {}
+            for cls in self._classes.values():
+                classes[cls.name] = {
+                    "share": cls.share, "queued": len(cls.queue),
+                    "running": cls.running, "dispatched": cls.dispatched,
+                    "expired": cls.expired, "wait": cls.wait,
+                    "max_wait": cls.max_wait}
+            return {"capacity": self._capacity(), "running": self._running,
+                    "classes": classes}
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The modules of the client import each other as top level modules, the
+# stub server lives with the benchmarks.
+sys.path.insert(0, ROOT)
+sys.path.insert(1, os.path.join(ROOT, "benchmarks"))
+
+
+@pytest.fixture
+def stub_server(tmpdir):
+    """
+    Factory of HTTPS stub servers, ``stub_server(**config)`` starts one
+    with a :class:`~stub_server.StubConfig` and trusts its certificate.
+    All servers are stopped after the test.
+    """
+    pytest.importorskip("obspy")
+    from stub_server import StubConfig, StubServer, trusted_certificate
+    bundle = str(tmpdir.join("bundle.pem"))
+    open(bundle, "w").close()
+    servers = []
+
+    def start(**kwargs):
+        kwargs.setdefault("npts", 1000)
+        server = StubServer(StubConfig(**kwargs)).start()
+        servers.append(server)
+        with open(server.certfile) as src, open(bundle, "a") as dst:
+            dst.write(src.read())
+        return server
+
+    with trusted_certificate(bundle):
+        try:
+            yield start
+        finally:
+            for server in servers:
+                server.stop()
+
+
+@pytest.fixture
+def dead_url():
+    """
+    HTTPS URL of a local port nobody listens on.
+    """
+    sock = socket.socket()
+    sock.bind(("localhost", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return "https://localhost:%d" % port
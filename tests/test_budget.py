@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from budget import MemoryBudget
+
+
+def test_wait_for_capacity_times_out_when_exhausted():
+    budget = MemoryBudget(100)
+    budget.reserve(150)
+    assert budget.wait_for_capacity(timeout=0.01) is False
+    budget.release(100)
+    assert budget.wait_for_capacity(timeout=0.01) is True
+
+
+def test_exempt_thread_does_not_wait():
+    budget = MemoryBudget(100)
+    budget.reserve(150)
+    with budget.exempt():
+        assert budget.wait_for_capacity(timeout=0.01) is True
+        with budget.exempt():
+            pass
+        # Still exempt after leaving a nested block.
+        assert budget.wait_for_capacity(timeout=0.01) is True
+    assert budget.wait_for_capacity(timeout=0.01) is False
+
+
+def test_exempt_is_per_thread():
+    budget = MemoryBudget(100)
+    budget.reserve(150)
+    results = []
+    with budget.exempt():
+        thread = threading.Thread(target=lambda: results.append(
+            budget.wait_for_capacity(timeout=0.01)))
+        thread.start()
+        thread.join()
+    assert results == [False]
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import pytest
+
+obspy = pytest.importorskip("obspy")
+
+from bulk_download import (BulkDownloader, DownloadItem,  # noqa: E402
+                           DownloadState, read_manifest, split_by_day)
+from client import Client  # noqa: E402
+
+T = obspy.UTCDateTime(2008, 4, 16)
+
+
+def _keys(items):
+    return [item.key for item in items]
+
+
+def test_split_by_day():
+    items = split_by_day("TW", "NSE01", "", "EHZ", T + 3600, T + 2 * 86400)
+    assert [(item.starttime, item.endtime) for item in items] == [
+        (T + 3600, T + 86400), (T + 86400, T + 2 * 86400)]
+    assert split_by_day("TW", "NSE01", "", "EHZ", T, T) == []
+
+
+def test_read_manifest_csv(tmpdir):
+    path = tmpdir.join("manifest.csv")
+    path.write("# comment\n"
+               "network,station,location,channel,starttime,endtime\n"
+               "TW, NSE01,,EHZ,2008-04-16T12:00:00,2008-04-17T06:00:00\n"
+               "TW,NSE02,00,EHN,2008-04-16,2008-04-16T01:00:00\n")
+    assert _keys(read_manifest(str(path))) == [
+        "TW.NSE01..EHZ|2008-04-16T12:00:00.000000Z|"
+        "2008-04-17T00:00:00.000000Z",
+        "TW.NSE01..EHZ|2008-04-17T00:00:00.000000Z|"
+        "2008-04-17T06:00:00.000000Z",
+        "TW.NSE02.00.EHN|2008-04-16T00:00:00.000000Z|"
+        "2008-04-16T01:00:00.000000Z"]
+
+
+def test_read_manifest_json(tmpdir):
+    path = tmpdir.join("manifest.json")
+    entry = {"network": "TW", "station": "NSE01", "location": None,
+             "channel": "EHZ", "starttime": "2008-04-16",
+             "endtime": "2008-04-16T00:10:00"}
+    path.write(json.dumps(entry))
+    assert _keys(read_manifest(str(path))) == [
+        "TW.NSE01..EHZ|2008-04-16T00:00:00.000000Z|"
+        "2008-04-16T00:10:00.000000Z"]
+    del entry["channel"]
+    path.write(json.dumps([entry]))
+    with pytest.raises(ValueError, match="channel"):
+        read_manifest(str(path))
+    path.write(json.dumps([{"stations": {"network": "TW"},
+                            "starttime": "2008-04-16",
+                            "endtime": "2008-04-17"}]))
+    with pytest.raises(ValueError, match="client"):
+        read_manifest(str(path))
+
+
+def test_read_manifest_expands_stations(tmpdir, stub_server):
+    server = stub_server(nstations=2)
+    path = tmpdir.join("manifest.json")
+    path.write(json.dumps([{"stations": {"network": "TW",
+                                         "channel": "EHZ"},
+                            "starttime": "2008-04-16",
+                            "endtime": "2008-04-16T01:00:00"}]))
+    items = read_manifest(str(path), client=Client(server.base_url))
+    # The stub server answers with all its channels.
+    assert sorted(item.seed_id for item in items) == [
+        "TW.%s..%s" % (sta, cha) for sta in ("NSE01", "NSE02")
+        for cha in ("EHE", "EHN", "EHZ")]
+    assert all((item.starttime, item.endtime) == (T, T + 3600)
+               for item in items)
+
+
+def test_filenames_of_windows_on_one_day_differ(tmpdir):
+    day = DownloadItem("TW", "NSE01", "", "EHZ", T, T + 86400)
+    first = DownloadItem("TW", "NSE01", "", "EHZ", T, T + 3600)
+    second = DownloadItem("TW", "NSE01", "", "EHZ", T + 3600, T + 7200)
+    names = [os.path.basename(item.filename(str(tmpdir)))
+             for item in (day, first, second)]
+    assert names == ["TW.NSE01..EHZ.2008.107.mseed",
+                     "TW.NSE01..EHZ.2008.107.000000-010000.mseed",
+                     "TW.NSE01..EHZ.2008.107.010000-020000.mseed"]
+
+
+def test_state_is_resumed(tmpdir):
+    path = str(tmpdir.join("state"))
+    item = DownloadItem("TW", "NSE01", "", "EHZ", T, T + 60)
+    other = DownloadItem("TW", "NSE01", "", "EHZ", T + 60, T + 120)
+    DownloadState(path).mark(item, "ok", 100)
+    with open(path, "a") as fh:
+        # Interrupted while writing the next record.
+        fh.write('{"key": "TW.NSE01..EHZ|20')
+    state = DownloadState(path)
+    assert item in state
+    assert other not in state
+    assert state.done[item.key] == {"key": item.key, "status": "ok",
+                                    "bytes": 100}
+
+
+def test_download_windows_of_one_day_and_resume(tmpdir, stub_server):
+    server = stub_server()
+    client = Client(server.base_url)
+    items = [DownloadItem("TW", "NSE01", "", "EHZ", T, T + 5),
+             DownloadItem("TW", "NSE01", "", "EHZ", T + 5, T + 10),
+             DownloadItem("TW", "NODATA", "", "EHZ", T, T + 10)]
+    outdir = str(tmpdir.join("data"))
+    downloader = BulkDownloader(client, outdir, workers=2, progress=False)
+    assert downloader.download(items) == {}
+    files = [item.filename(outdir) for item in items[:2]]
+    assert files[0] != files[1]
+    for path in files:
+        assert len(obspy.read(path)) == 1
+    assert not os.path.exists(items[2].filename(outdir))
+    assert not [name for name in os.listdir(os.path.dirname(files[0]))
+                if name.endswith(".part")]
+    state = DownloadState(os.path.join(outdir, ".taps_download_state"))
+    assert [state.done[item.key]["status"] for item in items] == [
+        "ok", "ok", "nodata"]
+    assert [state.done[item.key]["bytes"] for item in items[:2]] == [
+        os.path.getsize(path) for path in files]
+
+    requests = server.counts["/fdsnws/dataselect/0/query"]
+    resumed = BulkDownloader(client, outdir, progress=False)
+    assert resumed.download(items) == {}
+    assert server.counts["/fdsnws/dataselect/0/query"] == requests
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from client import Client
+from header import URL_MAJOR_VERSIONS, URL_MAPPINGS
+
+
+@pytest.mark.parametrize("key", sorted(URL_MAPPINGS))
+def test_known_centers_use_their_service_version(key):
+    client = Client(key)
+    version = URL_MAJOR_VERSIONS[key]
+    assert client.major_versions == {"dataselect": version,
+                                     "station": version}
+    assert client._build_url("station", "query") == \
+        "%s/fdsnws/station/%d/query" % (URL_MAPPINGS[key], version)
+
+
+def test_standard_fdsn_centers_serve_version_1():
+    assert URL_MAJOR_VERSIONS["TAPS"] == 0
+    assert all(version == 1 for key, version in URL_MAJOR_VERSIONS.items()
+               if key != "TAPS")
+    assert Client("IRIS")._build_url("dataselect", "query") == \
+        "https://service.iris.edu/fdsnws/dataselect/1/query"
+
+
+def test_major_versions_override_center_version():
+    client = Client("IRIS", major_versions={"station": 2})
+    assert client.major_versions == {"dataselect": 1, "station": 2}
+
+
+def test_other_urls_use_taps_versions():
+    client = Client("https://taps-mirror.example.org")
+    assert client.major_versions == {"dataselect": 0, "station": 0}
+
+
+def test_batch_gives_up_only_expired_queries(stub_server):
+    obspy = pytest.importorskip("obspy")
+    from scheduler import PriorityScheduler
+    t = obspy.UTCDateTime(2008, 4, 16)
+    server = stub_server(latency=0.3)
+    client = Client(server.base_url,
+                    scheduler=PriorityScheduler(capacity=1))
+    # Different windows, one query each. With one slot only the first
+    # queries are sent within the deadline.
+    requests = [("TW", "NSE01", "--", "EHZ", t + i, t + i + 1)
+                for i in range(6)]
+    with pytest.warns(UserWarning, match="passed the deadline"):
+        streams = client.get_waveforms_batch(requests, workers=6,
+                                             deadline=0.5)
+    assert len(streams) == 6
+    sent = server.counts["/fdsnws/dataselect/0/query"]
+    assert 1 <= sent < 6
+    assert sum(1 for st in streams if len(st)) == sent
+    stats = client.scheduler.get_stats()["classes"]["normal"]
+    assert stats["expired"] == 6 - sent
+    assert stats["running"] == 0
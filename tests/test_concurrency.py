@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import concurrency
+from concurrency import THROTTLE_RETRIES, AdaptiveConcurrency
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Manual monotonic clock of the controller, ``clock.now`` is advanced by
+    the tests.
+    """
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(concurrency, "time", SimpleNamespace(
+        monotonic=lambda: clock.now, time=time.time))
+    return clock
+
+
+def _window(limiter, clock, nbytes, duration=0.1, seconds=1.0):
+    """
+    Run a saturated window of ``limit`` requests of ``nbytes`` each that
+    take ``seconds`` in total.
+    """
+    n = limiter.limit
+    for _ in range(n):
+        limiter.acquire()
+    clock.now += seconds
+    for _ in range(n):
+        limiter.release(duration=duration, nbytes=nbytes)
+
+
+def test_limit_grows_by_one_per_window(clock):
+    limiter = AdaptiveConcurrency(initial=2, maximum=5, min_samples=2)
+    limits = []
+    for _ in range(5):
+        _window(limiter, clock, nbytes=1000)
+        limits.append(limiter.limit)
+    # Each window has one more request of the same size and duration, so
+    # throughput improves until the ceiling.
+    assert limits == [3, 4, 5, 5, 5]
+    assert [entry["reason"] for entry in limiter.history] == \
+        ["throughput"] * 3
+
+
+def test_limit_stays_without_saturation_or_gain(clock):
+    limiter = AdaptiveConcurrency(initial=4, min_samples=2)
+    _window(limiter, clock, nbytes=1000)
+    assert limiter.limit == 5
+    # Same throughput as before: no gain.
+    _window(limiter, clock, nbytes=800)
+    assert limiter.limit == 5
+    # Requests one after another never fill the limit.
+    for _ in range(5):
+        limiter.acquire()
+        limiter.release(duration=0.1, nbytes=10 ** 6)
+    assert limiter.limit == 5
+
+
+@pytest.mark.parametrize("code", [429, 503])
+def test_limit_halves_on_throttling_down_to_the_floor(clock, code):
+    limiter = AdaptiveConcurrency(initial=16, minimum=3, maximum=16)
+    limits = []
+    for _ in range(4):
+        limiter.acquire()
+        limiter.release(code=code)
+        limits.append(limiter.limit)
+        # Throttled answers to requests sent before a cut count once.
+        limiter.acquire()
+        limiter.release(code=code)
+        assert limiter.limit == limits[-1]
+        clock.now += 1.5
+    assert limits == [8, 4, 3, 3]
+    assert [entry["reason"] for entry in limiter.history] == [
+        "throttled (%d)" % code] * 3
+    limiter.acquire()
+    limiter.release(timeout=True)
+    assert limiter.limit == 3
+    assert limiter.in_flight == 0
+
+
+def test_other_errors_do_not_cut(clock):
+    limiter = AdaptiveConcurrency(initial=8)
+    for code in (204, 404, 413, 500):
+        limiter.acquire()
+        limiter.release(code=code)
+    assert limiter.limit == 8
+
+
+def test_throttled_request_is_retried_at_most_throttle_retries_times(
+        stub_server, monkeypatch):
+    obspy = pytest.importorskip("obspy")
+    import client as client_module
+    from client import Client
+    monkeypatch.setattr(client_module, "_retry_after",
+                        lambda error, attempt: 0.0)
+    server = stub_server(errors={429: 1.0})
+    path = "/fdsnws/dataselect/0/query"
+    t = obspy.UTCDateTime(2008, 4, 16)
+    limiter = AdaptiveConcurrency(initial=8, maximum=8)
+    client = Client(server.base_url, concurrency=limiter)
+    with pytest.raises(Exception):
+        client.get_waveforms("TW", "NSE01", "--", "EHZ", t, t + 5)
+    assert server.counts[path] == THROTTLE_RETRIES + 1
+    assert limiter.limit < 8 and limiter.in_flight == 0
+
+    # Without an adaptive limit the answer is final.
+    client = Client(server.base_url)
+    with pytest.raises(Exception):
+        client.get_waveforms("TW", "NSE01", "--", "EHZ", t, t + 5)
+    assert server.counts[path] == THROTTLE_RETRIES + 2
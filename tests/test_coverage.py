@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import io
+import struct
+
+import numpy as np
+import pytest
+
+obspy = pytest.importorskip("obspy")
+
+from coverage import (RecordTable, _uniform_table, get_coverage,  # noqa
+                      read_table, scan_records, scan_table)
+
+T = obspy.UTCDateTime(2008, 4, 16)
+
+# (offset, npts) in samples: a gap, an overlap and another gap.
+SEGMENTS = [(0, 5000), (6000, 3000), (8500, 2000), (20000, 1000)]
+
+
+def _stream(channel="EHZ", sampling_rate=100.0, starttime=T):
+    st = obspy.Stream()
+    for offset, npts in SEGMENTS:
+        st.append(obspy.Trace(
+            np.arange(npts, dtype=np.int32), header={
+                "network": "TW", "station": "NSE01", "location": "",
+                "channel": channel, "sampling_rate": sampling_rate,
+                "starttime": starttime + offset / sampling_rate}))
+    return st
+
+
+def _mseed(st, reclen=512, byteorder=">"):
+    buf = io.BytesIO()
+    st.write(buf, format="MSEED", reclen=reclen, byteorder=byteorder,
+             encoding="STEIM1")
+    return buf.getvalue()
+
+
+def _blockettes(buf, byteorder):
+    # Types of the blockettes of the first record.
+    types = []
+    pos = struct.unpack_from(byteorder + "H", buf, 46)[0]
+    while pos:
+        btype, next_pos = struct.unpack_from(byteorder + "HH", buf, pos)
+        types.append(btype)
+        pos = next_pos if next_pos > pos else 0
+    return types
+
+
+def _assert_records_match_obspy(table, buf):
+    assert len(table)
+    for i in range(len(table)):
+        offset, reclen = int(table.offset[i]), int(table.reclen[i])
+        tr = obspy.read(io.BytesIO(buf[offset:offset + reclen]))[0]
+        assert table.ids[table.channel[i]] == tr.id
+        assert table.starttime[i] == tr.stats.starttime.ns
+        assert table.npts[i] == tr.stats.npts
+        assert table.sampling_rate[i] == tr.stats.sampling_rate
+    assert int((table.offset + table.reclen).max()) == len(buf)
+
+
+def _obspy_gaps(st):
+    """
+    Gaps and overlaps of ObsPy in the convention of
+    :class:`~coverage.ChannelCoverage`: intervals end at the expected start
+    of the next sample.
+    """
+    gaps, overlaps = {}, {}
+    for net, sta, loc, cha, t1, t2, delta, _ in st.get_gaps():
+        seed_id = ".".join((net, sta, loc, cha))
+        sampling_rate = st.select(id=seed_id)[0].stats.sampling_rate
+        end = (t1 + 1.0 / sampling_rate).ns
+        if delta > 0:
+            gaps.setdefault(seed_id, []).append((end, t2.ns))
+        else:
+            overlaps.setdefault(seed_id, []).append((t2.ns, end))
+    return gaps, overlaps
+
+
+def _assert_close(actual, expected, sampling_rate=100.0):
+    # Record start times are rounded to microseconds, ObsPy derives the end
+    # of a segment from its start instead: allow a thousandth of a sample.
+    tolerance = 1e6 / sampling_rate
+    assert len(actual) == len(expected)
+    for (a0, a1), (e0, e1) in zip(actual, expected):
+        assert abs(a0 - e0) <= tolerance and abs(a1 - e1) <= tolerance
+
+
+def _assert_coverage_matches_obspy(cov, st):
+    gaps, overlaps = _obspy_gaps(st)
+    assert sorted(cov.channels) == sorted(set(tr.id for tr in st))
+    for channel in cov:
+        _assert_close(channel.gaps, gaps.get(channel.id, []),
+                      channel.sampling_rate)
+        _assert_close(channel.overlaps, overlaps.get(channel.id, []),
+                      channel.sampling_rate)
+        traces = st.select(id=channel.id)
+        assert channel.samples == sum(tr.stats.npts for tr in traces)
+        assert channel.starttime == min(tr.stats.starttime.ns
+                                        for tr in traces)
+
+
+# 100 Hz with blockette 1000 only, 1001 for microsecond start times, 100
+# for a rate factor and multiplier cannot express.
+@pytest.mark.parametrize("sampling_rate, starttime, blockettes", [
+    (100.0, T, [1000]),
+    (100.0, T + 0.000123, [1001, 1000]),
+    (33.123, T, [1001, 100, 1000])])
+@pytest.mark.parametrize("byteorder", [">", "<"])
+def test_uniform_records_match_obspy(byteorder, sampling_rate, starttime,
+                                     blockettes):
+    st = _stream(sampling_rate=sampling_rate, starttime=starttime)
+    buf = _mseed(st, byteorder=byteorder)
+    first = next(scan_records(buf))
+    assert first.byteorder == byteorder
+    assert _blockettes(buf, byteorder) == blockettes
+
+    table = _uniform_table(buf)
+    assert table is not None
+    _assert_records_match_obspy(table, buf)
+    # The record by record parser gives the same table.
+    slow = RecordTable.from_headers(scan_records(buf))
+    for name in ("offset", "reclen", "starttime", "npts", "sampling_rate"):
+        np.testing.assert_array_equal(getattr(table, name),
+                                      getattr(slow, name))
+    _assert_coverage_matches_obspy(get_coverage(buf), obspy.read(
+        io.BytesIO(buf)))
+
+
+@pytest.mark.parametrize("reclens", [(512, 4096), (4096, 512)])
+@pytest.mark.parametrize("byteorder", [">", "<"])
+def test_mixed_record_lengths_match_obspy(byteorder, reclens):
+    streams = [_stream("EHZ"), _stream("EHN", sampling_rate=50.0)]
+    buf = b"".join(_mseed(st, reclen, byteorder)
+                   for st, reclen in zip(streams, reclens))
+    assert _uniform_table(buf) is None
+    table = scan_table(buf)
+    assert sorted(set(table.reclen.tolist())) == [512, 4096]
+    _assert_records_match_obspy(table, buf)
+    _assert_coverage_matches_obspy(get_coverage(buf),
+                                   obspy.read(io.BytesIO(buf)))
+
+
+def test_coverage_of_files_and_window(tmpdir):
+    paths = []
+    for channel, byteorder in (("EHZ", ">"), ("EHN", "<")):
+        path = str(tmpdir.join("%s.mseed" % channel))
+        with open(path, "wb") as fh:
+            fh.write(_mseed(_stream(channel), byteorder=byteorder))
+        paths.append(path)
+    assert len(read_table(paths[0])) == len(scan_table(
+        open(paths[0], "rb").read()))
+    cov = get_coverage(paths, starttime=T - 10, endtime=T + 300)
+    st = obspy.read(paths[0]) + obspy.read(paths[1])
+    gaps, overlaps = _obspy_gaps(st)
+    for channel in cov:
+        # The window adds a gap at either end.
+        assert channel.gaps[0] == ((T - 10).ns, T.ns)
+        assert channel.gaps[-1] == ((T + 210).ns, (T + 300).ns)
+        _assert_close(channel.gaps[1:-1], gaps[channel.id])
+        _assert_close(channel.overlaps, overlaps[channel.id])
+    rows = dict((row[0], row[1:]) for row in cov.rows())
+    start, end, samples, ngaps, noverlaps, percent = rows["TW.NSE01..EHZ"]
+    assert (start, end, samples, ngaps, noverlaps) == (
+        T.ns, (T + 210).ns, 11000, 4, 1)
+    # 5000 + 4500 + 1000 samples of 100 Hz in 310 s.
+    assert percent == pytest.approx(100.0 * 105.0 / 310.0)
+    assert "TW.NSE01..EHN" in str(cov)
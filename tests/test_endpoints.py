@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import time
+from concurrent.futures import Future
+
+import pytest
+
+obspy = pytest.importorskip("obspy")
+
+from client import Client, _discard_response  # noqa: E402
+from endpoints import MIN_HEDGE_SAMPLES, EndpointPool  # noqa: E402
+
+T = obspy.UTCDateTime(2008, 4, 16)
+
+
+def test_login_fails_over_to_mirror(stub_server, dead_url):
+    mirror = stub_server()
+    client = Client(dead_url, mirrors=[mirror.base_url], user="u",
+                    password="p")
+    assert client.jwt_access_token == "stub-access"
+    st = client.get_waveforms("TW", "NSE01", "--", "EHZ", T, T + 5)
+    assert len(st) == 1
+    counts = mirror.counts
+    assert counts["/api/token"] == 1
+    assert counts["/api/token/verify"] == 1
+
+
+def test_token_verification_fails_over_to_mirror(stub_server, dead_url):
+    mirror = stub_server()
+    client = Client(dead_url, mirrors=[mirror.base_url],
+                    jwt_access_token="stub-access",
+                    jwt_refresh_token="stub-refresh")
+    st = client.get_waveforms("TW", "NSE01", "--", "EHZ", T, T + 5)
+    assert len(st) == 1
+    assert mirror.counts["/api/token/verify"] == 1
+
+
+def test_token_request_without_mirrors_raises(dead_url):
+    with pytest.raises(Exception) as e:
+        Client(dead_url, user="u", password="p")
+    assert isinstance(e.value, OSError)
+
+
+def test_discard_response_of_failed_request():
+    future = Future()
+    future.set_exception(OSError("connection reset"))
+    _discard_response(future)
+
+
+def _urls(endpoints):
+    return [endpoint.url for endpoint in endpoints]
+
+
+def test_ranking_after_failures():
+    pool = EndpointPool(["https://a", "https://b", "https://c"])
+    # Unmeasured endpoints keep their order.
+    assert _urls(pool.ranked()) == ["https://a", "https://b", "https://c"]
+    a, b, c = pool.endpoints
+    pool.record(b, 0.2, ok=True)
+    pool.record(c, 0.1, ok=True)
+    assert _urls(pool.ranked()) == ["https://c", "https://b", "https://a"]
+    # A failing endpoint backs off behind all others, even unmeasured ones.
+    pool.record(c, None, ok=False)
+    assert _urls(pool.ranked()) == ["https://b", "https://a", "https://c"]
+    # After the back off its error rate still counts against it.
+    c.down_until = time.time() - 1
+    assert c.error_rate == pytest.approx(0.2)
+    assert _urls(pool.ranked()) == ["https://c", "https://b", "https://a"]
+    pool.record(c, None, ok=False)
+    assert c.consecutive_failures == 2
+    assert c.down_until > time.time() + 1
+    pool.record(c, 0.1, ok=True)
+    assert (c.consecutive_failures, c.down_until) == (0, 0.0)
+    assert [stats["failures"] for stats in pool.get_stats()] == [0, 0, 2]
+
+
+def test_percentile_needs_samples():
+    pool = EndpointPool(["https://a"])
+    for i in range(MIN_HEDGE_SAMPLES):
+        assert pool.primary.percentile(50) is None
+        pool.record(pool.primary, (i + 1) / 10.0, ok=True)
+    assert pool.primary.percentile(50) == pytest.approx(0.5)
+    assert pool.primary.percentile(100) == pytest.approx(1.0)
+
+
+def _dataselect_requests(server):
+    return server.counts.get("/fdsnws/dataselect/0/query", 0)
+
+
+def test_dead_primary_fails_over_and_ranks_last(stub_server, dead_url):
+    mirror = stub_server()
+    client = Client(dead_url, mirrors=[mirror.base_url])
+    for _ in range(2):
+        st = client.get_waveforms("TW", "NSE01", "--", "EHZ", T, T + 5)
+        assert len(st) == 1
+    assert _dataselect_requests(mirror) == 2
+    primary, other = client.get_endpoint_stats()
+    # The second request went to the mirror right away.
+    assert (primary["requests"], primary["failures"]) == (1, 1)
+    assert (other["requests"], other["failures"]) == (2, 0)
+
+
+def test_throttling_primary_fails_over_without_retries(stub_server):
+    primary = stub_server(errors={503: 1.0})
+    mirror = stub_server()
+    client = Client(primary.base_url, mirrors=[mirror.base_url],
+                    concurrency=True)
+    st = client.get_waveforms("TW", "NSE01", "--", "EHZ", T, T + 5)
+    assert len(st) == 1
+    assert [_dataselect_requests(server)
+            for server in (primary, mirror)] == [1, 1]
+
+
+def test_hedged_request_discards_the_slower_answer(stub_server):
+    slow = stub_server(latency=0.5)
+    fast = stub_server()
+    client = Client(slow.base_url, mirrors=[fast.base_url], hedge_after=50)
+    events = []
+    client.instrumentation.subscribe(
+        lambda event, data: events.append(event))
+    pool = client._endpoint_pools[0]
+    # Enough fast answers of the primary to derive the hedging delay.
+    for _ in range(MIN_HEDGE_SAMPLES):
+        pool.record(pool.primary, 0.01, ok=True)
+    start = time.monotonic()
+    st = client.get_waveforms("TW", "NSE01", "--", "EHZ", T, T + 5)
+    assert time.monotonic() - start < 0.4
+    assert len(st) == 1
+    assert events.count("hedge") == 1
+    assert [_dataselect_requests(server) for server in (slow, fast)] == [
+        1, 1]
+    # The primary answers later, its response is read and thrown away.
+    deadline = time.monotonic() + 5
+    while pool.primary.requests < MIN_HEDGE_SAMPLES + 1:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    assert pool.primary.failures == 0
+    assert pool.endpoints[1].requests == 1
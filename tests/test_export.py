@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import io
+import warnings
+
+import numpy as np
+import pytest
+
+obspy = pytest.importorskip("obspy")
+zarr = pytest.importorskip("zarr")
+
+from client import Client  # noqa: E402
+from export import ArrayStore, export_waveforms, rate_matches  # noqa: E402
+
+T = obspy.UTCDateTime(2008, 4, 16)
+
+
+def _trace(channel, starttime, npts, sampling_rate=100.0):
+    return obspy.Trace(np.arange(npts, dtype=np.float32), header={
+        "network": "TW", "station": "NSE01", "location": "",
+        "channel": channel, "sampling_rate": sampling_rate,
+        "starttime": starttime})
+
+
+def _create(path, **kwargs):
+    return ArrayStore.create(
+        path, [("TW.NSE01..EHZ", 100.0, None), ("TW.NSE01..EHN", 100.0, None),
+               ("TW.NSE01..LHZ", 1.0, {"sensitivity": 1e9})],
+        T, T + 20, chunk_length=300, **kwargs)
+
+
+@pytest.mark.parametrize("compression", ["zlib", None])
+def test_store_round_trips_through_zarr(tmpdir, compression):
+    path = str(tmpdir.join("store.zarr"))
+    store = _create(path, compression=compression)
+    ehz = _trace("EHZ", T + 2.5, 1000)
+    lhz = _trace("LHZ", T + 4, 10, sampling_rate=1.0)
+    store.write_trace(ehz)
+    store.write_trace(lhz)
+
+    root = zarr.open(path, mode="r")
+    assert sorted(root.array_keys()) == sorted(store.attrs["arrays"])
+    array = root[store.attrs["arrays"][1]]
+    assert array.shape == (2, 2000)
+    assert [meta["id"] for meta in array.attrs["channels"]] == [
+        "TW.NSE01..EHN", "TW.NSE01..EHZ"]
+    expected = np.full(2000, np.nan, dtype=np.float32)
+    expected[250:1250] = ehz.data
+    np.testing.assert_array_equal(array[1], expected)
+    assert np.isnan(array[0]).all()
+    np.testing.assert_array_equal(store.read("TW.NSE01..EHZ"), expected)
+
+    array = root[store.attrs["arrays"][0]]
+    assert array.shape == (1, 20)
+    assert array.attrs["channels"][0]["sensitivity"] == 1e9
+    np.testing.assert_array_equal(array[0, 4:14], lhz.data)
+
+    tr = ArrayStore(path).read_trace("TW.NSE01..EHZ", T + 2.5, T + 12.5)
+    assert tr.stats.starttime == ehz.stats.starttime
+    np.testing.assert_array_equal(tr.data, ehz.data)
+
+
+def test_integer_store_uses_fill_value(tmpdir):
+    path = str(tmpdir.join("store.zarr"))
+    store = _create(path, dtype="int32", fill_value=-1)
+    store.write_trace(_trace("EHN", T, 100))
+    array = zarr.open(path, mode="r")[store.attrs["arrays"][1]]
+    assert array.fill_value == -1
+    np.testing.assert_array_equal(array[0, :100], np.arange(100))
+    assert (array[0, 100:] == -1).all() and (array[1] == -1).all()
+
+
+def test_trace_at_other_rate_is_rejected(tmpdir):
+    store = _create(str(tmpdir.join("store.zarr")))
+    with pytest.raises(ValueError, match="50 Hz"):
+        store.write_trace(_trace("EHZ", T, 100, sampling_rate=50.0))
+    assert np.isnan(store.read("TW.NSE01..EHZ")).all()
+    # Rounding of the header rate is no mismatch.
+    store.write_trace(_trace("EHZ", T, 100, sampling_rate=100.0000001))
+    assert rate_matches(100.0000001, 100.0, 100)
+    assert not rate_matches(100.01, 100.0, 360000)
+
+
+def _inventory(*epochs):
+    """
+    Inventory of TW.NSE01..EHZ with ``(start, end, sampling_rate)`` epochs.
+    """
+    from obspy.core.inventory import Channel, Inventory, Network, Station
+    channels = [Channel("EHZ", "", 24.0, 121.6, 30.0, 0.0, start_date=start,
+                        end_date=end, sample_rate=rate)
+                for start, end, rate in epochs]
+    station = Station("NSE01", 24.0, 121.6, 30.0, channels=channels)
+    return Inventory(networks=[Network("TW", stations=[station])])
+
+
+def _stub_data():
+    from stub_server import synthetic_mseed
+    return obspy.read(io.BytesIO(synthetic_mseed(1000)))[0]
+
+
+def test_export_waveforms(tmpdir, stub_server):
+    server = stub_server(nstations=1)
+    path = str(tmpdir.join("export.zarr"))
+    store = export_waveforms(Client(server.base_url), path, "TW", "NSE01",
+                             "--", "EH?", T, T + 12, chunk_duration=5,
+                             workers=2)
+    assert store.channels == ["TW.NSE01..EHE", "TW.NSE01..EHN",
+                              "TW.NSE01..EHZ"]
+    array = zarr.open(path, mode="r")[store.attrs["arrays"][0]]
+    assert array.shape == (3, 1200)
+    np.testing.assert_array_equal(array[2, :1000], _stub_data().data)
+    assert np.isnan(array[2, 1000:]).all()
+    assert np.isnan(array[:2]).all()
+
+
+def test_export_uses_rate_of_epoch_at_starttime(tmpdir, stub_server):
+    client = Client(stub_server().base_url)
+    inv = _inventory((T - 86400, T + 5, 100.0), (T + 5, None, 50.0))
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter("always")
+        store = export_waveforms(client, str(tmpdir.join("a.zarr")), "TW",
+                                 "NSE01", "--", "EHZ", T, T + 10,
+                                 inventory=inv)
+    assert ["changes within the window" in str(x.message) for x in w] == [
+        True]
+    assert [store[name].sampling_rate for name in store.attrs["arrays"]] \
+        == [100.0]
+    np.testing.assert_array_equal(store.read("TW.NSE01..EHZ"),
+                                  _stub_data().data)
+
+    # The 100 Hz data of the stub does not fit a 50 Hz epoch.
+    inv = _inventory((T - 86400, None, 50.0))
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter("always")
+        store = export_waveforms(client, str(tmpdir.join("b.zarr")), "TW",
+                                 "NSE01", "--", "EHZ", T, T + 10,
+                                 inventory=inv)
+    assert any("instead of 50 Hz" in str(x.message) for x in w)
+    assert np.isnan(store.read("TW.NSE01..EHZ")).all()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import re
+import warnings
+
+import pytest
+
+obspy = pytest.importorskip("obspy")
+
+from client import Client  # noqa: E402
+from header import FDSNNoDataException  # noqa: E402
+from instrumentation import Instrumentation  # noqa: E402
+
+T = obspy.UTCDateTime(2008, 4, 16)
+
+PROMETHEUS_LINE = re.compile(r'^(\w+)\{event="(\w+)"\} (\S+)$')
+
+
+@pytest.fixture
+def client(stub_server):
+    """
+    Authenticated client of a stub server after a request with data and
+    one without, and the events it emitted.
+    """
+    server = stub_server()
+    client = Client(server.base_url, user="u", password="p")
+    events = []
+    client.instrumentation.subscribe(
+        lambda event, data: events.append((event, data)))
+    client.get_waveforms("TW", "NSE01", "--", "EHZ", T, T + 5)
+    with pytest.raises(FDSNNoDataException):
+        client.get_waveforms("TW", "NODATA", "--", "EHZ", T, T + 5)
+    return client, events
+
+
+def test_get_stats(client):
+    client, events = client
+    from stub_server import synthetic_mseed
+    size = len(synthetic_mseed(1000))
+    stats = client.instrumentation.get_stats()
+    assert sorted(stats) == ["decode", "request", "token"]
+    request = stats["request"]
+    assert (request["count"], request["errors"]) == (2, 1)
+    assert request["bytes_wire_sum"] == request["bytes_wire_max"] == size
+    assert request["retries_sum"] == 0
+    assert 0 < request["duration_max"] <= request["duration_sum"]
+    assert request["ttfb_sum"] <= request["duration_sum"]
+    assert "status_sum" not in request and "error_sum" not in request
+    # Login, then one verification per request.
+    assert (stats["token"]["count"], stats["token"]["errors"]) == (3, 0)
+    assert (stats["decode"]["count"], stats["decode"]["nbytes_sum"]) == (
+        1, size)
+    assert client.get_stats()["events"] == stats
+
+    requests = [data for event, data in events if event == "request"]
+    assert [data["status"] for data in requests] == [200, 204]
+    assert [data["error"] for data in requests] == [None, 204]
+    assert all("/fdsnws/dataselect/0/queryauth?" in data["url"]
+               for data in requests)
+
+
+def test_to_prometheus(client):
+    client, _ = client
+    stats = client.instrumentation.get_stats()
+    lines = client.instrumentation.to_prometheus().splitlines()
+    exported = {}
+    for line in lines:
+        name, event, value = PROMETHEUS_LINE.match(line).groups()
+        assert name.startswith("tapsclient_")
+        exported[(event, name[len("tapsclient_"):])] = float(value)
+    assert exported == dict(
+        ((event, key), float(value))
+        for event, values in stats.items() for key, value in values.items())
+    assert 'taps_count{event="request"} 2.0' in \
+        client.instrumentation.to_prometheus(prefix="taps")
+    client.instrumentation.reset()
+    assert client.instrumentation.to_prometheus() == ""
+
+
+def test_failing_callback_warns():
+    instrumentation = Instrumentation()
+    seen = []
+
+    def broken(event, data):
+        raise RuntimeError("boom")
+
+    instrumentation.subscribe(broken)
+    instrumentation.subscribe(lambda event, data: seen.append(event))
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter("always")
+        with pytest.raises(ValueError):
+            with instrumentation.timer("decode", nbytes=10):
+                raise ValueError()
+    assert len(w) == 1 and "boom" in str(w[0].message)
+    assert seen == ["decode"]
+    instrumentation.unsubscribe(broken)
+    instrumentation.emit("decode", {"nbytes": 5, "flag": True})
+    stats = instrumentation.get_stats()["decode"]
+    assert (stats["count"], stats["errors"]) == (2, 1)
+    assert (stats["nbytes_sum"], stats["nbytes_max"]) == (15, 10)
+    assert "flag_sum" not in stats
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+obspy = pytest.importorskip("obspy")
+
+from merge import merge_traces  # noqa: E402
+
+T = obspy.UTCDateTime(2008, 4, 16)
+HEADER = {"network": "TW", "station": "NSE01", "channel": "EHZ",
+          "sampling_rate": 100.0}
+
+
+def _chunks(data, length, overlap=0, drop=()):
+    chunks = []
+    for i, start in enumerate(range(0, len(data), length)):
+        if i in drop:
+            continue
+        header = dict(HEADER, starttime=T + start / 100.0)
+        chunks.append(obspy.Trace(data[start:start + length + overlap].copy(),
+                                  header=header))
+    return chunks
+
+
+def _obspy_merge(traces, fill_value=None):
+    st = obspy.Stream([tr.copy() for tr in traces])
+    st.merge(method=1, fill_value=fill_value)
+    return st
+
+
+def _assert_same(result, expected):
+    assert len(result) == len(expected) == 1
+    a, b = result[0], expected[0]
+    assert a.stats.starttime == b.stats.starttime
+    assert a.stats.npts == b.stats.npts
+    assert a.data.dtype == b.data.dtype
+    np.testing.assert_array_equal(np.ma.getmaskarray(a.data),
+                                  np.ma.getmaskarray(b.data))
+    assert np.ma.allequal(a.data, b.data)
+
+
+@pytest.fixture
+def data():
+    return np.arange(10000, dtype=np.int32) % 977
+
+
+@pytest.mark.parametrize("fill_value", [None, 0, -1, "interpolate"])
+@pytest.mark.parametrize("drop", [(), (3,), (3, 4, 7)])
+def test_gaps_match_obspy(data, fill_value, drop):
+    chunks = _chunks(data, 500, drop=drop)
+    _assert_same(merge_traces(chunks, fill_value=fill_value),
+                 _obspy_merge(chunks, fill_value=fill_value))
+
+
+def test_contiguous_chunks_restore_data(data):
+    merged = merge_traces(_chunks(data, 300))
+    np.testing.assert_array_equal(merged[0].data, data)
+    assert not np.ma.isMaskedArray(merged[0].data)
+
+
+def test_overlaps_last_matches_obspy_method_1():
+    first = obspy.Trace(np.zeros(10, dtype=np.int32),
+                        header=dict(HEADER, starttime=T))
+    second = obspy.Trace(np.ones(10, dtype=np.int32),
+                         header=dict(HEADER, starttime=T + 0.05))
+    _assert_same(merge_traces([first, second], method="last"),
+                 _obspy_merge([first, second]))
+    result = merge_traces([first, second], method="first")[0].data
+    np.testing.assert_array_equal(result, [0] * 10 + [1] * 5)
+
+
+def test_identical_overlaps(data):
+    chunks = _chunks(data, 500, overlap=20)
+    for method in ("first", "last"):
+        _assert_same(merge_traces(chunks, method=method),
+                     _obspy_merge(chunks))
+
+
+def test_masked_input_keeps_mask(data):
+    chunks = _chunks(data, 500, drop=(2,))
+    gappy = merge_traces(chunks[:4])
+    assert np.ma.isMaskedArray(gappy[0].data)
+    rest = chunks[4:]
+    _assert_same(merge_traces(list(gappy) + rest),
+                 _obspy_merge(chunks))
+    filled = merge_traces(list(gappy) + rest, fill_value=0)[0].data
+    assert not np.ma.isMaskedArray(filled)
+    assert (filled[1000:1500] == 0).all()
+    interpolated = merge_traces(list(gappy) + rest,
+                                fill_value="interpolate")
+    _assert_same(interpolated, _obspy_merge(chunks, "interpolate"))
+
+
+@pytest.mark.parametrize("method", ["first", "last"])
+def test_masked_samples_never_win(data, method):
+    masked = obspy.Trace(np.ma.masked_array(data[:100], mask=False),
+                         header=dict(HEADER, starttime=T))
+    masked.data.mask[10:20] = True
+    repair = obspy.Trace(np.ma.masked_array(data[5:25], mask=False),
+                         header=dict(HEADER, starttime=T + 0.05))
+    repair.data.mask[:5] = True
+    for segments in ([masked, repair], [repair, masked]):
+        result = merge_traces(segments, method=method)[0].data
+        assert not np.ma.is_masked(result)
+        np.testing.assert_array_equal(result, data[:100])
+
+
+def test_channels_are_kept_apart(data):
+    chunks = _chunks(data, 500)
+    other = [tr.copy() for tr in chunks]
+    for tr in other:
+        tr.stats.channel = "EHN"
+    merged = merge_traces(chunks + other)
+    assert [tr.id for tr in merged] == ["TW.NSE01..EHZ", "TW.NSE01..EHN"]
+
+
+def test_invalid_method(data):
+    with pytest.raises(ValueError):
+        merge_traces(_chunks(data, 500), method="mean")
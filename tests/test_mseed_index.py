@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+obspy = pytest.importorskip("obspy")
+
+from mseed_index import MSeedIndex  # noqa: E402
+
+T = obspy.UTCDateTime(2008, 4, 16)
+RECLEN = 512
+
+
+def _trace(channel, starttime, npts, seed=0):
+    data = np.random.RandomState(seed).randint(-1000, 1000, npts)
+    return obspy.Trace(data.astype(np.int32), header={
+        "network": "TW", "station": "NSE01", "location": "",
+        "channel": channel, "starttime": starttime, "sampling_rate": 100.0})
+
+
+def _records(tr, path):
+    tr.write(path, format="MSEED", reclen=RECLEN, encoding="STEIM2")
+    with open(path, "rb") as fh:
+        raw = fh.read()
+    return [raw[i:i + RECLEN] for i in range(0, len(raw), RECLEN)]
+
+
+def _assert_same(st, expected):
+    assert len(st) == len(expected)
+    for tr, ref in zip(sorted(st, key=lambda tr: tr.id),
+                       sorted(expected, key=lambda tr: tr.id)):
+        assert tr.id == ref.id
+        assert tr.stats.starttime == ref.stats.starttime
+        np.testing.assert_array_equal(tr.data, ref.data)
+
+
+@pytest.fixture
+def multiplexed(tmpdir):
+    """
+    Three channels with their records interleaved in one file.
+    """
+    channels = [_records(_trace(cha, T, 30000, i), str(tmpdir.join(cha)))
+                for i, cha in enumerate(("EHE", "EHN", "EHZ"))]
+    path = str(tmpdir.join("multiplexed.mseed"))
+    with open(path, "wb") as fh:
+        for i in range(max(len(records) for records in channels)):
+            for records in channels:
+                if i < len(records):
+                    fh.write(records[i])
+    return path
+
+
+@pytest.fixture
+def day_files(tmpdir):
+    """
+    One channel split over two files, with a gap in the second one.
+    """
+    paths = []
+    for i, (start, npts) in enumerate([(T, 20000), (T + 200, 10000),
+                                       (T + 400, 10000)]):
+        path = str(tmpdir.join("part%d.mseed" % min(i, 1)))
+        with open(path, "ab") as fh:
+            for record in _records(_trace("EHZ", start, npts, i),
+                                   str(tmpdir.join("tmp"))):
+                fh.write(record)
+        if path not in paths:
+            paths.append(path)
+    return paths
+
+
+@pytest.mark.parametrize("window", [(0, 300), (10.005, 10.5), (123.4, 250),
+                                    (-10, 20), (290, 400)])
+def test_read_multiplexed_matches_obspy(multiplexed, window):
+    t0, t1 = T + window[0], T + window[1]
+    with MSeedIndex([multiplexed]) as index:
+        assert index.channels == ["TW.NSE01..EHE", "TW.NSE01..EHN",
+                                  "TW.NSE01..EHZ"]
+        st = index.read("TW.NSE01..EH?", t0, t1)
+    expected = obspy.read(multiplexed).merge().trim(t0, t1)
+    _assert_same(st, expected)
+
+
+def test_read_reads_only_overlapping_records(multiplexed):
+    with MSeedIndex([multiplexed]) as index:
+        everything = index.records("TW.NSE01..EHZ")
+        window = index.records("TW.NSE01..EHZ", T + 100, T + 101)
+    assert 0 < len(window) < len(everything)
+    assert all(record in everything for record in window)
+
+
+@pytest.mark.parametrize("window", [(0, 600), (150, 250), (190, 450),
+                                    (300, 350), (350, 380)])
+def test_read_multiple_files_matches_obspy(tmpdir, day_files, window):
+    t0, t1 = T + window[0], T + window[1]
+    with MSeedIndex([str(tmpdir.join("part*.mseed"))]) as index:
+        assert len(index) == 2
+        st = index.read("TW.NSE01..EHZ", t0, t1)
+    expected = obspy.Stream()
+    for path in day_files:
+        expected += obspy.read(path)
+    # Windows inside the gap have no records and no trace, like the
+    # segments trimmed before merging.
+    expected = expected.trim(t0, t1).merge()
+    if not len(expected):
+        assert not len(st)
+        return
+    assert np.ma.is_masked(st[0].data) == np.ma.is_masked(expected[0].data)
+    np.testing.assert_array_equal(np.ma.getmaskarray(st[0].data),
+                                  np.ma.getmaskarray(expected[0].data))
+    _assert_same(st, expected)
+
+
+def test_read_without_merge_returns_segments(tmpdir, day_files):
+    with MSeedIndex([str(tmpdir.join("part*.mseed"))]) as index:
+        st = index.read("TW.NSE01..EHZ", merge=False)
+    st.merge()
+    expected = obspy.Stream()
+    for path in day_files:
+        expected += obspy.read(path)
+    _assert_same(st, expected.merge())
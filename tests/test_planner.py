@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+obspy = pytest.importorskip("obspy")
+
+from planner import (WaveformRequest, demultiplex,  # noqa: E402
+                     plan_waveform_requests)
+
+T = obspy.UTCDateTime(2008, 4, 16)
+
+
+def _trace(seed_id):
+    net, sta, loc, cha = seed_id.split(".")
+    return obspy.Trace(header={"network": net, "station": sta,
+                               "location": loc, "channel": cha,
+                               "starttime": T})
+
+
+@pytest.mark.parametrize("location, seed_id, expected", [
+    ("", "TW.NSE01..EHZ", True),
+    ("--", "TW.NSE01..EHZ", True),
+    ("--", "TW.NSE01.00.EHZ", False),
+    ("00", "TW.NSE01.00.EHZ", True),
+    ("00,--", "TW.NSE01..EHZ", True),
+    ("0?", "TW.NSE01.01.EHZ", True),
+    ("*", "TW.NSE01.10.EHZ", True),
+    (None, "TW.NSE01..EHZ", True),
+    (None, "TW.NSE01.00.EHZ", True),
+])
+def test_match_location(location, seed_id, expected):
+    req = WaveformRequest("TW", "NSE01", location, "EHZ", T, T + 60)
+    assert req.matches(_trace(seed_id)) is expected
+
+
+def test_match_wildcards_and_lists():
+    req = WaveformRequest("TW", "NSE0*", "--", "EH?,HH?", T, T + 60)
+    assert req.matches(_trace("TW.NSE02..EHN"))
+    assert req.matches(_trace("TW.NSE01..HHZ"))
+    assert not req.matches(_trace("TW.NSE11..EHZ"))
+    assert not req.matches(_trace("TW.NSE01..BHZ"))
+    assert not req.matches(_trace("IU.NSE01..EHZ"))
+
+
+def test_plan_coalesces_cross_products():
+    reqs = [WaveformRequest("TW", sta, "", cha, T, T + 60)
+            for sta in ("NSE01", "NSE02") for cha in ("EHZ", "EHN")]
+    reqs.append(WaveformRequest("TW", "NSE03", "00", "EHZ", T, T + 60))
+    reqs.append(WaveformRequest("TW", "NSE01", "", "EHZ", T + 60, T + 120))
+    queries = plan_waveform_requests(reqs)
+    assert [(q.station, q.location, q.channel, q.members)
+            for q in queries] == [
+        ("NSE01,NSE02", "--", "EHN,EHZ", [0, 1, 2, 3]),
+        ("NSE03", "00", "EHZ", [4]),
+        ("NSE01", "--", "EHZ", [5])]
+
+
+def test_plan_none_location_asks_for_any_location():
+    reqs = [WaveformRequest("TW", "NSE01", None, "EHZ", T, T + 60)]
+    query, = plan_waveform_requests(reqs)
+    assert query.location == "*"
+    st = obspy.Stream([_trace("TW.NSE01..EHZ"), _trace("TW.NSE01.00.EHZ")])
+    assert len(demultiplex(st, query, reqs)[0]) == 2
+
+
+def test_plan_respects_max_items():
+    reqs = [WaveformRequest("TW", "NSE%02d" % i, "", "EHZ", T, T + 60)
+            for i in range(10)]
+    queries = plan_waveform_requests(reqs, max_items=4)
+    assert [len(q.members) for q in queries] == [4, 4, 2]
+
+
+def test_demultiplex_copies_shared_traces():
+    reqs = [WaveformRequest("TW", "NSE01", "", "EHZ", T, T + 60),
+            WaveformRequest("TW", "NSE01", "", "EHZ", T, T + 60),
+            WaveformRequest("TW", "NSE02", "", "EH?", T, T + 60)]
+    queries = plan_waveform_requests(reqs)
+    st = obspy.Stream([_trace("TW.NSE01..EHZ"), _trace("TW.NSE02..EHN"),
+                       _trace("TW.NSE02..EHZ")])
+    result = {}
+    for query in queries:
+        result.update(demultiplex(st, query, reqs))
+    assert [len(result[i]) for i in range(3)] == [1, 1, 2]
+    assert result[0][0] is not result[1][0]
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import pickle
+import warnings
+
+import pytest
+
+obspy = pytest.importorskip("obspy")
+
+from query import Query, canonical_location, canonical_time  # noqa: E402
+
+T = obspy.UTCDateTime(2008, 4, 16)
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("2008-04-16", "2008-04-16T00:00:00.000000"),
+    (T, "2008-04-16T00:00:00.000000"),
+    ("2008-04-16T01:02:03Z", "2008-04-16T01:02:03.000000"),
+    (T + 1.5, "2008-04-16T00:00:01.500000"),
+    # Rounded to microseconds, carrying into the seconds.
+    (obspy.UTCDateTime(ns=T.ns + 499), "2008-04-16T00:00:00.000000"),
+    (obspy.UTCDateTime(ns=T.ns + 500), "2008-04-16T00:00:00.000001"),
+    (obspy.UTCDateTime(ns=T.ns - 400), "2008-04-16T00:00:00.000000"),
+    ("1969-12-31T23:59:59.5", "1969-12-31T23:59:59.500000")])
+def test_canonical_time(value, expected):
+    assert canonical_time(value) == expected
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("", "--"), ("--", "--"), ("00", "00"), (" 10 ", "10"),
+    ("00,,10", "00,--,10"), (",", "--,--")])
+def test_canonical_location(value, expected):
+    assert canonical_location(value) == expected
+
+
+def _dataselect(**kwargs):
+    parameters = dict(network="TW", station="NSE01", location="",
+                      channel="EHZ", starttime=T, endtime=T + 3600)
+    parameters.update(kwargs)
+    return Query("dataselect", **parameters)
+
+
+def test_equivalent_queries_are_equal():
+    query = _dataselect()
+    same = [
+        _dataselect(location="--", starttime="2008-04-16T00:00:00.0000001"),
+        Query("dataselect", cha="EHZ", loc="--", net="TW", sta="NSE01",
+              start=T, end="2008-04-16T01:00:00Z"),
+        _dataselect(minimumlength=None)]
+    for other in same:
+        assert other == query and not other != query
+        assert hash(other) == hash(query)
+        assert other.url("x") == query.url("x")
+    assert len(set(same + [query])) == 1
+    assert query != _dataselect(location="00")
+    assert query != Query("station", **query.parameters())
+    assert query != query.parameters()
+    assert pickle.loads(pickle.dumps(query)) == query
+
+
+def test_query_is_immutable():
+    query = _dataselect()
+    with pytest.raises(AttributeError):
+        query.service = "station"
+    replaced = query.replace(loc="00", endtime=None)
+    assert replaced["location"] == "00" and replaced.get("endtime") is None
+    assert query["loc"] == "--"
+
+
+def test_invalid_parameters():
+    with pytest.raises(TypeError, match="not supported"):
+        _dataselect(color="red")
+    with pytest.raises(TypeError, match="same option"):
+        _dataselect(net="BW")
+    with pytest.raises(TypeError, match="could not be converted"):
+        _dataselect(minimumlength="long")
+    with pytest.raises(ValueError, match="event"):
+        Query("event")
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter("always")
+        query = _dataselect(nodata=404)
+    assert len(w) == 1 and query.get("nodata") is None
+
+
+def test_query_string():
+    query = _dataselect(channel="EH?,HH*", minimumlength=10,
+                        longestonly=True)
+    assert query.query_string == (
+        "starttime=2008-04-16T00:00:00.000000&"
+        "endtime=2008-04-16T01:00:00.000000&network=TW&station=NSE01&"
+        "location=--&channel=EH%3F,HH*&minimumlength=10.0&longestonly=true")
+    prefix = "https://localhost/fdsnws/dataselect/1/query"
+    assert query.url(prefix) == prefix + "?" + query.query_string
+    assert Query("dataselect").url(prefix) == prefix
+
+
+def test_post_line():
+    assert _dataselect().post_line() == (
+        "TW NSE01 -- EHZ 2008-04-16T00:00:00.000000 "
+        "2008-04-16T01:00:00.000000")
+    assert Query("dataselect", station="NSE01").post_line() == \
+        "* NSE01 * * * *"
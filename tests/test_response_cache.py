@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import copy
+import warnings
+
+import numpy as np
+import pytest
+
+obspy = pytest.importorskip("obspy")
+
+from response_cache import (ResponseCache, attach_responses,  # noqa: E402
+                            response_fingerprint)
+
+
+@pytest.fixture
+def data():
+    st = obspy.read()
+    inv = obspy.read_inventory()
+    return st, inv
+
+
+def _response(inv, seed_id="BW.RJOB..EHZ",
+              time=obspy.UTCDateTime(2009, 8, 24)):
+    # Inventory.select returns copies, the response is changed in place.
+    for net in inv:
+        for sta in net:
+            for cha in sta:
+                if "%s.%s.%s.%s" % (net.code, sta.code, cha.location_code,
+                                    cha.code) == seed_id and \
+                        cha.is_active(time):
+                    return cha.response
+
+
+def test_fingerprint_depends_on_content_only(data):
+    _, inv = data
+    response = _response(inv)
+    same = copy.deepcopy(response)
+    same.response_stages[0].description = "re-issued"
+    assert response_fingerprint(response) == response_fingerprint(same)
+    changed = copy.deepcopy(response)
+    changed.response_stages[0].stage_gain *= 2
+    assert response_fingerprint(response) != response_fingerprint(changed)
+
+
+def test_remove_response_matches_obspy(data):
+    st, inv = data
+    expected = st.copy()
+    expected.remove_response(inventory=inv, output="VEL",
+                             pre_filt=(0.1, 0.2, 30, 40))
+    result = st.copy()
+    ResponseCache().remove_response(result, inventory=inv, output="VEL",
+                                    pre_filt=(0.1, 0.2, 30, 40))
+    for a, b in zip(expected, result):
+        np.testing.assert_allclose(a.data, b.data, rtol=1e-10,
+                                   atol=1e-12 * np.abs(a.data).max())
+
+
+def test_changed_response_gets_new_filter(data, tmp_path):
+    st, inv = data
+    tr = st.select(channel="EHZ")[0]
+    changed_inv = copy.deepcopy(inv)
+    _response(changed_inv).response_stages[0].stage_gain *= 2
+    cache = ResponseCache(path=str(tmp_path))
+    cache.remove_response([tr.copy()], inventory=inv)
+    # Same channel and epoch, different stages: in memory and on disk.
+    for current in (cache, ResponseCache(path=str(tmp_path))):
+        result = current.remove_response([tr.copy()],
+                                          inventory=changed_inv)[0]
+        expected = tr.copy().remove_response(inventory=changed_inv)
+        np.testing.assert_allclose(result.data, expected.data, rtol=1e-10,
+                                   atol=1e-12 * np.abs(expected.data).max())
+    assert cache.get_stats()["misses"] == 2
+
+
+def test_distinct_response_objects_do_not_share_filters(data):
+    # Filters of attached responses are keyed on content, not on the
+    # identity of (possibly garbage collected) response objects.
+    st, inv = data
+    cache = ResponseCache()
+    first = st.select(channel="EHZ").copy()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        attach_responses(first, inv)
+    cache.remove_response(first)
+    del first
+    changed_inv = copy.deepcopy(inv)
+    _response(changed_inv).response_stages[0].stage_gain *= 2
+    second = st.select(channel="EHZ").copy()
+    attach_responses(second, changed_inv)
+    cache.remove_response(second)
+    expected = st.select(channel="EHZ").copy()
+    expected.remove_response(inventory=changed_inv)
+    np.testing.assert_allclose(second[0].data, expected[0].data,
+                               rtol=1e-10,
+                               atol=1e-12 * np.abs(expected[0].data).max())
+    assert cache.get_stats() == {"size": 2, "maxsize": 256, "hits": 0,
+                                 "misses": 2}
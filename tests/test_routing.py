@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+
+from client import Client
+from routing import RoutingClient
+
+obspy = pytest.importorskip("obspy")
+
+T = obspy.UTCDateTime(2008, 4, 16)
+
+
+class _Center(Client):
+    """
+    Offline client serving a fixed set of networks.
+    """
+    def __init__(self, base_url, networks):
+        self.base_url = base_url
+        self.networks = networks
+        self.calls = 0
+
+    def get_stations(self, **kwargs):
+        self.calls += 1
+        time.sleep(0.05)
+        return [SimpleNamespace(code=code) for code in self.networks]
+
+
+def test_routes_are_discovered_once_by_concurrent_requests():
+    centers = {"A": _Center("https://a", ["TW"]),
+               "B": _Center("https://b", ["BW", "TW"])}
+    client = RoutingClient(centers, discover=True)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        client.route("BW"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    client.close()
+    assert results == [["B"]] * 8
+    assert [center.calls for center in centers.values()] == [1, 1]
+    assert client.route("TW") == ["A", "B"]
+
+
+@pytest.fixture
+def servers(stub_server):
+    """
+    Two stub servers that both serve network TW.
+    """
+    return [stub_server(nstations=3) for _ in range(2)]
+
+
+def _routing_client(servers, **kwargs):
+    return RoutingClient(OrderedDict(
+        (name, Client(server.base_url))
+        for name, server in zip(("A", "B"), servers)), **kwargs)
+
+
+def _dataselect_requests(server):
+    return server.counts.get("/fdsnws/dataselect/0/query", 0)
+
+
+def test_get_waveforms_without_network_queries_all_centers(servers):
+    client = _routing_client(servers)
+    st = client.get_waveforms(None, "NSE01", "*", "EHZ", T, T + 5)
+    assert [tr.id for tr in st] == ["TW.NSE01..EHZ"]
+    assert [_dataselect_requests(server) for server in servers] == [1, 1]
+    streams = client.get_waveforms_batch(
+        [(None, "NSE01", "*", "EHZ", T, T + 5)])
+    client.close()
+    assert [[tr.id for tr in st] for st in streams] == [["TW.NSE01..EHZ"]]
+    assert [_dataselect_requests(server) for server in servers] == [2, 2]
+
+
+def test_overlapping_centers_deliver_each_trace_once(servers):
+    client = _routing_client(servers, discover=True)
+    assert client.route("TW") == ["A", "B"]
+    st = client.get_waveforms("TW", "NSE01", "*", "EHZ", T, T + 5)
+    assert [tr.id for tr in st] == ["TW.NSE01..EHZ"]
+    assert [_dataselect_requests(server) for server in servers] == [1, 1]
+    inv = client.get_stations(network="TW", level="station")
+    client.close()
+    assert [net.code for net in inv] == ["TW"]
+    assert [sta.code for sta in inv[0]] == ["NSE01", "NSE02", "NSE03"]
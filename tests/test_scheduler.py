@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+from header import FDSNDeadlineExceededException
+from scheduler import PriorityScheduler, deadline_after
+
+
+def _wait_for(condition, timeout=5.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "Timed out"
+        time.sleep(0.005)
+
+
+def _queued(scheduler, priority):
+    return scheduler.get_stats()["classes"][priority]["queued"]
+
+
+def _start(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _join(threads):
+    for thread in threads:
+        thread.join(5.0)
+    assert not any(thread.is_alive() for thread in threads)
+
+
+def test_classes_are_served_by_their_shares():
+    scheduler = PriorityScheduler(capacity=1)
+    # The slot held while the queues fill counts for "normal".
+    order = ["normal"]
+
+    def request(priority):
+        with scheduler.slot(priority):
+            order.append(priority)
+
+    scheduler.acquire("normal")
+    threads = []
+    for priority in ("batch", "normal", "interactive"):
+        for _ in range(30):
+            threads.append(_start(request, priority))
+        _wait_for(lambda: _queued(scheduler, priority) == 30)
+    scheduler.release("normal")
+    _join(threads)
+    # All classes stay queued for the first 26 slots, which are split 8:4:1.
+    first = order[:26]
+    assert [first.count(p) for p in ("interactive", "normal", "batch")] == \
+        [16, 8, 2]
+    assert sorted(order[1:]) == sorted(["batch", "normal", "interactive"] *
+                                       30)
+    stats = scheduler.get_stats()
+    assert stats["running"] == 0
+    assert stats["classes"]["batch"]["dispatched"] == 30
+
+
+def test_batch_is_capped_to_three_quarters():
+    scheduler = PriorityScheduler(capacity=4)
+    for _ in range(3):
+        scheduler.acquire("batch")
+    thread = _start(scheduler.acquire, "batch")
+    _wait_for(lambda: _queued(scheduler, "batch") == 1)
+    time.sleep(0.05)
+    assert scheduler.get_stats()["classes"]["batch"]["running"] == 3
+    # The last slot is left to the other classes.
+    assert scheduler.acquire("interactive", deadline_after(1.0)) < 0.5
+    scheduler.release("interactive")
+    assert _queued(scheduler, "batch") == 1
+    scheduler.release("batch")
+    _join([thread])
+    assert scheduler.get_stats()["classes"]["batch"]["running"] == 3
+
+
+def test_cap_allows_one_slot():
+    scheduler = PriorityScheduler(capacity=1)
+    with scheduler.slot("batch", deadline_after(1.0)):
+        assert scheduler.get_stats()["running"] == 1
+
+
+def test_queued_requests_expire_at_their_deadline():
+    scheduler = PriorityScheduler(capacity=1)
+    scheduler.acquire("batch")
+    errors, waited = [], []
+
+    def expiring():
+        try:
+            scheduler.acquire("interactive", deadline_after(0.2))
+        except FDSNDeadlineExceededException as e:
+            errors.append(e)
+
+    def patient():
+        waited.append(scheduler.acquire("normal"))
+        scheduler.release("normal")
+
+    threads = [_start(expiring) for _ in range(3)] + [_start(patient)]
+    _wait_for(lambda: _queued(scheduler, "normal") == 1)
+    time.sleep(0.4)
+    assert len(errors) == 3 and "interactive" in str(errors[0])
+    assert _queued(scheduler, "interactive") == 0
+    scheduler.release("batch")
+    _join(threads)
+    assert len(waited) == 1
+    stats = scheduler.get_stats()
+    assert stats["running"] == 0
+    assert stats["classes"]["interactive"]["expired"] == 3
+    assert stats["classes"]["interactive"]["dispatched"] == 0
+    # A passed deadline fails at once, the scheduler stays usable.
+    with pytest.raises(FDSNDeadlineExceededException):
+        scheduler.acquire("normal", deadline_after(-1.0))
+    with scheduler.slot("interactive", deadline_after(1.0)):
+        pass
+    assert scheduler.get_stats()["running"] == 0
+
+
+def test_unknown_priority():
+    scheduler = PriorityScheduler()
+    with pytest.raises(ValueError, match="urgent"):
+        scheduler.acquire("urgent")
+    with pytest.raises(ValueError, match="urgent"):
+        PriorityScheduler(limits={"urgent": 0.5})
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import pickle
+import threading
+import time
+
+import pytest
+
+from token_cache import (EXPIRY_MARGIN, FileTokenCache, is_expired,
+                         jwt_expiration)
+
+
+def _token(exp):
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": exp}).encode())
+    return "e30." + payload.decode().rstrip("=") + ".sig"
+
+
+def test_is_expired_reads_the_exp_claim():
+    now = time.time()
+    assert jwt_expiration(_token(now + 3600)) == pytest.approx(now + 3600)
+    assert not is_expired(_token(now + 3600))
+    assert is_expired(_token(now - 1))
+    # Tokens about to expire are refreshed ahead of time.
+    assert is_expired(_token(now + EXPIRY_MARGIN / 2))
+    assert not is_expired(_token(now + EXPIRY_MARGIN / 2), margin=0)
+    assert is_expired(None) and is_expired("")
+    assert not is_expired("opaque-token")
+
+
+def test_instances_share_the_file(tmpdir):
+    path = str(tmpdir.join("tokens.json"))
+    first, second = FileTokenCache(path), FileTokenCache(path)
+    with first.lock():
+        first.store("a|u", "access", "refresh")
+        first.store("b|u", "access-b", "refresh-b")
+    with second.lock():
+        entry = second.load("a|u")
+        assert (entry["access"], entry["refresh"]) == ("access", "refresh")
+        second.clear("a|u")
+    with first.lock():
+        assert first.load("a|u") is None
+        assert first.load("b|u")["access"] == "access-b"
+    assert pickle.loads(pickle.dumps(first)).path == path
+
+
+def test_lock_excludes_other_instances(tmpdir):
+    path = str(tmpdir.join("tokens.json"))
+    events = []
+
+    def other():
+        with FileTokenCache(path).lock():
+            events.append("other")
+
+    with FileTokenCache(path).lock():
+        thread = threading.Thread(target=other)
+        thread.start()
+        time.sleep(0.1)
+        events.append("first")
+    thread.join(5.0)
+    assert events == ["first", "other"]
+
+
+def test_clients_share_a_token(tmpdir, stub_server):
+    pytest.importorskip("obspy")
+    from client import Client
+    server = stub_server()
+    path = str(tmpdir.join("tokens.json"))
+    clients = [Client(server.base_url, user="u", password="p",
+                      token_cache=path) for _ in range(2)]
+    assert server.counts["/api/token"] == 1
+    assert [c.jwt_refresh_token for c in clients] == ["stub-refresh"] * 2
+
+    # An expired refresh token in the cache is replaced.
+    cache = FileTokenCache(path)
+    key = clients[0]._token_cache_key()
+    with cache.lock():
+        cache.store(key, "old-access", _token(time.time() - 1))
+    Client(server.base_url, user="u", password="p", token_cache=cache)
+    assert server.counts["/api/token"] == 2
+    with cache.lock():
+        assert cache.load(key)["refresh"] == "stub-refresh"
+
+
+def test_client_round_trips_through_pickle(tmpdir, stub_server):
+    obspy = pytest.importorskip("obspy")
+    from client import Client
+    server = stub_server()
+    client = Client(server.base_url, user="u", password="p",
+                    token_cache=str(tmpdir.join("tokens.json")),
+                    hedge_after=95, concurrency=True, scheduler=True)
+    events = []
+    client.instrumentation.subscribe(lambda event, data: events.append(1))
+    state = client.__getstate__()
+    for name in ("_url_opener", "instrumentation", "_hedge_executor",
+                 "_hedge_lock"):
+        assert name not in state
+
+    copy = pickle.loads(pickle.dumps(client))
+    assert copy.jwt_access_token == client.jwt_access_token
+    assert copy.token_cache.path == client.token_cache.path
+    assert copy._url_opener is not client._url_opener
+    assert copy._hedge_lock is not client._hedge_lock
+    assert copy.concurrency.in_flight == 0
+    t = obspy.UTCDateTime(2008, 4, 16)
+    st = copy.get_waveforms("TW", "NSE01", "--", "EHZ", t, t + 5)
+    assert len(st) == 1
+    assert server.counts["/fdsnws/dataselect/0/queryauth"] == 1
+    # Neither a new login nor callbacks of the original client.
+    assert server.counts["/api/token"] == 1
+    assert events == []
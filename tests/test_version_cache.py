@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import json
+import multiprocessing
+import pickle
+
+from version_cache import VersionCache, get_version_cache
+
+
+def test_get_version_cache_keys_on_path_and_ttl(tmpdir):
+    path = str(tmpdir.join("versions.json"))
+    cache = get_version_cache(path, ttl=60)
+    assert get_version_cache(path, ttl=60) is cache
+    other = get_version_cache(path, ttl=3600)
+    assert other is not cache
+    assert (cache.ttl, other.ttl) == (60, 3600)
+    assert pickle.loads(pickle.dumps(other)) is other
+
+
+def test_caches_of_one_file_share_versions(tmpdir):
+    path = str(tmpdir.join("versions.json"))
+    get_version_cache(path, ttl=60).put("http://x/version", [1, 2, 3])
+    assert get_version_cache(path, ttl=3600).get("http://x/version") == \
+        [1, 2, 3]
+    assert get_version_cache(path, ttl=-1).get("http://x/version") is None
+
+
+def test_put_keeps_versions_of_other_caches(tmpdir):
+    path = str(tmpdir.join("versions.json"))
+    # Separate instances, as in separate processes.
+    first, second = VersionCache(path), VersionCache(path)
+    first.put("http://a/version", [1, 0])
+    second.put("http://b/version", [2, 0])
+    first.put("http://c/version", [3, 0])
+    with open(path) as fh:
+        assert sorted(json.load(fh)) == [
+            "http://a/version", "http://b/version", "http://c/version"]
+    assert VersionCache(path).get("http://b/version") == [2, 0]
+
+
+def _put_versions(path, worker):
+    cache = VersionCache(path)
+    for i in range(20):
+        cache.put("http://%d/%d/version" % (worker, i), [worker, i])
+
+
+def test_concurrent_processes_keep_all_versions(tmpdir):
+    path = str(tmpdir.join("versions.json"))
+    processes = [multiprocessing.Process(target=_put_versions,
+                                         args=(path, worker))
+                 for worker in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(30)
+    assert [process.exitcode for process in processes] == [0] * 4
+    with open(path) as fh:
+        assert len(json.load(fh)) == 80
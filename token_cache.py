@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Cross-process cache of JSON Web Tokens.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+Worker processes sharing a :class:`FileTokenCache` share one access/refresh
+token pair per server and user. Reading and updating the cache happens
+under an exclusive file lock, so only one process at a time talks to the
+token endpoints::
+
+    >>> from client import Client
+    >>> cache = FileTokenCache("/tmp/taps_tokens.json")
+    >>> client = Client("TAPS", user="user", password="password",
+    ...                 token_cache=cache)  # doctest: +SKIP
+"""
+import base64
+import json
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+    import msvcrt
+
+# Tokens expiring within this many seconds are treated as expired.
+EXPIRY_MARGIN = 30
+
+
+def jwt_expiration(token):
+    """
+    Return the ``exp`` claim of a JSON Web Token as POSIX timestamp or
+    ``None`` if it can not be determined. The signature is not checked.
+    >>> payload = base64.urlsafe_b64encode(b'{"exp": 1600000000}')
+    >>> jwt_expiration("e30." + payload.decode().rstrip("=") + ".sig")
+    1600000000.0
+    >>> print(jwt_expiration("not-a-token"))
+    None
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload.encode()))
+        return float(claims["exp"])
+    except Exception:
+        return None
+
+
+def is_expired(token, margin=EXPIRY_MARGIN):
+    """
+    True if the token is missing or known to expire within ``margin``
+    seconds. Tokens without a readable ``exp`` claim count as valid.
+    """
+    if not token:
+        return True
+    expiration = jwt_expiration(token)
+    if expiration is None:
+        return False
+    return expiration - margin < time.time()
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock on ``path`` across processes, using the lock
+    file ``path + ".lock"``.
+    """
+    fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:  # pragma: no cover
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+        yield
+    finally:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        else:  # pragma: no cover
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        os.close(fd)
+
+
+class FileTokenCache(object):
+    """
+    Token cache in a JSON file guarded by a lock file next to it.
+    Only the path is pickled, so the cache can be handed to worker
+    processes together with a :class:`~client.Client`.
+    :type path: str
+    :param path: JSON file holding the tokens. Created on first store with
+        permissions restricted to the current user.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(os.path.expanduser(path))
+
+    def __repr__(self):
+        return "FileTokenCache(%r)" % self.path
+
+    def lock(self):
+        """
+        Hold an exclusive lock on the cache across processes.
+        """
+        return file_lock(self.path)
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def load(self, key):
+        """
+        Return the cached ``{"access": ..., "refresh": ...}`` entry for
+        ``key`` or ``None``. Call while holding :meth:`lock`.
+        """
+        return self._read().get(key)
+
+    def _write(self, entries):
+        # Write atomically, readers never see a partially written file.
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as fh:
+            json.dump(entries, fh)
+        os.replace(tmp, self.path)
+
+    def store(self, key, access, refresh):
+        """
+        Store a token pair for ``key``. Call while holding :meth:`lock`.
+        """
+        entries = self._read()
+        entries[key] = {"access": access, "refresh": refresh,
+                        "updated": time.time()}
+        self._write(entries)
+
+    def clear(self, key):
+        """
+        Remove the entry for ``key``. Call while holding :meth:`lock`.
+        """
+        entries = self._read()
+        if entries.pop(key, None) is not None:
+            self._write(entries)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Process wide (and optionally persistent) cache of web service versions.
+:copyright:
+    The TAPS Development Team (dmc@earth.sinica.edu.tw)
+
+All clients of a process share one :class:`VersionCache`, so the
+``/version`` endpoint of a service is asked at most once per TTL. With a
+file, the versions survive the process and are shared with other (e.g.
+short-lived worker) processes, which merge their updates under a file
+lock. Versions can be probed in background
+threads, printing a client never waits for the network::
+
+    >>> cache = get_version_cache("/tmp/taps_versions.json", ttl=3600)
+    >>> cache is get_version_cache("/tmp/taps_versions.json", ttl=3600)
+    True
+"""
+import json
+import os
+import threading
+import time
+
+from token_cache import file_lock
+
+# Seconds a probed version is considered current.
+DEFAULT_TTL = 24 * 3600
+
+
+class VersionCache(object):
+    """
+    Thread safe mapping of version URL to the version of the service.
+    :type path: str
+    :param path: Optional JSON file the versions are persisted in.
+    :type ttl: float
+    :param ttl: Seconds after which a version is probed again.
+    """
+    def __init__(self, path=None, ttl=DEFAULT_TTL):
+        if path is not None:
+            path = os.path.abspath(os.path.expanduser(path))
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._probing = set()
+
+    def __repr__(self):
+        return "VersionCache(path=%r, ttl=%s)" % (self.path, self.ttl)
+
+    def __reduce__(self):
+        # Unpickled caches resolve to the shared cache of the new process.
+        return (get_version_cache, (self.path, self.ttl))
+
+    def _fresh(self, entry):
+        return entry is not None and time.time() - entry["time"] < self.ttl
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as fh:
+                entries = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return
+        with self._lock:
+            for url, entry in entries.items():
+                current = self._entries.get(url)
+                if current is None or current["time"] < entry["time"]:
+                    self._entries[url] = entry
+
+    def get(self, url):
+        """
+        Return the cached version (list of ints) of the service at ``url``
+        or ``None`` if it is unknown or outdated.
+        """
+        entry = self._entries.get(url)
+        if not self._fresh(entry) and self.path is not None:
+            # Another process may have probed it in the meantime.
+            self._load()
+            entry = self._entries.get(url)
+        if self._fresh(entry):
+            return list(entry["version"])
+        return None
+
+    def put(self, url, version):
+        with self._lock:
+            self._entries[url] = {"version": list(version),
+                                  "time": time.time()}
+        if self.path is None:
+            return
+        try:
+            # Merge the versions other processes wrote in the meantime
+            # instead of overwriting them.
+            with file_lock(self.path):
+                self._load()
+                with self._lock:
+                    entries = dict(self._entries)
+                self._write(entries)
+        except (IOError, OSError):
+            # The cache is an optimization only.
+            pass
+
+    def _write(self, entries):
+        # Write atomically, readers never see a partially written file.
+        tmp = "%s.%d.%d.tmp" % (self.path, os.getpid(), threading.get_ident())
+        with open(tmp, "w") as fh:
+            json.dump(entries, fh)
+        os.replace(tmp, self.path)
+
+    def probe(self, url, fetch):
+        """
+        Call ``fetch()`` in a background thread and cache the version it
+        returns, unless the version is cached or already being probed.
+        Failures are ignored, the next probe tries again.
+        """
+        with self._lock:
+            if url in self._probing or self._fresh(self._entries.get(url)):
+                return
+            self._probing.add(url)
+
+        def run():
+            try:
+                self.put(url, fetch())
+            except Exception:
+                pass
+            finally:
+                with self._lock:
+                    self._probing.discard(url)
+
+        thread = threading.Thread(target=run, name="version-probe")
+        thread.daemon = True
+        thread.start()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+
+def get_version_cache(path=None, ttl=DEFAULT_TTL):
+    """
+    Return the process wide cache for ``path`` (the in-memory cache for
+    ``None``) and ``ttl``, created on first use. Caches of the same file
+    with different TTLs share the file, not their TTL.
+    """
+    if path is not None:
+        path = os.path.abspath(os.path.expanduser(path))
+    key = (path, ttl)
+    with _CACHES_LOCK:
+        if key not in _CACHES:
+            _CACHES[key] = VersionCache(path, ttl=ttl)
+        return _CACHES[key]